@@ -12,7 +12,7 @@ from subprocess import call
 
 from warctradeoff.crawl import warcprocess
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import logger, upload
+from warctradeoff.utils import logger, upload, warc_index
 import utils
 
 parser = argparse.ArgumentParser(description='Flags for the script')
@@ -32,6 +32,9 @@ parser.add_argument('--run_id', type=int, help='Run ID for the current run. Only
 parser.add_argument('--inferrable_dir', type=str, help='Directory to load URL inferrable information')
 parser.add_argument('--failed_fetch_dir', type=str, help='Directory to load URL failed fetch information')
 parser.add_argument('--collection', type=str, help='Collection name')
+parser.add_argument('--virtual', action='store_true', help='If true, resource/inferrable warcs are written as exclusion manifests over the original warc')
+parser.add_argument('--force', action='store_true', help='If true, re-extract warcs even if they are up to date with their inputs')
+parser.add_argument('--compress', action='store_true', help='If true, extracted warcs are written as per-record gzip .warc.gz')
 args = parser.parse_args()
 
 PREFIX = 'static_replay'
@@ -63,6 +66,10 @@ num_throw_resources = args.num_throw_resources if args.num_throw_resources is no
 run_id = int(args.run_id) if args.run_id is not None else None
 inferrable_dir = args.inferrable_dir
 failed_fetch_dir = args.failed_fetch_dir
+virtual = args.virtual
+force = args.force
+if args.compress:
+    CONFIG.compress_warcs = True
 
 idx = utils.get_idx()
 SUFFIX = '' if idx < 0 else f'_{idx}'
@@ -70,7 +77,8 @@ inferrable_file = f'{inferrable_dir}/inferrable{SUFFIX}.json' if inferrable_dir
 failed_fetch_file = f'{failed_fetch_dir}/diff{SUFFIX}.json' if failed_fetch_dir is not None else None
 if os.environ.get('SEPARATE_COLLECTION') is not None:
     CONFIG.separate_collection = os.environ['SEPARATE_COLLECTION']
-    call(f'rm -rf {CONFIG.archive_dir}/collections/{CONFIG.separate_collection}_*', shell=True)
+    # * Each archive is a tenant of the shared collection (see tenant_index), so drop the ones of earlier runs
+    upload.LocalUploadManager().remove_tenants(CONFIG.separate_collection)
     COLLECTION = CONFIG.separate_collection
 
 # * 1 Find the closest timestamp within certain gap
@@ -80,23 +88,41 @@ cache_static_ts = utils.closest_ts(cache_static_ts, idx, PREFIX)
 
 NUM_WORKERS = 32
 # * 2 Extract static warcs from dynamic warcs
+# * All variants of a WARC (the static one, and the valid cache one if static_ts is also a dynamic_ts)
+# * are extracted in one pass over it (see warcprocess.extract_variants)
 static_extracted = {}
+cache_extracted = {} # * {dynamic_ts: [archive_name]}
 if static_ts:
+    variants, static_variant, variant_prefix = [], None, static_prefix
+    variant_virtual = virtual if resource_match_type else False
     if resource_match_type:
         if inferrable_dir:
-            static_extracted = warcprocess.extract_inferrable_warcs(col=PREFIX, file_suffix=static_ts, resource_match_type=resource_match_type,
-                                                                    inferrable_file=inferrable_file, file_prefix=static_prefix, num_workers=NUM_WORKERS)
+            static_variant = warcprocess.InferrableVariant.from_file(resource_match_type, inferrable_file)
+        elif failed_fetch_file:
+            static_variant = warcprocess.ResourceVariant.from_file(resource_match_type, failed_fetch_file,
+                                                                   num_throw_resources=num_throw_resources, run_id=run_id)
+            variant_prefix = 'record'
         else:
-            static_extracted = warcprocess.extract_resource_warcs(col=PREFIX, file_suffix=static_ts, resource_match_type=resource_match_type,
-                                                              num_throw_resources=num_throw_resources, run_id=run_id, 
-                                                              failed_fetch_file=failed_fetch_file, num_workers=NUM_WORKERS)
-        static_extracted = {s[0]: s[1] for s in static_extracted}
+            static_variant = warcprocess.ResourceVariant(resource_match_type, num_throw_resources=num_throw_resources, run_id=run_id)
+            variant_prefix = 'record'
     elif bypass_static:
         static_extracted = warcprocess.list_static_warcs(col=PREFIX, file_suffix=static_ts, bypass_replay=bypass_replay)
-        static_extracted = {s[0]: s[1] for s in static_extracted}
     else:
-        static_extracted = warcprocess.extract_static_warcs(col=PREFIX, file_suffix=static_ts, file_prefix=static_prefix, num_workers=NUM_WORKERS)
-        static_extracted = {s[0]: s[1] for s in static_extracted}
+        static_variant = warcprocess.StaticVariant()
+    if static_variant is not None:
+        variants.append(static_variant)
+    cache_variant = None
+    if cache_static_ts and not dynamic_other_url and not variant_virtual and static_ts in dynamic_tss:
+        cache_variant = warcprocess.CacheVariant(cache_static_ts)
+        variants.append(cache_variant)
+    if len(variants) > 0:
+        extracted = warcprocess.extract_variants(col=PREFIX, file_suffix=static_ts, variants=variants, file_prefix=variant_prefix,
+                                                 num_workers=NUM_WORKERS, virtual=variant_virtual, force=force)
+        if static_variant is not None:
+            static_extracted = extracted[static_variant.suffix()]
+        if cache_variant is not None:
+            cache_extracted[static_ts] = extracted[cache_variant.suffix()]
+    static_extracted = {s[0]: s[1] for s in static_extracted}
 else:
     print("No static ts specified, skipping extraction", flush=True)
 
@@ -109,12 +135,16 @@ for dynamic_ts in dynamic_tss:
     elif dynamic_other_url:
         dynamic_extracted = warcprocess.extract_dynamic_other_url_warcs(col=PREFIX, file_suffix=dynamic_ts, 
                                                                         static_extracted=static_extracted, file_prefix=dynamic_prefix, 
-                                                                        num_others=dynamic_other_url, cache_static_ts=cache_static_ts, num_workers=NUM_WORKERS)
+                                                                        num_others=dynamic_other_url, cache_static_ts=cache_static_ts, num_workers=NUM_WORKERS,
+                                                                        match_urls=resource_match_type is not None)
         dynamic_extracted = {d[0]: d[1] for d in dynamic_extracted}
     elif cache_static_ts:
-        dynamic_extracted = warcprocess.extract_valid_cached_warcs(col=PREFIX, file_suffix=dynamic_ts, static_ts=cache_static_ts, 
-                                                                    num_workers=NUM_WORKERS)
-        dynamic_extracted = {d: None for d in dynamic_extracted}
+        if dynamic_ts not in cache_extracted:
+            cache_variant = warcprocess.CacheVariant(cache_static_ts)
+            extracted = warcprocess.extract_variants(col=PREFIX, file_suffix=dynamic_ts, variants=[cache_variant],
+                                                     num_workers=NUM_WORKERS, force=force)
+            cache_extracted[dynamic_ts] = extracted[cache_variant.suffix()]
+        dynamic_extracted = {d: None for d in cache_extracted[dynamic_ts]}
     else:
         dynamic_extracted = warcprocess.extract_dynamic_warcs(col=PREFIX, file_suffix=dynamic_ts, selected_archives=selected_archives, num_workers=NUM_WORKERS)
         dynamic_extracted = {d: None for d in dynamic_extracted}
@@ -150,7 +180,7 @@ for archive_name, archive_info in dynamic_extracted_all.items():
     if static_ts:
         if archive_name not in static_extracted:
             continue
-        if not os.path.exists(static_warc):
+        if not warc_index.warc_exists(static_warc):
             continue
         warcs.append(static_warc)
     obj = {'hostname': archive_name, 
@@ -175,5 +205,4 @@ else:
 client = upload.LocalUploadManager()
 separate_collection = CONFIG.separate_collection is not None
 finished = client.upload_warcs_to_archive(warc_paths, col_name=COLLECTION, 
-                                          lock=(not separate_collection),
                                           separate_collection=separate_collection)
\ No newline at end of file
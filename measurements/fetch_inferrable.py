@@ -80,6 +80,16 @@ def check_inferrable_worker(ff, i, total):
     url = ff['url']
     hostname = ff['hostname']
     right_url_src_tracer = source_trace.URLSrcTracer(url, hostname, ff['right_ts'])
+    if source_trace.crawl_contains(hostname, ff['left_ts'], url):
+        # * The URL itself is the most similar one and trivially inferrable, so the keywords of the warcs are not parsed
+        score = right_url_src_tracer.url_tokens.simi_scores(source_trace.URLTokens(url))
+        return {
+            'hostname': hostname,
+            'url': url,
+            'inferrable': True,
+            'most_similar_url': [(score, url)],
+            'matches': []
+        }
     most_similar_urls = right_url_src_tracer.most_similar_urls(hostname, ff['left_ts'])
     if len(most_similar_urls) == 0:
         return {
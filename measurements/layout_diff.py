@@ -19,7 +19,7 @@ from warctradeoff.fidelity_check import layout_tree_patch, missing_resources
 from fidex.fidelity_check import fidelity_detect
 from fidex.utils import logger
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import url_utils
+from warctradeoff.utils import url_utils, catalog
 # supress warnings
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -88,7 +88,14 @@ def fidelity_issue_wrapper(idx, url, dirr, left_prefix='live', right_prefix='arc
 
 def process_fidelity():
     global counter
-    dirs = os.listdir(writes_dir)
+    cat = catalog.get_catalog()
+    cat.refresh(PREFIX)
+    prefix, ts = LEFT.rsplit('-', 1)
+    # * Only archives with both sides done. refresh re-reads archives whose directory changed, so new done files are seen
+    done = set(cat.archive_names(PREFIX, done=[LEFT, RIGHT]))
+    hostname_url = {r['archive_name']: r['url'] for r in cat.runs(PREFIX, file_prefix=prefix, file_suffix=ts)
+                    if r['archive_name'] in done}
+    dirs = list(hostname_url.keys())
     random.shuffle(dirs)
     num_workers = 31
 
@@ -100,18 +107,12 @@ def process_fidelity():
         return total
 
     print("Available dirs:", len(dirs))
-    hostname_url = {}
     results = []
     with futures.ProcessPoolExecutor(num_workers) as executor:
         rs = []
         last_ts = time.time()
         for d in dirs:
-            metadata = json.load(open(f'{writes_dir}/{d}/metadata.json'))
-            prefix, ts = LEFT.rsplit('-', 1)
-            if metadata.get(prefix, {}).get(ts) is None:
-                continue
-            url = metadata[prefix][ts]['url']
-            hostname_url[d] = url
+            url = hostname_url[d]
             rs.append(executor.submit(fidelity_issue_wrapper, counter, url, f'{writes_dir}/{d}', LEFT, RIGHT, True, False, False, True))
             counter += 1
         while len(rs):
@@ -139,7 +140,7 @@ def process_fidelity():
 
 
 def missing_scripts():
-    dirs = os.listdir(writes_dir)
+    dirs = [os.path.basename(d) for d in catalog.archive_dirs(PREFIX)]
     results = []
     for i, d in enumerate(dirs):
         print(i, d, flush=True)
@@ -152,7 +153,7 @@ def missing_scripts():
 
 def missing_scripts_xhr_content():
     """Beyond just check missing fetched scripts. Also checks for if XHR content is different between crawls"""
-    dirs = os.listdir(writes_dir)
+    dirs = [os.path.basename(d) for d in catalog.archive_dirs(PREFIX)]
     results = []
     def get_ts(ts):
         ts_split = ts.split('-')
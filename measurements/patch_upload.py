@@ -12,7 +12,7 @@ from subprocess import call
 
 from warctradeoff.patch import patch
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import logger, upload
+from warctradeoff.utils import logger, upload, warc_utils
 import utils
 
 parser = argparse.ArgumentParser(description='Flags for the script')
@@ -39,11 +39,12 @@ dynamic_ts = utils.closest_ts(dynamic_ts, idx, PREFIX)
 
 if os.environ.get('SEPARATE_COLLECTION') is not None:
     CONFIG.separate_collection = os.environ['SEPARATE_COLLECTION']
-    call(f'rm -rf {CONFIG.archive_dir}/collections/{CONFIG.separate_collection}_*', shell=True)
+    # * Each archive is a tenant of the shared collection (see tenant_index), so drop the ones of earlier runs
+    upload.LocalUploadManager().remove_tenants(CONFIG.separate_collection)
     COLLECTION = CONFIG.separate_collection
 
 # * Extract static warcs from dynamic warcs
-call(f'rm {CONFIG.archive_dir}/warcs/{PREFIX}/*_{static_ts}.static.patched.warc', shell=True)
+call(f'rm -f {CONFIG.archive_dir}/warcs/{PREFIX}/*_{static_ts}.static.patched.warc*', shell=True)
 patched = patch.patch_warcs(col=PREFIX, 
                             dynamic_suffix=dynamic_ts, 
                             static_suffix=static_ts, 
@@ -58,7 +59,7 @@ for warc in glob.glob(f'{CONFIG.archive_dir}/warcs/{PREFIX}/*_{dynamic_ts}.warc'
     static_patched_warc = f'{CONFIG.archive_dir}/warcs/{PREFIX}/{archive_name}_{static_ts}.static.patched.warc'
     if archive_name not in patched:
         continue
-    if not os.path.exists(static_patched_warc):
+    if not os.path.exists(warc_utils.resolve_warc(static_patched_warc)):
         continue
     obj = {'hostname': archive_name,
            'patch_warc_info': static_patched_warc,
@@ -82,5 +83,4 @@ else:
 client = upload.LocalUploadManager()
 separate_collection = CONFIG.separate_collection is not None
 client.upload_warcs_to_archive(warc_paths, col_name=COLLECTION,
-                               lock=(not separate_collection),
                                separate_collection=separate_collection)
\ No newline at end of file
@@ -4,6 +4,8 @@ import re
 from datetime import datetime
 import json
 
+from warctradeoff.utils import catalog
+
 DEFAULT_TIMEGAP = 30 * 60
 
 def get_idx():
@@ -17,14 +19,20 @@ def get_idx():
     else:
         return -1
 
-def get_tss(ts, idx, PREFIX, gap=DEFAULT_TIMEGAP):
+def load_suffixes(idx, PREFIX) -> list:
+    """[{'suffix': ts}] of crawls in PREFIX, from metadata/{PREFIX}_metadata.json or the catalog if it doesn't exist"""
     cur_dir = os.path.dirname(os.path.abspath(__file__))
+    path = f'{cur_dir}/metadata/{PREFIX}_metadata.json' if idx < 0 else f'{cur_dir}/metadata/{PREFIX}_metadata_{idx}.json'
+    if os.path.exists(path):
+        return json.load(open(path))
+    cat = catalog.get_catalog()
+    cat.refresh(PREFIX)
+    return [{'suffix': suffix} for suffix in cat.suffixes(PREFIX)]
+
+def get_tss(ts, idx, PREFIX, gap=DEFAULT_TIMEGAP):
     if ts is None:
         return None
-    if idx < 0:
-        metadata = json.load(open(f'{cur_dir}/metadata/{PREFIX}_metadata.json'))
-    else:
-        metadata = json.load(open(f'{cur_dir}/metadata/{PREFIX}_metadata_{idx}.json'))
+    metadata = load_suffixes(idx, PREFIX)
     DELIMITERS = ['-', ',']
     pattern = f"([{re.escape(''.join(DELIMITERS))}]+)"
     ts_split = re.split(pattern, ts)
@@ -58,13 +66,9 @@ def closest_ts(ts, idx, PREFIX, gap=DEFAULT_TIMEGAP):
     num_ts: Number of ts to extract from ts (split by '-')
     gap: in seconds
     """
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
     if ts is None:
         return None
-    if idx < 0:
-        metadata = json.load(open(f'{cur_dir}/metadata/{PREFIX}_metadata.json'))
-    else:
-        metadata = json.load(open(f'{cur_dir}/metadata/{PREFIX}_metadata_{idx}.json'))
+    metadata = load_suffixes(idx, PREFIX)
     DELIMITERS = ['-', ',']
     pattern = f"([{re.escape(''.join(DELIMITERS))}]+)"
     ts_split = re.split(pattern, ts)
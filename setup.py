@@ -19,6 +19,8 @@ setup(
         "pandas",
         "diff_match_patch",
         "levenshtein",
+        "warcio",
+        "surt",
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",
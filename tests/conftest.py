@@ -0,0 +1,11 @@
+import pytest
+
+from warctradeoff.config import CONFIG
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    """CONFIG.archive_dir pointed to an empty directory (with its own catalog)"""
+    archive_dir = tmp_path / 'archive'
+    archive_dir.mkdir()
+    monkeypatch.setitem(CONFIG.config, 'archive_dir', str(archive_dir))
+    return str(archive_dir)
@@ -0,0 +1,70 @@
+"""Small synthetic WARCs and crawls for the unit tests, written with warcio"""
+import io
+import os
+import json
+
+from warcio.warcwriter import WARCWriter
+from warcio.statusandheaders import StatusAndHeaders
+
+PAGE = 'http://site.com/'
+RESOURCES = [
+    (PAGE, 'text/html', b'<html>hi</html>'),
+    ('http://site.com/a.js', 'application/javascript', b'var a=1;'),
+    ('http://site.com/api', 'application/json', b'{"x":1}'),
+    ('http://cdn.com/s.css', 'text/css', b'body{}'),
+]
+# * (url, mime, body, resourceType, is_static) of a crawl. Non-static fetches are initiated by a script
+FETCHES = [
+    (PAGE, 'text/html', b'<html>hi</html>', 'Document', True),
+    ('http://site.com/a.js', 'application/javascript', b'var a=1;', 'Script', False),
+    ('http://site.com/api', 'application/json', b'{"x":1}', 'XHR', False),
+    ('http://cdn.com/s.css', 'text/css', b'body{}', 'Stylesheet', True),
+    ('http://site.com/img.png', 'image/png', b'PNG', 'Image', True),
+]
+COL = 'col'
+TS = '202501010000'
+
+def response_record(writer, url, mime, body, date='2025-01-01T00:00:00Z', headers=()):
+    http_headers = StatusAndHeaders('200 OK', [('Content-Type', mime)] + list(headers), protocol='HTTP/1.1')
+    return writer.create_warc_record(url, 'response', payload=io.BytesIO(body), http_headers=http_headers,
+                                     warc_headers_dict={'WARC-Date': date})
+
+def request_record(writer, url):
+    http_headers = StatusAndHeaders('GET / HTTP/1.1', [], is_http_request=True)
+    return writer.create_warc_record(url, 'request', payload=io.BytesIO(b''), http_headers=http_headers)
+
+def make_warc(path, resources=RESOURCES, gzip=False, requests=True, date='2025-01-01T00:00:00Z', headers=None) -> str:
+    """
+    Write a response (and a request, if requests is set) record for each (url, mime, body) of resources
+    headers: {url: [(name, value)]} of extra HTTP headers of responses
+    """
+    headers = headers or {}
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=gzip)
+        for url, mime, body in resources:
+            writer.write_record(response_record(writer, url, mime, body, date, headers.get(url, ())))
+            if requests:
+                writer.write_record(request_record(writer, url))
+    return str(path)
+
+def make_crawl(archive_dir, archive_name, fetches=FETCHES, col=COL, ts=TS, page=PAGE, **kwargs) -> str:
+    """
+    Write a recorded crawl of page as autorun.record_replay would: warcs/{col}/{archive_name}_{ts}.warc,
+    and the metadata, fetches, request stacks and done file under writes/{col}/{archive_name}
+    Returns the path of the warc. kwargs are passed to make_warc
+    """
+    dirr = f'{archive_dir}/writes/{col}/{archive_name}'
+    os.makedirs(dirr, exist_ok=True)
+    os.makedirs(f'{archive_dir}/warcs/{col}', exist_ok=True)
+    script_stack = [{'callFrames': [{'functionName': 'f', 'url': 'http://site.com/a.js'}]}]
+    json.dump([{'url': url, 'method': 'GET', 'mime': mime, 'resourceType': rt} for url, mime, _, rt, _ in fetches],
+              open(f'{dirr}/record-{ts}_fetches.json', 'w'))
+    json.dump([{'urls': [url], 'stackInfo': [] if static else script_stack} for url, _, _, _, static in fetches],
+              open(f'{dirr}/record-{ts}_requestStacks.json', 'w'))
+    metadata_path = f'{dirr}/metadata.json'
+    metadata = json.load(open(metadata_path)) if os.path.exists(metadata_path) else {}
+    metadata.setdefault('record', {})[ts] = {'url': page, 'ts': ts}
+    json.dump(metadata, open(metadata_path, 'w'))
+    open(f'{dirr}/record-{ts}_done', 'w').close()
+    resources = [(url, mime, body) for url, mime, body, _, _ in fetches]
+    return make_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{ts}.warc', resources=resources, **kwargs)
@@ -0,0 +1,93 @@
+import os
+import json
+import shutil
+
+from warctradeoff.utils import catalog, pool
+from warctradeoff.crawl.warcprocess import static_warc_extract
+from measurements import utils as measurement_utils
+from tests.synthetic_warcs import make_crawl, make_warc, COL, TS
+
+def test_parse_warc_name():
+    assert catalog.parse_warc_name(f'site.com_1_{TS}.warc') == \
+        {'archive_name': 'site.com_1', 'file_suffix': TS, 'variant': '', 'compressed': False, 'virtual': False}
+    assert catalog.parse_warc_name(f'site.com_1_{TS}.{TS}.cache.warc.gz')['variant'] == f'{TS}.cache'
+    assert catalog.parse_warc_name(f'site.com_1_{TS}.exjs.warc.exclude.json')['virtual']
+    assert catalog.parse_warc_name('site.com_1.payloads.json') is None
+
+def test_refresh(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    cat = catalog.get_catalog()
+    assert cat.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    cat.refresh(COL)
+    assert cat.archive_names(COL) == ['site.com_1']
+    assert cat.archive_names(COL, done=[f'record-{TS}']) == ['site.com_1']
+    assert [w['name'] for w in cat.warcs(COL)] == [f'site.com_1_{TS}.warc']
+
+    # * New archives, new runs of known archives and removed archives are picked up
+    make_crawl(archive_dir, 'site.com_2')
+    make_crawl(archive_dir, 'site.com_1', ts='202502010000')
+    cat.refresh(COL)
+    assert cat.archive_names(COL) == ['site.com_1', 'site.com_2']
+    assert cat.suffixes(COL) == [TS, '202502010000']
+    assert cat.archive_names(COL, runs=['record-202502010000']) == ['site.com_1']
+    shutil.rmtree(f'{archive_dir}/writes/{COL}/site.com_2')
+    os.remove(f'{archive_dir}/warcs/{COL}/site.com_2_{TS}.warc')
+    cat.refresh(COL)
+    assert cat.archive_names(COL) == ['site.com_1']
+    assert sorted(w['name'] for w in cat.warcs(COL)) == [f'site.com_1_{TS}.warc', 'site.com_1_202502010000.warc']
+
+def test_refresh_metadata_rewritten(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    cat = catalog.get_catalog()
+    cat.refresh(COL)
+    path = f'{archive_dir}/writes/{COL}/site.com_1/metadata.json'
+    metadata = json.load(open(path))
+    metadata['replay'] = {TS: {'url': 'http://site.com/', 'ts': TS}}
+    dir_mtime = os.path.getmtime(os.path.dirname(path))
+    json.dump(metadata, open(path, 'w'))
+    os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+    os.utime(os.path.dirname(path), (dir_mtime, dir_mtime))
+    cat.refresh(COL)
+    assert cat.archive_names(COL, runs=[f'replay-{TS}']) == ['site.com_1']
+
+def test_update_warcs(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    cat = catalog.get_catalog()
+    cat.refresh(COL)
+    warc = f'{archive_dir}/warcs/{COL}/site.com_1_{TS}.static.warc'
+    make_warc(f'{warc}.gz', gzip=True)
+    catalog.update_warcs(COL, [warc])
+    rows = cat.warcs(COL, variant='static')
+    assert [(r['name'], r['compressed']) for r in rows] == [(f'site.com_1_{TS}.static.warc.gz', 1)]
+    os.remove(f'{warc}.gz')
+    catalog.update_warcs(COL, [warc])
+    assert cat.warcs(COL, variant='static') == []
+
+
+def write_pid(path):
+    open(path, 'a').write(f'{os.getpid()}\n')
+
+def leave_to_parent(path):
+    pool.in_parent(write_pid, path)
+    return os.getpid()
+
+def test_updates_in_parent(tmp_path):
+    path = str(tmp_path / 'pids')
+    worker_pids = [pid for _, pid in pool.run_tasks(leave_to_parent, [{'path': path}] * 3, num_workers=2)]
+    assert all(pid != os.getpid() for pid in worker_pids)
+    assert open(path).read().split() == [str(os.getpid())] * 3
+
+def test_extract_updates_catalog(archive_dir):
+    for archive_name in ['site.com_1', 'site.com_2']:
+        make_crawl(archive_dir, archive_name)
+    static_warc_extract.extract_static_warcs(COL, TS, num_workers=2)
+    # * Without a refresh, from the updates of the workers
+    rows = catalog.get_catalog().warcs(COL, variant='static')
+    assert sorted(r['archive_name'] for r in rows) == ['site.com_1', 'site.com_2']
+
+
+def test_load_suffixes_from_catalog(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    make_crawl(archive_dir, 'site.com_2', ts='202502010000')
+    # * No measurements/metadata/{PREFIX}_metadata.json for this collection
+    assert measurement_utils.load_suffixes(-1, COL) == [{'suffix': TS}, {'suffix': '202502010000'}]
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+from warctradeoff.utils import collection_lock
+from warctradeoff.utils.collection_lock import CollectionLock
+
+def wait_for_tickets(lock_dir, count):
+    """Block until count tickets were taken from the queue of lock_dir"""
+    counter = f'{lock_dir}/{collection_lock.QUEUE_DIR}/{collection_lock.COUNTER_FILE}'
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if os.path.exists(counter) and open(counter).read().strip() == str(count):
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f'{count} tickets not taken')
+
+def test_fifo_order(tmp_path):
+    lock_dir, order = str(tmp_path), []
+    holder = CollectionLock(lock_dir)
+    holder.acquire()
+    def waiter(i):
+        with CollectionLock(lock_dir):
+            order.append(i)
+    threads = []
+    for i in range(5):
+        threads.append(threading.Thread(target=waiter, args=(i,)))
+        threads[-1].start()
+        wait_for_tickets(lock_dir, i + 2)
+    holder.release()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert order == list(range(5))
+
+def test_wait_stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(collection_lock, 'LOCK_STATS', {'acquired': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+    holder = CollectionLock(str(tmp_path))
+    assert holder.acquire() < 1
+    threading.Timer(0.3, holder.release).start()
+    waited = CollectionLock(str(tmp_path)).acquire()
+    assert waited >= 0.3
+    assert collection_lock.LOCK_STATS['acquired'] == 2
+    assert collection_lock.LOCK_STATS['wait_max'] == waited
+
+
+# * The holder forks a child that inherits its ticket file, so the flock outlives the holder
+HOLDER_SCRIPT = '''
+import os, sys, time
+from warctradeoff.utils.collection_lock import CollectionLock
+
+lock = CollectionLock(sys.argv[1])
+lock.acquire()
+if os.fork() == 0:
+    time.sleep(60)
+    os._exit(0)
+print('locked', flush=True)
+time.sleep(60)
+'''
+
+def test_holder_killed(tmp_path, monkeypatch):
+    monkeypatch.setattr(collection_lock, 'STALE_CHECK_INTERVAL', 0.1)
+    script, lock_dir = tmp_path / 'holder.py', str(tmp_path / 'col')
+    script.write_text(HOLDER_SCRIPT)
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}
+    holder = subprocess.Popen([sys.executable, str(script), lock_dir], env=env, stdout=subprocess.PIPE,
+                              start_new_session=True)
+    try:
+        assert holder.stdout.readline().strip() == b'locked'
+        holder.kill()
+        holder.wait()
+        lock = CollectionLock(lock_dir)
+        assert lock.acquire() < 5
+        lock.release()
+    finally:
+        os.killpg(holder.pid, signal.SIGKILL)
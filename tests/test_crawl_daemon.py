@@ -0,0 +1,70 @@
+import sys
+
+import pytest
+
+from warctradeoff.crawl import crawl_daemon
+from warctradeoff.crawl.crawl_daemon import CrawlDaemon, CrawlDaemonError
+
+# * Stands in for crawl_daemon.js: answers JSON-RPC requests on its stdio
+DAEMON = '''
+import sys, json, time
+print('daemon started', flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    method, params = request['method'], request['params']
+    response = {'jsonrpc': '2.0', 'id': request['id'], 'time': 10}
+    if method == 'hang':
+        time.sleep(60)
+    elif method == 'exit':
+        sys.exit(3)
+    elif method == 'fail':
+        response['error'] = {'message': 'page crashed'}
+    else:
+        response['result'] = {'method': method, **params}
+    # * A late answer to an earlier request comes first
+    print(json.dumps({'jsonrpc': '2.0', 'id': 0, 'result': None}), flush=True)
+    print(json.dumps(response), flush=True)
+    if method == 'shutdown':
+        break
+'''
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    script = tmp_path / 'daemon.py'
+    script.write_text(DAEMON)
+    monkeypatch.setattr(crawl_daemon, 'DAEMON_COMMAND', [sys.executable, str(script)])
+    daemon = CrawlDaemon(name=0)
+    yield daemon
+    daemon._kill()
+
+def test_call(daemon):
+    assert daemon.record(['-w', 'http://site.com/']) == {'method': 'record', 'argv': ['-w', 'http://site.com/']}
+    pid = daemon.process.pid
+    assert daemon.replay(['http://site.com/'])['method'] == 'replay'
+    # * The same process for every page
+    assert daemon.process.pid == pid
+    assert daemon.stats['jobs'] == 2 and daemon.stats['job_time'] == pytest.approx(0.02)
+
+def test_error(daemon):
+    with pytest.raises(CrawlDaemonError, match='page crashed'):
+        daemon.call('fail')
+    assert daemon.stats['errors'] == 1 and daemon.alive()
+
+def test_restart(daemon):
+    with pytest.raises(CrawlDaemonError, match='exited with 3'):
+        daemon.call('exit')
+    assert daemon.call('record')['method'] == 'record'
+    assert daemon.stats['restarts'] == 1
+    # * Stuck: killed, and started again on the next call
+    with pytest.raises(CrawlDaemonError, match='no response'):
+        daemon.call('hang', timeout=0.5)
+    assert not daemon.alive()
+    assert daemon.call('record')['method'] == 'record'
+    assert daemon.stats['restarts'] == 2
+
+def test_stop(daemon):
+    daemon.reset() # * Not started yet
+    assert daemon.process is None
+    daemon.call('record')
+    daemon.stop()
+    assert not daemon.alive() and daemon.process.returncode == 0
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+import pytest
+
+from warctradeoff.utils import pool
+
+def square(x):
+    return x * x
+
+def sleep_or_fail(t):
+    if t < 0:
+        raise ValueError('negative')
+    time.sleep(t)
+    return t
+
+def crash(exit):
+    if exit:
+        os._exit(1)
+    return exit
+
+def budget():
+    return pool.worker_budget(8)
+
+def test_run_tasks():
+    tasks = [{'x': i} for i in range(20)]
+    results = dict((task['x'], result) for task, result in pool.run_tasks(square, tasks, num_workers=3))
+    assert results == {i: i * i for i in range(20)}
+
+def test_run_tasks_generator():
+    results = list(pool.run_tasks(square, ({'x': i} for i in range(5)), num_workers=2))
+    assert sorted(result for _, result in results) == [0, 1, 4, 9, 16]
+
+def test_run_tasks_skips_failures():
+    tasks = [{'t': -1}, {'t': 0}, {'t': -1}, {'t': 0.01}]
+    results = list(pool.run_tasks(sleep_or_fail, tasks, num_workers=2))
+    assert sorted(result for _, result in results) == [0, 0.01]
+
+def test_run_tasks_timeout():
+    # * The slow task's worker is replaced, so the tasks after it still run
+    tasks = [{'t': 30}] + [{'t': 0.01}] * 4
+    start = time.time()
+    results = list(pool.run_tasks(sleep_or_fail, tasks, num_workers=1, timeout=1))
+    assert [result for _, result in results] == [0.01] * 4
+    assert time.time() - start < 15
+
+def test_run_tasks_worker_crash():
+    tasks = [{'exit': True}, {'exit': False}, {'exit': False}]
+    results = list(pool.run_tasks(crash, tasks, num_workers=1))
+    assert [result for _, result in results] == [False, False]
+
+def test_worker_budget(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    assert pool.worker_budget() == 4
+    assert pool.worker_budget(2) == 2
+    assert pool.worker_budget(8) == 4
+    # * Workers split the budget of their parent
+    results = list(pool.run_tasks(budget, [{}] * 2, num_workers=2))
+    assert [result for _, result in results] == [2, 2]
+
+
+PARENT_SCRIPT = '''
+import os, sys, time
+from warctradeoff.utils import pool
+
+def sleep_task(path):
+    open(path, 'w').write(str(os.getpid()))
+    time.sleep(60)
+
+if __name__ == '__main__':
+    for _ in pool.run_tasks(sleep_task, [{'path': sys.argv[1]}]):
+        pass
+'''
+
+def alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+@pytest.mark.parametrize('signum', [signal.SIGINT, signal.SIGTERM])
+def test_workers_killed_with_parent(tmp_path, signum):
+    script, pid_file = tmp_path / 'parent.py', tmp_path / 'worker.pid'
+    script.write_text(PARENT_SCRIPT)
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}
+    parent = subprocess.Popen([sys.executable, str(script), str(pid_file)], env=env, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while not (pid_file.exists() and pid_file.read_text()) and time.time() < deadline:
+            time.sleep(0.1)
+        worker_pid = int(pid_file.read_text())
+        # * The worker is in its own process group, so the signal only reaches the parent
+        parent.send_signal(signum)
+        parent.wait(timeout=30)
+        deadline = time.time() + 10
+        while alive(worker_pid) and time.time() < deadline:
+            time.sleep(0.1)
+        assert not alive(worker_pid)
+    finally:
+        parent.kill()
+
+
+def test_run_slots():
+    done, lock = [], threading.Lock()
+    def work(slot, item):
+        if item < 0:
+            raise ValueError('negative')
+        time.sleep(item)
+        with lock:
+            done.append((slot, item))
+    # * The slow item keeps one slot, while the other takes every item after it
+    stats = pool.run_slots(work, [0.5] + [0.01] * 10 + [-1], num_workers=2)
+    assert (stats['done'], stats['failed']) == (11, 1)
+    slow_slot = next(slot for slot, item in done if item == 0.5)
+    assert [slot for slot, item in done if item != 0.5] == [1 - slow_slot] * 10
+    assert len(stats['utilization']) == 2 and all(0 < u <= 1 for u in stats['utilization'])
+
+def test_run_slots_empty():
+    stats = pool.run_slots(lambda slot, item: None, [], num_workers=0)
+    assert (stats['done'], stats['failed'], stats['utilization']) == (0, 0, [])
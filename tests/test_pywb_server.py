@@ -0,0 +1,83 @@
+import os
+import time
+import signal
+
+import pytest
+
+from warctradeoff.config import CONFIG
+
+pytest.importorskip('fidex')
+from warctradeoff.utils import upload
+
+# * Stands in for pywb's wayback: answers any request once it is up
+WAYBACK = '''#!/usr/bin/env python3
+import sys, time, http.server
+args = sys.argv[1:]
+port = int(args[args.index('-p') + 1])
+time.sleep(0.5)
+http.server.HTTPServer(('localhost', port), http.server.BaseHTTPRequestHandler).serve_forever()
+'''
+
+@pytest.fixture
+def wayback(archive_dir, tmp_path, monkeypatch):
+    """upload's servers run a fake wayback in archive_dir"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'wayback').write_text(WAYBACK)
+    (bin_dir / 'wayback').chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    monkeypatch.setattr(upload, 'PYWBENV', 'true')
+    monkeypatch.setattr(upload, 'ARCHIVEDIR', archive_dir)
+    monkeypatch.setattr(upload, 'PORT_LOCK_DIR', f'{archive_dir}/.ports')
+    monkeypatch.setattr(upload, 'READY_INTERVAL', 0.05)
+    return archive_dir
+
+def test_reserve_port(wayback, monkeypatch):
+    monkeypatch.setitem(CONFIG.config, 'replay_ports', [20000, 20001])
+    monkeypatch.setattr(upload, '_ephemeral_ports', lambda: (20001, 60999))
+    # * 20001 is in the ephemeral range, and 20000 is reserved while its lock file is open
+    port, lock_file = upload.reserve_port()
+    assert port == 20000
+    with pytest.raises(OSError):
+        upload.reserve_port()
+    lock_file.close()
+    port, lock_file = upload.reserve_port()
+    assert port == 20000
+    lock_file.close()
+
+def test_pool(wayback):
+    pool = upload.PYWBServerPool(['c1', 'c2'], proxy=True, max_uses=2)
+    pool.start()
+    try:
+        ports = [server.port for server in pool.servers]
+        assert len(set(ports)) == 2
+        assert all(server.probe() is not None for server in pool.servers)
+        assert os.path.realpath(f'{wayback}/collections/{pool[0].view}/archive') == f'{wayback}/collections/c1/archive'
+
+        # * Recycled on the same port once it reached max_uses
+        server = pool.server(0)
+        pid = server.server.pid
+        pool.server(0)
+        pool.server(0)
+        assert server.server.pid != pid and server.port == ports[0] and server.restarts == 1
+
+        # * Restarted when it died
+        os.killpg(pool[1].server.pid, signal.SIGKILL)
+        pool[1].server.wait()
+        pool.server(1)
+        assert pool[1].alive() and pool[1].port == ports[1]
+    finally:
+        pool.stop()
+    # * Ports are released once the servers stop
+    assert all(server.port_lock is None and not server.alive() for server in pool.servers)
+
+def test_server_not_ready(wayback, monkeypatch):
+    # * A wayback that exits right away
+    open(f'{os.path.dirname(wayback)}/bin/wayback', 'w').write('#!/bin/sh\nexit 1\n')
+    monkeypatch.setattr(upload, 'READY_TIMEOUT', 2)
+    server = upload.PYWBServer(archive='c1')
+    start = time.time()
+    with pytest.raises(upload.ServerNotReadyError):
+        server.start()
+    assert time.time() - start < 30
+    assert server.port_lock is None
@@ -0,0 +1,79 @@
+import os
+import http.client
+
+import pytest
+
+from warctradeoff.utils import replay_server, tenant_index, warc_index
+from tests.synthetic_warcs import make_warc
+
+JAN1, JAN5 = 'Wed, 01 Jan 2025 00:00:00 GMT', 'Sun, 05 Jan 2025 00:00:00 GMT'
+
+@pytest.fixture
+def collection(archive_dir, monkeypatch):
+    """Collection c with captures of http://site.com/ on Jan 1 and Jan 5, and tenant t1 with only the first"""
+    monkeypatch.setattr(replay_server, 'ARCHIVEDIR', archive_dir)
+    col_dir = f'{archive_dir}/collections/c'
+    for sub_dir in ['archive', 'indexes']:
+        os.makedirs(f'{col_dir}/{sub_dir}')
+    warcs = [make_warc(f'{col_dir}/archive/jan1.warc', resources=[('http://site.com/', 'text/html', b'jan1')]),
+             make_warc(f'{col_dir}/archive/jan5.warc', resources=[('http://site.com/', 'text/html', b'jan5')],
+                       date='2025-01-05T00:00:00Z')]
+    warc_index.merge_pywb_index(f'{col_dir}/indexes/{warc_index.COLLECTION_INDEX}',
+                                [(w, os.path.basename(w)) for w in warcs])
+    tenant_index.add_tenants(col_dir, {'t1': warcs[:1]})
+    return col_dir
+
+@pytest.fixture
+def pool(collection):
+    pool = replay_server.ReplayServerPool(['c'])
+    pool.start()
+    yield pool
+    pool.stop()
+
+def get(server, url, **headers) -> (int, bytes):
+    conn = http.client.HTTPConnection('localhost', server.port, timeout=10)
+    conn.request('GET', url, headers=headers)
+    response = conn.getresponse()
+    result = response.status, response.read()
+    conn.close()
+    return result
+
+def test_closest_capture(pool):
+    server = pool.server(0)
+    assert get(server, 'http://site.com/', **{'Accept-Datetime': JAN1}) == (200, b'jan1')
+    assert get(server, 'http://site.com/', **{'Accept-Datetime': JAN5}) == (200, b'jan5')
+    # * Latest capture without Accept-Datetime
+    assert get(server, 'http://site.com/') == (200, b'jan5')
+    assert get(server, 'http://site.com/missing')[0] == 404
+    stats = server.stats()
+    assert (stats['requests'], stats['found'], stats['not_found']) == (4, 3, 1)
+
+def test_closest_ties():
+    lines = [f'com,a)/ {ts} {{"url": "http://a.com/", "offset": "0", "length": "1", "filename": "{ts[:8]}"}}'
+             for ts in ['20250101000000', '20250103000000', '20250105000000']]
+    index = replay_server.CollectionIndex('/archive', lines)
+    assert index.closest('http://a.com/', '20241201000000')[1] == '/archive/20250101'
+    assert index.closest('http://a.com/', '20250104000000')[1] == '/archive/20250103'
+    assert index.closest('http://a.com/', '20250104120000')[1] == '/archive/20250105'
+    assert index.closest('http://b.com/', '20250104000000') is None
+
+def test_tenants(pool, collection):
+    server = pool.server(0)
+    # * By header or query parameter, without changing the server's selection
+    assert get(server, 'http://site.com/', **{replay_server.TENANT_HEADER: 't1'}) == (200, b'jan1')
+    assert get(server, f'http://site.com/?{replay_server.TENANT_PARAM}=t1') == (200, b'jan1')
+    assert get(server, 'http://site.com/', **{replay_server.TENANT_HEADER: 't2'})[0] == 404
+    assert get(server, 'http://site.com/') == (200, b'jan5')
+
+    server.select_tenant('c', 't1')
+    assert get(server, 'http://site.com/') == (200, b'jan1')
+    # * Picked up on the next use once the shared index changes
+    tenant_index.add_tenants(collection, {'t1': [f'{collection}/archive/jan5.warc']})
+    pool.server(0)
+    assert get(server, 'http://site.com/') == (200, b'jan5')
+
+def test_url_mode_rejected():
+    hub = replay_server.ReplayHub()
+    with pytest.raises(ValueError):
+        replay_server.ReplayServer(hub, proxy=False)
+    hub.stop()
@@ -0,0 +1,55 @@
+import os
+import json
+
+import pytest
+
+from warctradeoff.crawl.warcprocess.static_warc_extract import StaticWarcExtractor
+from tests.synthetic_warcs import make_crawl, FETCHES, PAGE, COL, TS
+
+def test_fetch_classification(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    extractor = StaticWarcExtractor(archive_dir, COL, 'site.com_1', TS)
+    classification = extractor.fetch_classification(PAGE)
+    assert {url: c['is_static'] for url, c in classification.items()} == {url: static for url, *_, static in FETCHES}
+    assert classification['http://site.com/api']['initiator'] == 'script'
+    assert os.path.exists(extractor.classification_path)
+
+@pytest.fixture
+def classified(archive_dir, monkeypatch):
+    """Extractor whose classification sidecar is written, and a list that records each classify_fetches"""
+    make_crawl(archive_dir, 'site.com_1')
+    extractor = StaticWarcExtractor(archive_dir, COL, 'site.com_1', TS)
+    extractor.fetch_classification(PAGE)
+    classify_fetches, calls = extractor.classify_fetches, []
+    def counted(html_url):
+        calls.append(html_url)
+        return classify_fetches(html_url)
+    monkeypatch.setattr(extractor, 'classify_fetches', counted)
+    return extractor, calls
+
+def test_sidecar_reused(classified):
+    extractor, calls = classified
+    assert extractor.static_fetches(PAGE)['http://site.com/a.js'] is False
+    assert calls == []
+
+def test_sidecar_invalidated_by_inputs(classified):
+    extractor, calls = classified
+    # * Another page, or changed fetches / request stacks
+    extractor.fetch_classification('http://site.com/other')
+    extractor.fetch_classification(PAGE)
+    assert len(calls) == 2
+    stacks = json.load(open(extractor.request_stacks_path))
+    for stack in stacks:
+        stack['stackInfo'] = []
+    json.dump(stacks, open(extractor.request_stacks_path, 'w'))
+    os.utime(extractor.request_stacks_path, (os.path.getmtime(extractor.request_stacks_path) + 10,) * 2)
+    assert all(extractor.static_fetches(PAGE).values())
+    assert len(calls) == 3
+    extractor.fetch_classification(PAGE)
+    assert len(calls) == 3
+
+def test_sidecar_corrupt(classified):
+    extractor, calls = classified
+    open(extractor.classification_path, 'w').write('{')
+    assert extractor.static_fetches(PAGE)['http://site.com/img.png'] is True
+    assert len(calls) == 1
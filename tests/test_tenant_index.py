@@ -0,0 +1,64 @@
+import os
+import json
+
+from warctradeoff.utils import tenant_index, warc_index
+from tests.synthetic_warcs import make_warc, RESOURCES
+
+def line_urls(lines) -> set:
+    return set(json.loads(line.split(' ', 2)[2])['url'] for line in lines)
+
+def add(tmp_path, col_dir):
+    a = make_warc(tmp_path / 'a.warc', resources=RESOURCES[:2])
+    b = make_warc(tmp_path / 'b.warc', resources=RESOURCES[2:])
+    return tenant_index.add_tenants(col_dir, {'site.com_1': [a], 'site.com_2': [b]})
+
+def test_add_tenants(tmp_path):
+    col_dir = str(tmp_path / 'collections' / 'col')
+    assert add(tmp_path, col_dir) == len(RESOURCES)
+    assert tenant_index.tenants(col_dir) == {'site.com_1', 'site.com_2'}
+    assert sorted(os.listdir(f'{col_dir}/archive')) == ['a.warc', 'b.warc']
+    lines = open(tenant_index.tenant_index_path(col_dir)).read().splitlines()
+    assert lines == sorted(lines)
+    assert line_urls(tenant_index.tenant_lines(col_dir, 'site.com_1')) == {url for url, _, _ in RESOURCES[:2]}
+    assert line_urls(tenant_index.tenant_lines(col_dir, 'site.com_2')) == {url for url, _, _ in RESOURCES[2:]}
+    assert tenant_index.tenant_lines(col_dir, 'site.com') == []
+
+    # * Lines of a tenant added again are replaced
+    c = make_warc(tmp_path / 'c.warc', resources=[('http://new.com/', 'text/html', b'new')])
+    tenant_index.add_tenants(col_dir, {'site.com_1': [c]})
+    assert line_urls(tenant_index.tenant_lines(col_dir, 'site.com_1')) == {'http://new.com/'}
+    assert line_urls(tenant_index.tenant_lines(col_dir, 'site.com_2')) == {url for url, _, _ in RESOURCES[2:]}
+
+def test_write_view(tmp_path):
+    col_dir = str(tmp_path / 'collections' / 'col')
+    add(tmp_path, col_dir)
+    view_dir = str(tmp_path / 'collections' / 'view')
+    assert tenant_index.write_view(col_dir, view_dir, 'site.com_2') == len(RESOURCES[2:])
+    assert os.path.realpath(f'{view_dir}/archive') == os.path.realpath(f'{col_dir}/archive')
+    view_lines = open(f'{view_dir}/indexes/{warc_index.COLLECTION_INDEX}').read().splitlines()
+    assert view_lines == tenant_index.tenant_lines(col_dir, 'site.com_2')
+    # * Switched to another tenant
+    tenant_index.write_view(col_dir, view_dir, 'site.com_1')
+    view_lines = open(f'{view_dir}/indexes/{warc_index.COLLECTION_INDEX}').read().splitlines()
+    assert line_urls(view_lines) == {url for url, _, _ in RESOURCES[:2]}
+
+def test_tenant_view(tmp_path):
+    col_dir = str(tmp_path / 'collections' / 'col')
+    add(tmp_path, col_dir)
+    view = tenant_index.tenant_view(col_dir, 'site.com_1')
+    assert view == tenant_index.view_name('col', 'site.com_1')
+    assert view.startswith('col--site-com_1-')
+    assert view != tenant_index.view_name('col', 'site-com_1')
+    view_lines = open(tmp_path / 'collections' / view / 'indexes' / warc_index.COLLECTION_INDEX).read().splitlines()
+    assert line_urls(view_lines) == {url for url, _, _ in RESOURCES[:2]}
+
+def test_remove_tenants(tmp_path):
+    col_dir = str(tmp_path / 'collections' / 'col')
+    add(tmp_path, col_dir)
+    view = tenant_index.tenant_view(col_dir, 'site.com_1')
+    assert tenant_index.remove_tenants(col_dir, ['site.com_1']) == {'site.com_1'}
+    assert tenant_index.tenants(col_dir) == {'site.com_2'}
+    assert not os.path.exists(tmp_path / 'collections' / view)
+    assert tenant_index.remove_tenants(col_dir) == {'site.com_2'}
+    assert tenant_index.tenants(col_dir) == set()
+    assert os.listdir(f'{col_dir}/archive') == []
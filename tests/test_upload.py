@@ -0,0 +1,110 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+pytest.importorskip('fidex')
+from warctradeoff.utils import upload, collection_lock
+
+class FakeChannel:
+    """paramiko channel that keeps what is written to it, and exits with exit_status"""
+    def __init__(self, exit_status=0):
+        self.exit_status = exit_status
+        self.command = None
+        self.sent = b''
+        self.closed = False
+
+    def exec_command(self, command):
+        self.command = command
+
+    def makefile(self, mode, bufsize=-1):
+        channel = self
+        class Stream(io.BytesIO):
+            def close(self):
+                channel.sent += self.getvalue()
+                super().close()
+        return Stream()
+
+    def makefile_stderr(self, mode):
+        return io.StringIO('failed')
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+class FakeSSHClient:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return self.channel
+
+def manager(channel) -> upload.SSHClientManager:
+    """SSHClientManager that talks to channel instead of a server"""
+    manager = object.__new__(upload.SSHClientManager)
+    manager.ssh_client = FakeSSHClient(channel)
+    manager.scp_client = None
+    manager.wb_manager = upload.WBManager()
+    manager.locks = {}
+    manager.lock_helper_copied = False
+    return manager
+
+def batch(tmp_path) -> dict:
+    for name in ['a.warc', 'b.warc', 'shot.png']:
+        (tmp_path / name).write_bytes(name.encode())
+    (tmp_path / 'site.com_1').mkdir()
+    (tmp_path / 'site.com_1' / 'metadata.json').write_text('{}')
+    return {
+        'writes': [(str(tmp_path / 'site.com_1'), 'col')],
+        'warcs': [(str(tmp_path / 'a.warc'), 'c1', 'col'), (str(tmp_path / 'b.warc'), None, 'col')],
+        'screenshots': [(str(tmp_path / 'shot.png'), 'col')],
+    }
+
+def test_upload_batch(tmp_path):
+    channel = FakeChannel()
+    manager(channel).upload_batch(**batch(tmp_path))
+    with tarfile.open(fileobj=io.BytesIO(channel.sent), mode='r|') as tar:
+        files = {m.name: tar.extractfile(m).read() for m in tar if m.isfile()}
+    helper = os.path.relpath(upload.LOCK_HELPER, upload.ARCHIVEDIR)
+    assert files == {
+        'writes/col/site.com_1/metadata.json': b'{}',
+        'screenshots/col/shot.png': b'shot.png',
+        'warcs/col/a.warc': b'a.warc',
+        'warcs/col/b.warc': b'b.warc',
+        helper: open(collection_lock.__file__, 'rb').read(),
+    }
+    # * Only the warc with a collection is added, under the collection's lock
+    assert channel.command.endswith(f'python {upload.LOCK_HELPER} {upload.ARCHIVEDIR}/collections/c1 '
+                                    f'wb-manager add c1 {upload.ARCHIVEDIR}/warcs/col/a.warc')
+    assert channel.closed
+    assert os.listdir(tmp_path) == []
+
+def test_upload_batch_failed(tmp_path):
+    channel = FakeChannel(exit_status=1)
+    client = manager(channel)
+    with pytest.raises(Exception, match='failed'):
+        client.upload_batch(**batch(tmp_path), lock=False)
+    # * Nothing is removed, so that the batch can be retried
+    assert sorted(os.listdir(tmp_path)) == ['a.warc', 'b.warc', 'shot.png', 'site.com_1']
+    assert channel.command.endswith(f'wb-manager add c1 {upload.ARCHIVEDIR}/warcs/col/a.warc')
+    assert upload.LOCK_HELPER not in channel.command and not client.lock_helper_copied
+
+def test_local_remove(archive_dir, monkeypatch):
+    monkeypatch.setattr(upload, 'ARCHIVEDIR', archive_dir)
+    for path in ['writes/col/site.com_1', 'collections/c 1/archive']:
+        os.makedirs(f'{archive_dir}/{path}')
+    client = upload.LocalUploadManager()
+    client.remove_write('col/site.com_1')
+    client.remove_archive('c 1')
+    # * Already removed
+    client.remove_archive('c 1')
+    assert os.listdir(f'{archive_dir}/writes/col') == [] and os.listdir(f'{archive_dir}/collections') == []
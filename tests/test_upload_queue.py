@@ -0,0 +1,88 @@
+import json
+import threading
+
+import pytest
+
+from warctradeoff.utils import upload_queue
+from warctradeoff.utils.upload_queue import UploadQueue
+
+class FakeClient:
+    """Upload manager that records the batches, failing the first `failures` of them"""
+    def __init__(self, uploaded, failures=0, block=None):
+        self.uploaded = uploaded
+        self.failures = failures
+        self.block = block
+
+    def upload_batch(self, writes=(), warcs=(), screenshots=(), lock=True):
+        if self.block is not None:
+            self.block.wait()
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError('connection lost')
+        self.uploaded.append(writes)
+
+    def close(self):
+        pass
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(upload_queue, 'RETRY_DELAY', 0)
+
+def journal_jobs(journal) -> list:
+    return UploadQueue(None, journal=journal).recovered
+
+def test_upload(tmp_path):
+    uploaded, journal = [], str(tmp_path / 'uploads.jsonl')
+    uploader = UploadQueue(lambda: FakeClient(uploaded), journal=journal).start()
+    for i in range(5):
+        uploader.put(writes=[[f'w{i}', 'col']])
+    stats = uploader.close(timeout=10)
+    assert (stats['queued'], stats['done'], stats['failed']) == (5, 5, 0)
+    assert sorted(uploaded) == [[[f'w{i}', 'col']] for i in range(5)]
+    assert journal_jobs(journal) == []
+
+def test_journal_recovery(tmp_path):
+    journal = tmp_path / 'uploads.jsonl'
+    jobs = [{'id': i, 'writes': [[f'w{i}', 'col']], 'warcs': [], 'screenshots': [], 'lock': True, 'catalog': None}
+            for i in range(3)]
+    # * Job 1 is done, and the process died while it wrote the last line
+    journal.write_text(''.join(json.dumps(job) + '\n' for job in jobs) + json.dumps({'done': 1}) + '\n{"do')
+    uploaded = []
+    uploader = UploadQueue(lambda: FakeClient(uploaded), journal=str(journal))
+    assert [job['writes'] for job in uploader.recovered] == [[['w0', 'col']], [['w2', 'col']]]
+    uploader.start().close(timeout=10)
+    assert sorted(uploaded) == [[['w0', 'col']], [['w2', 'col']]]
+    assert journal_jobs(str(journal)) == []
+
+def test_retry(tmp_path):
+    uploaded, journal = [], str(tmp_path / 'uploads.jsonl')
+    uploader = UploadQueue(lambda: FakeClient(uploaded, failures=upload_queue.MAX_RETRIES), num_workers=1,
+                           journal=journal).start()
+    uploader.put(writes=[['w0', 'col']])
+    assert uploader.flush(timeout=10) == 0
+    assert uploader.stats['retries'] == upload_queue.MAX_RETRIES and uploaded == [[['w0', 'col']]]
+    uploader.close()
+
+    # * Given up after MAX_RETRIES, and left in the journal for the next run
+    uploader = UploadQueue(lambda: FakeClient(uploaded, failures=upload_queue.MAX_RETRIES + 1), num_workers=1,
+                           journal=journal).start()
+    uploader.put(writes=[['w1', 'col']])
+    assert uploader.close(timeout=10)['failed'] == 1
+    assert [job['writes'] for job in journal_jobs(journal)] == [[['w1', 'col']]]
+
+def test_flush_timeout():
+    block, uploaded = threading.Event(), []
+    uploader = UploadQueue(lambda: FakeClient(uploaded, block=block), num_workers=1).start()
+    uploader.put(writes=[['w0', 'col']])
+    with pytest.raises(TimeoutError):
+        uploader.flush(timeout=0.2)
+    block.set()
+    assert uploader.flush(timeout=10) == 0
+    uploader.close()
+    assert uploaded == [[['w0', 'col']]]
+
+def test_flush_without_uploaders():
+    uploader = UploadQueue(lambda: FakeClient([]))
+    uploader.put(writes=[['w0', 'col']])
+    with pytest.raises(RuntimeError):
+        uploader.flush(timeout=10)
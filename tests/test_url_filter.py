@@ -0,0 +1,48 @@
+import os
+
+from warctradeoff.utils import url_filter
+from tests.synthetic_warcs import make_warc, RESOURCES
+
+def test_bloom_filter():
+    urls = [f'http://site.com/{i}' for i in range(1000)]
+    bloom = url_filter.BloomFilter.for_capacity(len(urls))
+    for url in urls:
+        bloom.add(url)
+    assert all(url in bloom for url in urls)
+    false_positives = sum(f'http://other.com/{i}' in bloom for i in range(10000))
+    assert false_positives < 10000 * url_filter.FP_RATE * 3
+    # * URLs are normalized before hashing
+    assert 'https://site.com/1/' in bloom
+
+def test_bloom_filter_dump_load(tmp_path):
+    bloom = url_filter.BloomFilter.for_capacity(10)
+    bloom.add('http://site.com/')
+    path = str(tmp_path / 'f.bloom')
+    bloom.dump(path, {'a.warc': [1, 2.0]})
+    loaded, sources = url_filter.BloomFilter.load(path)
+    assert sources == {'a.warc': [1, 2.0]}
+    assert (loaded.num_bits, loaded.num_hashes, loaded.count, loaded.bits) == \
+           (bloom.num_bits, bloom.num_hashes, bloom.count, bloom.bits)
+
+def test_warc_filter(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    assert all(url_filter.may_contain(warc, url) for url, _, _ in RESOURCES)
+    assert os.path.exists(url_filter.bloom_path(warc))
+    assert not url_filter.may_contain(str(tmp_path / 'missing.warc'), RESOURCES[0][0])
+
+    # * Rebuilt once the WARC changes
+    make_warc(warc, resources=[('http://new.com/', 'text/html', b'new')])
+    assert url_filter.may_contain(warc, 'http://new.com/')
+    assert url_filter.warc_filter(warc).count == 1
+
+def test_candidate_warcs(tmp_path):
+    a = make_warc(tmp_path / 'a.warc', resources=RESOURCES[:2])
+    b = make_warc(tmp_path / 'b.warc', resources=RESOURCES[2:])
+    assert url_filter.candidate_warcs([a, b], RESOURCES[0][0]) == [a]
+    assert url_filter.candidate_warcs([a, b], RESOURCES[3][0]) == [b]
+
+    path = url_filter.group_path(str(tmp_path), 'site.com', '202501010000')
+    group = url_filter.group_filter([a, b], path)
+    assert all(url in group for url, _, _ in RESOURCES)
+    assert url_filter.group_filter([a, b], path, build=False) is not None
+    assert url_filter.load_filter([a], path, build=False) is None
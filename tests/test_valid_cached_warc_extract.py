@@ -0,0 +1,58 @@
+from warctradeoff.utils import warc_index
+from warctradeoff.crawl.warcprocess import valid_cached_warc_extract, variant_warc_extract
+from warctradeoff.crawl.warcprocess.valid_cached_warc_extract import FreshnessTable, ValidCachedWarcExtractor
+from tests.synthetic_warcs import make_crawl, COL, TS
+
+# * Crawled at 2025-01-01 00:00
+HEADERS = {
+    'http://site.com/a.js': [('Cache-Control', 'max-age=86400')],
+    'http://cdn.com/s.css': [('Cache-Control', 'max-age=31536000')],
+    'http://site.com/img.png': [('Cache-Control', 'no-store')],
+}
+STATIC_TSS = ['202501010100', '202506010000', '202701010000']
+VALID_URLS = {
+    '202501010100': {'http://site.com/a.js', 'http://cdn.com/s.css'},
+    '202506010000': {'http://cdn.com/s.css'},
+    '202701010000': set(),
+}
+
+def response_urls(warc) -> set:
+    return set(warc_index.load_index(warc).urls('response'))
+
+def cache_warc(archive_dir, archive_name, static_ts) -> str:
+    return f'{archive_dir}/warcs/{COL}/{archive_name}_{TS}.{static_ts}.cache.warc'
+
+def test_extract_valid_cached_warcs_multi(archive_dir):
+    for archive_name in ['site.com_1', 'site.com_2']:
+        make_crawl(archive_dir, archive_name, headers=HEADERS)
+    success = valid_cached_warc_extract.extract_valid_cached_warcs_multi(COL, TS, STATIC_TSS)
+    assert {ts: sorted(names) for ts, names in success.items()} == {ts: ['site.com_1', 'site.com_2'] for ts in STATIC_TSS}
+    warc = f'{archive_dir}/warcs/{COL}/site.com_1_{TS}.warc'
+    table = FreshnessTable.load(warc)
+    for static_ts in STATIC_TSS:
+        assert response_urls(cache_warc(archive_dir, 'site.com_1', static_ts)) == VALID_URLS[static_ts]
+        assert table.valid_urls(static_ts) == VALID_URLS[static_ts]
+
+    # * Same outputs as one ValidCachedWarcExtractor per timestamp
+    for static_ts in STATIC_TSS:
+        ValidCachedWarcExtractor(archive_dir, COL, 'site.com_1', TS, static_ts).extract()
+        assert response_urls(cache_warc(archive_dir, 'site.com_1', static_ts)) == VALID_URLS[static_ts]
+
+def test_multi_cached_reuses_outputs(archive_dir):
+    make_crawl(archive_dir, 'site.com_1', headers=HEADERS)
+    def extractor(static_tss, table_only=False):
+        return valid_cached_warc_extract.MultiCachedWarcExtractor(archive_dir, COL, 'site.com_1', TS, static_tss, table_only)
+    assert extractor(STATIC_TSS[:2]).extract_incremental()[1] == 0
+    # * Only the new timestamp is written
+    results, reused = extractor(STATIC_TSS).extract_incremental()
+    assert reused == 2 and set(results) == set(STATIC_TSS)
+    assert extractor(STATIC_TSS).extract_incremental(force=True)[1] == 0
+    assert extractor([], table_only=True).extract_incremental() == ({}, 1)
+
+def test_cache_variants(archive_dir):
+    make_crawl(archive_dir, 'site.com_1', headers=HEADERS)
+    variants = [variant_warc_extract.CacheVariant(static_ts) for static_ts in STATIC_TSS]
+    success = variant_warc_extract.extract_variants(COL, TS, variants)
+    for static_ts in STATIC_TSS:
+        assert success[f'{static_ts}.cache'] == ['site.com_1']
+        assert response_urls(cache_warc(archive_dir, 'site.com_1', static_ts)) == VALID_URLS[static_ts]
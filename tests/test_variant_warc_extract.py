@@ -0,0 +1,72 @@
+import json
+
+from warctradeoff.utils import warc_index
+from warctradeoff.crawl.warcprocess import variant_warc_extract, static_warc_extract, resource_warc_extract
+from warctradeoff.crawl.warcprocess.resource_warc_extract import ResourceMatchType
+from tests.synthetic_warcs import make_crawl, FETCHES, COL, TS
+
+SCRIPT = ('http://site.com/b.js', 'application/javascript', b'var b=1;', 'Script', False)
+
+def response_urls(warc) -> set:
+    index = warc_index.load_index(warc)
+    return set(index.urls('response'))
+
+def test_extract_variants(archive_dir):
+    for archive_name in ['site.com_1', 'site.com_2']:
+        make_crawl(archive_dir, archive_name)
+    success = variant_warc_extract.extract_variants(COL, TS, ['static', 'exjs', 'exxhr'])
+
+    all_urls = set(url for url, *_ in FETCHES)
+    assert sorted(success['static']) == [('site.com_1', ['http://site.com/']), ('site.com_2', ['http://site.com/'])]
+    assert sorted(success['exjs']) == [('site.com_1', ['http://site.com/a.js']), ('site.com_2', ['http://site.com/a.js'])]
+    warc = f'{archive_dir}/warcs/{COL}/site.com_1_{TS}'
+    variants = {suffix: response_urls(f'{warc}.{suffix}.warc') for suffix in ['static', 'exjs', 'exxhr']}
+    assert variants == {
+        'static': all_urls - {'http://site.com/a.js', 'http://site.com/api'},
+        'exjs': all_urls - {'http://site.com/a.js'},
+        'exxhr': all_urls - {'http://site.com/api'},
+    }
+
+    # * Same outputs as the single-variant extractors
+    static_warc_extract.extract_static_warcs(COL, TS, force=True)
+    resource_warc_extract.extract_resource_warcs(COL, TS, ResourceMatchType.EXCLUDE_JS, force=True)
+    assert response_urls(f'{warc}.static.warc') == variants['static']
+    assert response_urls(f'{warc}.exjs.warc') == variants['exjs']
+
+def test_extract_variants_reuses_outputs(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    variant_warc_extract.extract_variants(COL, TS, ['static', 'exjs'])
+    extractor = variant_warc_extract.MultiVariantExtractor(archive_dir, COL, 'site.com_1', TS,
+                                                           [variant_warc_extract.StaticVariant()], 'record')
+    results, reused = extractor.extract_incremental()
+    assert reused == 1
+    assert results == {'static': ['site.com_1', ['http://site.com/']]}
+
+def test_resource_variant_from_file(archive_dir, tmp_path):
+    for archive_name in ['a.com_1', 'b.com_1']:
+        make_crawl(archive_dir, archive_name, fetches=FETCHES + [SCRIPT])
+    failed_fetch_file = tmp_path / 'failed_fetches.json'
+    json.dump([{'hostname': 'a.com_1', 'missing_script': {'failFetchScripts': [{'url': 'http://site.com/a.js'}]}}],
+              open(failed_fetch_file, 'w'))
+    variant = variant_warc_extract.ResourceVariant.from_file(ResourceMatchType.EXCLUDE_JS, str(failed_fetch_file))
+    assert variant.archives == {'a.com_1'}
+
+    success = variant_warc_extract.extract_variants(COL, TS, [variant, 'static'])
+    # * Only archives with failed fetches, and the failed fetches themselves are kept
+    assert success['exjs'] == [('a.com_1', ['http://site.com/b.js'])]
+    assert len(success['static']) == 2
+    assert 'http://site.com/a.js' in response_urls(f'{archive_dir}/warcs/{COL}/a.com_1_{TS}.exjs.warc')
+    assert not warc_index.warc_exists(f'{archive_dir}/warcs/{COL}/b.com_1_{TS}.exjs.warc')
+
+def test_inferrable_variant_from_file(archive_dir, tmp_path):
+    for archive_name in ['a.com_1', 'b.com_1']:
+        make_crawl(archive_dir, archive_name, fetches=FETCHES + [SCRIPT])
+    inferrable_file = tmp_path / 'inferrable.json'
+    json.dump([{'hostname': 'a.com_1', 'url': 'http://site.com/a.js', 'inferrable': False},
+               {'hostname': 'a.com_1', 'url': 'http://site.com/b.js', 'inferrable': True}],
+              open(inferrable_file, 'w'))
+    variant = variant_warc_extract.InferrableVariant.from_file(ResourceMatchType.EXCLUDE_JS, str(inferrable_file))
+
+    success = variant_warc_extract.extract_variants(COL, TS, [variant])
+    # * Only non-inferrable urls are excluded
+    assert success[variant.suffix()] == [('a.com_1', ['http://site.com/a.js'])]
@@ -0,0 +1,61 @@
+import os
+import json
+
+from warctradeoff.crawl.warcprocess import warc_extract
+from warctradeoff.crawl.warcprocess.static_warc_extract import StaticWarcExtractor
+from warctradeoff.crawl.warcprocess.resource_warc_extract import ResourceTypeWARCExtractor, ResourceMatchType
+from tests.synthetic_warcs import make_crawl, COL, TS
+
+def touch(path):
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+
+def test_load_fresh_deps(tmp_path):
+    inputs = [str(tmp_path / 'in1'), str(tmp_path / 'in2')]
+    for path in inputs:
+        open(path, 'w').write('in')
+    output = str(tmp_path / 'out.warc')
+    assert warc_extract.load_fresh_deps(output, inputs, {}) == (False, None)
+    open(output, 'w').write('out')
+    warc_extract.write_deps(output, inputs, {'a': 1}, ['result'])
+
+    assert warc_extract.load_fresh_deps(output, inputs, {'a': 1}) == (True, ['result'])
+    assert warc_extract.load_fresh_deps(output, inputs, {'a': 2})[0] is False
+    assert warc_extract.load_fresh_deps(output, inputs[:1], {'a': 1})[0] is False
+    touch(inputs[1])
+    assert warc_extract.load_fresh_deps(output, inputs, {'a': 1})[0] is False
+    warc_extract.write_deps(output, inputs, {'a': 1}, ['result'])
+    open(output, 'a').write('changed')
+    assert warc_extract.load_fresh_deps(output, inputs, {'a': 1})[0] is False
+
+def test_extract_incremental(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    extractor = StaticWarcExtractor(archive_dir, COL, 'site.com_1', TS)
+    result, reused = extractor.extract_incremental()
+    assert result == ('site.com_1', ['http://site.com/']) and not reused
+    assert os.path.exists(warc_extract.deps_path(extractor.output_warc))
+
+    result, reused = extractor.extract_incremental()
+    assert reused
+    # * The recorded result is returned as json
+    assert json.loads(json.dumps(result)) == ['site.com_1', ['http://site.com/']]
+    assert not extractor.extract_incremental(force=True)[1]
+
+    # * Any input, the output and the parameters invalidate the output
+    touch(extractor.fetches_path)
+    assert not extractor.extract_incremental()[1]
+    assert extractor.extract_incremental()[1]
+    touch(extractor.input_warc)
+    assert not extractor.extract_incremental()[1]
+    os.remove(extractor.output_warc)
+    assert not extractor.extract_incremental()[1]
+    assert os.path.exists(extractor.output_warc)
+
+def test_extract_incremental_params(archive_dir):
+    make_crawl(archive_dir, 'site.com_1')
+    def extractor(num_throw_resources):
+        return ResourceTypeWARCExtractor(archive_dir, COL, 'site.com_1', TS, ResourceMatchType.EXCLUDE_JS,
+                                         num_throw_resources=num_throw_resources)
+    assert not extractor(1).extract_incremental()[1]
+    assert extractor(1).extract_incremental()[1]
+    assert not extractor(2).extract_incremental()[1]
@@ -0,0 +1,205 @@
+import os
+import json
+
+import pytest
+
+from warctradeoff.utils import warc_index, warc_utils
+from warctradeoff.crawl.warcprocess import dedup
+from tests.synthetic_warcs import make_warc, PAGE, RESOURCES
+
+def payload(record):
+    return record.content_stream().read()
+
+def test_sidecar_written_and_fresh(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    index = warc_index.load_index(warc)
+    assert os.path.exists(warc_index.index_path(warc))
+    assert warc_index.index_fresh(warc)
+    assert sorted(index.urls()) == sorted(url for url, _, _ in RESOURCES)
+    assert len(index.entries) == 2 * len(RESOURCES)
+    # * Entries span the whole file back to back
+    entries = sorted(index.entries, key=lambda e: e.offset)
+    assert entries[0].offset == 0
+    assert sum(e.length for e in entries) == os.path.getsize(warc)
+
+    with open(warc, 'ab') as f:
+        f.write(b'\r\n')
+    assert not warc_index.index_fresh(warc)
+
+def test_seek_record(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    for url, mime, body in RESOURCES:
+        record = warc_index.seek_record(warc, url)
+        assert record.rec_type == 'response'
+        assert record.http_headers.get_header('Content-Type') == mime
+        assert payload(record) == body
+    assert warc_index.seek_record(warc, PAGE, rec_type='request').rec_type == 'request'
+    assert warc_index.seek_record(warc, 'http://site.com/missing') is None
+    assert warc_index.seek_record(str(tmp_path / 'missing.warc'), PAGE) is None
+
+def test_write_filtered(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    entries = [e for e in warc_index.load_index(warc).entries if e.url != PAGE]
+    entries.sort(key=lambda e: e.offset)
+    output = warc_index.write_filtered(warc, str(tmp_path / 'b.warc'), entries)
+    assert warc_index.index_fresh(output)
+    assert warc_index.seek_record(output, PAGE) is None
+    assert payload(warc_index.seek_record(output, RESOURCES[1][0])) == RESOURCES[1][2]
+    # * Records are copied as-is
+    with open(warc, 'rb') as f:
+        copied = b''
+        for entry in entries:
+            f.seek(entry.offset)
+            copied += f.read(entry.length)
+    assert open(output, 'rb').read() == copied
+
+
+def test_exclusion_manifest(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    output = str(tmp_path / 'b.warc')
+    excluded = warc_index.load_index(warc).lookup(RESOURCES[1][0])
+    warc_index.write_exclusion_manifest(warc, output, [excluded])
+
+    assert not os.path.exists(output)
+    assert warc_index.is_virtual(output) and warc_index.warc_exists(output)
+    index = warc_index.load_index(output)
+    assert index.warc == os.path.abspath(warc)
+    assert RESOURCES[1][0] not in index.urls()
+    assert len(index.entries) == 2 * len(RESOURCES) - 1
+    assert warc_index.seek_record(output, RESOURCES[1][0]) is None
+    assert payload(warc_index.seek_record(output, PAGE)) == RESOURCES[0][2]
+
+    # * pywb loads the records from the source WARC
+    index_file = str(tmp_path / 'b.cdxj')
+    warc_index.write_pywb_index(output, index_file)
+    lines = open(index_file).read().splitlines()
+    assert len(lines) == len(RESOURCES) - 1
+    assert all(json.loads(line.split(' ', 2)[2])['filename'] == 'a.warc' for line in lines)
+
+    warc_index.remove_outputs(output)
+    assert not warc_index.warc_exists(output)
+
+def test_exclusion_manifest_stale_source(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    output = str(tmp_path / 'b.warc')
+    warc_index.write_exclusion_manifest(warc, output, [])
+    make_warc(warc, resources=RESOURCES[:1])
+    with pytest.raises(ValueError):
+        warc_index.load_index(output)
+
+def test_exclusion_manifest_source_rewritten_same_size(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    output = str(tmp_path / 'b.warc')
+    warc_index.write_exclusion_manifest(warc, output, [])
+    size, mtime = os.path.getsize(warc), os.path.getmtime(warc)
+    make_warc(warc, resources=list(reversed(RESOURCES)))
+    os.utime(warc, (mtime + 10, mtime + 10))
+    assert os.path.getsize(warc) == size
+    with pytest.raises(ValueError):
+        warc_index.load_index(output)
+
+
+def test_revisit_resolution(tmp_path):
+    body = b'x' * (2 * dedup.MIN_DEDUP_LENGTH)
+    original_url, revisit_url = 'http://site.com/big.js', 'http://site.com/big.js?v=2'
+    original = make_warc(tmp_path / 'a.warc', resources=[(original_url, 'application/javascript', body)])
+    revisit = make_warc(tmp_path / 'b.warc', resources=[(revisit_url, 'application/javascript', body)],
+                        date='2025-01-02T00:00:00Z')
+    store = dedup.PayloadStore(str(tmp_path / 'store.json'))
+    assert dedup.dedup_warc(original, store)['revisits'] == 0
+    stats = dedup.dedup_warc(revisit, store)
+    assert stats['revisits'] == 1 and stats['saved'] > 0
+
+    index = warc_index.load_index(revisit)
+    assert index.lookup(revisit_url) is None
+    assert index.lookup(revisit_url, 'revisit') is not None
+    # * The revisit of a different URL is resolved by WARC-Refers-To-Target-URI in the WARC it refers to
+    record = warc_index.seek_record(revisit, revisit_url)
+    assert record.rec_headers.get_header('WARC-Target-URI') == original_url
+    assert payload(record) == body
+    assert warc_index.revisit_targets(revisit) == {original: [warc_index.load_index(original).lookup(original_url)]}
+    responses = warc_index.IndexedResponses(revisit)
+    assert revisit_url in responses
+    assert responses[revisit_url] == {body}
+
+def test_dangling_revisit(tmp_path):
+    body = b'x' * (2 * dedup.MIN_DEDUP_LENGTH)
+    url = 'http://site.com/big.js'
+    original = make_warc(tmp_path / 'a.warc', resources=[(url, 'application/javascript', body)])
+    revisit = make_warc(tmp_path / 'b.warc', resources=[(url, 'application/javascript', body)],
+                        date='2025-01-02T00:00:00Z')
+    store = dedup.PayloadStore(str(tmp_path / 'store.json'))
+    dedup.dedup_warc(original, store)
+    dedup.dedup_warc(revisit, store)
+    os.remove(original)
+    assert warc_index.seek_record(revisit, url) is None
+
+
+def test_gzip_warc(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc.gz', gzip=True)
+    # * The plain name resolves to the gzip form
+    warc = warc_utils.strip_gzip_suffix(warc)
+    for url, _, body in RESOURCES:
+        assert payload(warc_index.seek_record(warc, url)) == body
+
+def test_write_filtered_compressed(tmp_path):
+    warc = make_warc(tmp_path / 'a.warc')
+    entries = sorted(warc_index.load_index(warc).entries, key=lambda e: e.offset)
+    output = warc_index.write_filtered(warc, str(tmp_path / 'b.warc'), entries[2:], compress=True)
+    assert output == str(tmp_path / 'b.warc.gz')
+    assert warc_index.index_fresh(output)
+    with open(output, 'rb') as f:
+        assert warc_utils.is_gzip_warc(f)
+    # * One gzip member per record, so each record can be read with a single seek
+    for url, _, body in RESOURCES[1:]:
+        assert payload(warc_index.seek_record(output, url)) == body
+    assert warc_index.seek_record(output, PAGE) is None
+    # * Writing it again replaces the other form
+    output = warc_index.write_filtered(warc, str(tmp_path / 'b.warc'), entries)
+    assert not os.path.exists(str(tmp_path / 'b.warc.gz'))
+
+
+def test_shards_match_full_scan(tmp_path):
+    resources = [(f'http://site.com/{i}', 'text/plain', b'x' * 100) for i in range(50)]
+    warc = make_warc(tmp_path / 'a.warc', resources=resources)
+    full = warc_index.scan_shard(warc, 0, os.path.getsize(warc))
+    shards = warc_index.shard_ranges(warc, shard_size=2000)
+    assert len(shards) > 1
+    assert shards[0][0] == 0 and shards[-1][1] == os.path.getsize(warc)
+    scanned = []
+    for start, end in shards:
+        scanned += warc_index.scan_shard(warc, start, end)
+    assert scanned == full
+
+def test_scan_sharded(tmp_path, monkeypatch):
+    resources = [(f'http://site.com/{i}', 'text/plain', b'x' * 100) for i in range(50)]
+    warc = make_warc(tmp_path / 'a.warc', resources=resources)
+    monkeypatch.setattr(warc_index, 'SHARD_THRESHOLD', 1000)
+    monkeypatch.setattr(warc_index, 'SHARD_SIZE', 2000)
+    full = warc_index.scan_shard(warc, 0, os.path.getsize(warc))
+    assert warc_index.scan_sharded(warc, num_workers=3) == full
+
+
+def write_collection_index(tmp_path, name, resources):
+    warc = make_warc(tmp_path / f'{name}.warc', resources=resources)
+    index_file = str(tmp_path / f'{name}.cdxj')
+    warc_index.write_pywb_index(warc, index_file)
+    return index_file
+
+def test_merge_index_files(tmp_path):
+    index_file = write_collection_index(tmp_path, 'base', RESOURCES[:2])
+    sources = [write_collection_index(tmp_path, 'c1', RESOURCES[2:]),
+               write_collection_index(tmp_path, 'c2', [('http://aaa.com/', 'text/html', b'a')])]
+    expected = sorted(sum((open(f).read().splitlines() for f in [index_file] + sources), []))
+
+    assert warc_index.merge_index_files(index_file, sources) == len(RESOURCES) - 2 + 1
+    assert open(index_file).read().splitlines() == expected
+
+def test_merge_index_files_skip(tmp_path):
+    index_file = str(tmp_path / 'index.cdxj')
+    sources = [write_collection_index(tmp_path, 'c1', RESOURCES[:2]),
+               write_collection_index(tmp_path, 'c2', RESOURCES[2:])]
+    assert warc_index.merge_index_files(index_file, sources, skip_filenames=['c1.warc']) == len(RESOURCES) - 2
+    lines = open(index_file).read().splitlines()
+    assert lines == sorted(lines)
+    assert all(json.loads(line.split(' ', 2)[2])['filename'] == 'c2.warc' for line in lines)
@@ -0,0 +1,76 @@
+import io
+
+import pytest
+from warcio.warcwriter import WARCWriter
+
+from warctradeoff.utils import warc_utils, warc_index
+from tests.synthetic_warcs import make_warc, response_record, RESOURCES
+
+def read_spans(path, spans) -> list:
+    """(url, payload) of the record at each span of path"""
+    records = []
+    for offset, length in spans:
+        entry = warc_index.IndexEntry(None, None, None, offset, length, None, None, None)
+        record = warc_index.read_entry(path, entry)
+        records.append((record.rec_headers.get_header('WARC-Target-URI'), record.content_stream().read()))
+    return records
+
+def test_merge_spans():
+    assert warc_utils.merge_spans([(0, 10), (10, 5), (20, 5), (25, 1)]) == [(0, 15), (20, 6)]
+    assert warc_utils.record_spans([0, 10, 30], 35) == [(0, 10), (10, 20), (30, 5)]
+
+@pytest.mark.parametrize('kernel', [True, False])
+def test_copy_byte_ranges(tmp_path, monkeypatch, kernel):
+    if not kernel:
+        monkeypatch.setattr(warc_utils, '_copy_range_kernel', lambda *args: 0)
+    src_path, dst_path = tmp_path / 'src', tmp_path / 'dst'
+    data = bytes(range(256)) * 16
+    src_path.write_bytes(data)
+    spans = [(0, 100), (100, 50), (1000, 24), (4000, 96)]
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        dst.write(b'head')
+        warc_utils.copy_byte_ranges(src, dst, spans)
+        # * dst stays positioned at the end, for writes that follow
+        dst.write(b'tail')
+    expected = b'head' + b''.join(data[offset:offset + length] for offset, length in spans) + b'tail'
+    assert dst_path.read_bytes() == expected
+
+
+def copy_with_copier(tmp_path, src, compress):
+    entries = sorted(warc_index.load_index(src).entries, key=lambda e: e.offset)
+    responses = [e for e in entries if e.rec_type == 'response']
+    dst = str(tmp_path / 'out.warc')
+    with open(src, 'rb') as iw, open(dst, 'wb') as fw:
+        copier = warc_utils.WarcCopier(iw, fw, compress=compress)
+        copier.copy([(e.offset, e.length) for e in responses[:2]])
+        writer = WARCWriter(io.BytesIO())
+        copier.write(response_record(writer, 'http://site.com/new', 'text/plain', b'new'))
+        copier.copy([(e.offset, e.length) for e in responses[2:]])
+        spans = copier.close()
+    return dst, spans
+
+@pytest.mark.parametrize('gzip_src,compress', [(False, False), (False, True), (True, False)])
+def test_warc_copier(tmp_path, gzip_src, compress):
+    src = make_warc(tmp_path / ('src.warc.gz' if gzip_src else 'src.warc'), gzip=gzip_src)
+    dst, spans = copy_with_copier(tmp_path, src, compress)
+    expected = [(url, body) for url, _, body in RESOURCES]
+    expected.insert(2, ('http://site.com/new', b'new'))
+
+    assert len(spans) == len(expected)
+    assert read_spans(dst, spans) == expected
+    with open(dst, 'rb') as f:
+        assert warc_utils.is_gzip_warc(f) == (gzip_src or compress)
+    # * Spans are back to back, so they match a scan of the output
+    scanned = sorted(warc_index.scan_entries(dst), key=lambda e: e.offset)
+    assert [(e.offset, e.length) for e in scanned] == spans
+
+def test_move_path_sidecars(tmp_path, monkeypatch):
+    src = make_warc(tmp_path / 'a.warc')
+    warc_index.load_index(src)
+    dst = str(tmp_path / 'warcs' / 'a.warc')
+    warc_utils.move_path(src, dst, sidecars=[warc_index.INDEX_SUFFIX])
+    assert not warc_index.index_fresh(src) and warc_index.index_fresh(dst)
+    # * The moved sidecar is loaded, not rebuilt
+    monkeypatch.setattr(warc_index, 'build_index', lambda *args, **kwargs: pytest.fail('index rebuilt'))
+    warc_index.INDEX_CACHE.clear()
+    assert set(warc_index.load_index(dst).urls('response')) == {url for url, _, _ in RESOURCES}
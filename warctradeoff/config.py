@@ -13,6 +13,7 @@ class Config:
         self._collection = None
         self._replayweb = False
         self._separate_collection = None
+        self._compress_warcs = None
 
     @cached_property
     def host(self):
@@ -30,6 +31,16 @@ class Config:
     def host_proxy_patch(self):
         return self.config.get('host_proxy_patch')
     
+    @cached_property
+    def replay_server(self):
+        """'pywb' (wayback subprocesses) or 'inprocess' (utils/replay_server.py) for measurement replays"""
+        return self.config.get('replay_server', 'pywb')
+
+    @cached_property
+    def crawl_daemon(self):
+        """Whether record_replay_all_urls_multi runs pages on long-lived crawl daemons (crawl/crawl_daemon.js)"""
+        return self.config.get('crawl_daemon', False)
+
     @cached_property
     def pywb_env(self):
         return self.config.get('pywb_env', ':')
@@ -67,6 +78,11 @@ class Config:
     def archive_dir(self):
         return self.config.get('archive_dir', '.')
     
+    @property
+    def replay_ports(self):
+        """(first, last) ports that replay servers are started on, outside of the ephemeral range"""
+        return tuple(self.config.get('replay_ports', [20000, 29999]))
+
     @property
     def separate_collection(self):
         return self._separate_collection
@@ -75,5 +91,16 @@ class Config:
     def separate_collection(self, value):
         self._separate_collection = value
 
+    @property
+    def compress_warcs(self):
+        """Whether derived warcs are written as per-record gzip .warc.gz"""
+        if self._compress_warcs is None:
+            self._compress_warcs = self.config.get('compress_warcs', False)
+        return self._compress_warcs
+
+    @compress_warcs.setter
+    def compress_warcs(self, value):
+        self._compress_warcs = value
+
 config_path = os.path.join(_FILEDIR, 'config.json') if not os.environ.get('FIDEX_CONFIG') else os.environ.get('FIDEX_CONFIG')
 CONFIG = Config(config_path)
\ No newline at end of file
@@ -15,8 +15,6 @@ import os
 import json
 import sys
 import re
-import threading
-import concurrent.futures
 import time
 import logging
 import traceback
@@ -25,8 +23,8 @@ import glob
 _FILEDIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(_FILEDIR))
 _CURDIR = os.getcwd()
-from warctradeoff.crawl import warcprocess
-from warctradeoff.utils import upload, url_utils, logger, common
+from warctradeoff.crawl import warcprocess, crawl_daemon
+from warctradeoff.utils import upload, url_utils, logger, common, catalog, replay_server, upload_queue, pool
 from warctradeoff.config import CONFIG
 
 REMOTE = False
@@ -37,6 +35,15 @@ HOME = os.path.expanduser("~")
 default_archive = 'test'
 DEFAULTARGS = ['-w', '-s', '--scroll']
 SPLIT_ARCHIVE = False
+# * Uploader threads and queued uploads of record_replay_all_urls_multi (see utils/upload_queue.py)
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_SIZE = 64
+# * Run the pages of record_replay_all_urls_multi's workers on long-lived crawl daemons (see crawl_daemon.js)
+# * Opt-in with "crawl_daemon": true in the config
+CRAWL_DAEMON = CONFIG.crawl_daemon
+# * Replay servers are recycled after this many replays, or once they use more than this much memory (bytes)
+PYWB_MAX_USES = 200
+PYWB_MAX_RSS = 4 << 30
 
 DEFAULT_CHROMEDATA = CONFIG.chrome_data_dir
 
@@ -48,17 +55,27 @@ def record(url, archive_name,
            archive_path='./',
            wr_archive=default_archive,
            filename=None, 
-           arguments=None):
+           arguments=None,
+           crawler=None):
+    """crawler (CrawlDaemon | None): If set, record on it instead of a new node record.js"""
     filename = 'live' if filename is None else filename
     assert '_' not in filename, "Filename cannot contain underscore"
     if download_path is not None:
         arguments = arguments + ['--download', download_path]
-    p = Popen(['node', 'record.js', '-d', f'{write_path}/{archive_name}',
-                '-f', filename,
-                '-a', wr_archive,
-                '-c', chrome_data,
-                *arguments,
-                url], stdout=PIPE, cwd=_FILEDIR)
+    argv = ['-d', f'{write_path}/{archive_name}',
+            '-f', filename,
+            '-a', wr_archive,
+            '-c', chrome_data,
+            *arguments,
+            url]
+    if crawler is not None:
+        try:
+            info = crawler.record(argv)
+            return info['ts'], info['url']
+        except crawl_daemon.CrawlDaemonError as e:
+            logging.error(f"Record exception on {url}: {str(e)}")
+            return None, url
+    p = Popen(['node', 'record.js', *argv], stdout=PIPE, cwd=_FILEDIR)
     ts = None
     while True:
         line = p.stdout.readline()
@@ -77,15 +94,24 @@ def replay(url, archive_name,
            write_path=f'{_CURDIR}/writes',
            proxy=False,
            filename=None,
-           arguments=None):
+           arguments=None,
+           crawler=None):
+    """crawler (CrawlDaemon | None): If set, replay on it instead of a new node replay.js"""
     if filename is None:
         filename = 'proxy' if proxy else 'archive'
     assert '_' not in filename, "Filename cannot contain underscore"
-    check_call(['node', 'replay.js', '-d', f'{write_path}/{archive_name}', 
-                '-f', filename,
-                '-c', chrome_data,
-                *arguments,
-                url], cwd=_FILEDIR)
+    argv = ['-d', f'{write_path}/{archive_name}', 
+            '-f', filename,
+            '-c', chrome_data,
+            *arguments,
+            url]
+    if crawler is not None:
+        try:
+            crawler.replay(argv)
+        except crawl_daemon.CrawlDaemonError as e:
+            logging.error(f"Replay exception on {url}: {str(e)}")
+        return
+    check_call(['node', 'replay.js', *argv], cwd=_FILEDIR)
 
 def record_replay(url, archive_name,
                   file_suffix,
@@ -105,7 +131,9 @@ def record_replay(url, archive_name,
                   replay_archive_patch=False,
                   replay_ts=None,
                   patch_ts=None,
-                  arguments=None):
+                  arguments=None,
+                  uploader=None,
+                  crawler=None):
     """
     Now record and replay should be totally separate process, although they're still in the same function
     The reason is that the js and nojs combination in the pywb might change. So it doesn't make sense to replay right after record
@@ -124,6 +152,8 @@ def record_replay(url, archive_name,
         replay_archive_patch (bool): True if run with patch, False if not run with patch
         replay_ts: str: If replay is set, run the specific timestamp for replay
         patch_ts: str: If replay_archive_patch is set, run the specific timestamp for patch
+        uploader (UploadQueue | None): If set, the warc and writes are queued to be uploaded in the background
+        crawler (CrawlDaemon | None): If set, record and replay on this long-lived crawler instead of a node process each
     """
     if arguments is None:
         arguments = DEFAULTARGS
@@ -144,6 +174,7 @@ def record_replay(url, archive_name,
     metadata = client.get_metadata(col_name=upload_write_archive, directory=archive_name)
     if download_path is None:
         download_path = f'{chrome_data}/Downloads'
+    pending_warcs = []
     if record_live:
         file_prefix = file_prefix or 'record'
         filename = f'{file_prefix}-{file_suffix}'
@@ -154,7 +185,8 @@ def record_replay(url, archive_name,
                                 archive_path=archive_path, 
                                 wr_archive=wr_archive, 
                                 filename=filename,
-                                arguments=arguments)
+                                arguments=arguments,
+                                crawler=crawler)
         # Logic still in testing
         record_success = ts is not None
         if record_success:
@@ -164,7 +196,11 @@ def record_replay(url, archive_name,
                 'req_url': url
             }
             check_call(['mv', f'{download_path}/{wr_archive}.warc', f'{download_path}/{archive_name}_{file_suffix}.warc'], cwd=_FILEDIR)
-            client.upload_warc(f'{download_path}/{archive_name}_{file_suffix}.warc', pw_archive, pw_archive , mv_only=True)
+            if remote_host or uploader is not None:
+                # * Sent with the writes below, in one batch
+                pending_warcs.append((f'{download_path}/{archive_name}_{file_suffix}.warc', None, pw_archive))
+            else:
+                client.upload_warc(f'{download_path}/{archive_name}_{file_suffix}.warc', pw_archive, pw_archive , mv_only=True)
             
 
     if replay_archive or replay_archive_patch:
@@ -194,7 +230,8 @@ def record_replay(url, archive_name,
                 chrome_data=chrome_data,
                 write_path=write_path, 
                 filename=filename,
-                arguments=proxy_arguments)
+                arguments=proxy_arguments,
+                crawler=crawler)
         # Logic still in testing
         metadata[file_prefix][file_suffix] = {
             'url': record_url,
@@ -207,9 +244,28 @@ def record_replay(url, archive_name,
     # The metadata will also be merged and dump together later. Here just leave a copy at the directory
     if os.path.exists(f'{write_path}/{archive_name}'):
         json.dump(metadata, open(f'{write_path}/{archive_name}/metadata.json', 'w+'), indent=2)
-    client.upload_write(f'{write_path}/{archive_name}', directory=upload_write_archive)
+    if uploader is not None:
+        # * Remote crawls land in the catalog of the archive host, whose refresh sees the changed archive directories
+        catalog_updates = None
+        if not remote_host:
+            catalog_updates = {'archive': [upload_write_archive, archive_name]}
+            if record_live and record_success:
+                catalog_updates['warcs'] = [pw_archive, [f'{archive_name}_{file_suffix}.warc']]
+        uploader.put(writes=[(f'{write_path}/{archive_name}', upload_write_archive)], warcs=pending_warcs,
+                         catalog_updates=catalog_updates)
+    elif remote_host:
+        try:
+            client.upload_batch(writes=[(f'{write_path}/{archive_name}', upload_write_archive)], warcs=pending_warcs)
+        except Exception as e:
+            print("Exception on uploading batch", str(e))
+    else:
+        client.upload_write(f'{write_path}/{archive_name}', directory=upload_write_archive)
+    if not remote_host and uploader is None:
+        catalog.update_archive(upload_write_archive, archive_name)
+        if record_live and record_success:
+            catalog.update_warcs(pw_archive, [f'{archive_name}_{file_suffix}.warc'])
     if temp_client:
-        sshclient.close()
+        client.close()
     return metadata
 
 
@@ -230,7 +286,9 @@ def record_replay_all_urls(urls,
                            replay_archive_patch=False,
                            replay_ts=None,
                            patch_ts=None,
-                           arguments=None) -> set:
+                           arguments=None,
+                           uploader=None,
+                           crawler=None) -> set:
     if arguments is None:
         arguments = DEFAULTARGS
     finished_urls = set()
@@ -260,10 +318,14 @@ def record_replay_all_urls(urls,
                                     replay_archive_patch=replay_archive_patch,
                                     replay_ts=replay_ts,
                                     patch_ts=patch_ts,
-                                    arguments=arguments)
+                                    arguments=arguments,
+                                    uploader=uploader,
+                                    crawler=crawler)
             logging.info(f"Finished {url}")
             if len(url_metadata) == 0:
                 if worker_id is not None: # Only remove chrome_data in multiprocess mode, since there might something wrong with the chrome_data
+                    if crawler is not None:
+                        crawler.reset()
                     call(['rm', '-rf', chrome_data])
                 continue
         except Exception as e:
@@ -288,38 +350,41 @@ def record_replay_all_urls_multi(urls, file_suffix, num_workers=8,
                                  replay_ts=None,
                                  patch_ts=None,
                                  arguments=None,
-                                 trials=1):
+                                 trials=1,
+                                 upload_workers=UPLOAD_WORKERS,
+                                 use_daemon=CRAWL_DAEMON):
     """
     The  multi-threaded version of record_replay_all_urls
     Need to make sure that the chrome_data_dir is set up with base, since the workers will copy from base
     Base need to have the webrecorder extension installed. Adblock is optional but recommended.
+    Uploads are queued to upload_workers background threads (0 to upload in the crawl workers),
+    and journaled to {write_path}.uploads.jsonl so that unfinished ones are retried by the next run
+    If use_daemon is set, each worker records and replays on its own crawl daemon, which keeps node and Chrome warm
     """
     if arguments is None:
         arguments = DEFAULTARGS
     num_workers = min(num_workers, len(urls))
     # random.shuffle(urls)
-    active_ids = set()
-    pywb_servers = []
-    id_lock = threading.Lock()
-    urls_remain, finished_urls = urls.copy(), set()
-
-    def _get_worker_task():
-        with id_lock:
-            for i in range(num_workers):
-                if i not in active_ids:
-                    active_ids.add(i)
-                    url = urls_remain.pop(0) if len(urls_remain) > 0 else None
-                    return i, url
-        return None, None
+    finished_urls = set()
     
-    def _start_pywb_servers():
-        for i in range(num_workers):
-            wb_manager = upload.WBManager(split=SPLIT_ARCHIVE, worker_id=i)
-            pywb_server = upload.PYWBServer(archive=wb_manager.collection(pw_archive), proxy=True)
-            if replay_archive or replay_archive_patch:
-                pywb_server.start()
-            pywb_servers.append(pywb_server)
-    _start_pywb_servers()
+    # * One persistent server per worker, switched between collections (or tenants) without restarts
+    archives = [upload.WBManager(split=SPLIT_ARCHIVE, worker_id=i).collection(pw_archive) for i in range(num_workers)]
+    if CONFIG.replay_server == 'inprocess':
+        pywb_pool = replay_server.ReplayServerPool(archives, proxy=True)
+    else:
+        pywb_pool = upload.PYWBServerPool(archives, proxy=True, max_uses=PYWB_MAX_USES, max_rss=PYWB_MAX_RSS)
+    if replay_archive or replay_archive_patch:
+        pywb_pool.start()
+    uploader = None
+    if upload_workers > 0:
+        if remote_host:
+            client_factory = upload.SSHClientManager
+        else:
+            client_factory = upload.LocalUploadManager
+        uploader = upload_queue.UploadQueue(client_factory, num_workers=upload_workers, max_size=UPLOAD_QUEUE_SIZE,
+                                            journal=f'{write_path}.uploads.jsonl').start()
+    # * Started on their first job
+    crawlers = [crawl_daemon.CrawlDaemon(name=i) if use_daemon else None for i in range(num_workers)]
 
     def _replace_port(url, port):
             us = urlsplit(url)
@@ -344,16 +409,17 @@ def record_replay_all_urls_multi(urls, file_suffix, num_workers=8,
                              replay_ts,
                              patch_ts,
                              arguments):
-        pywb_server = pywb_servers[worker_id]
+        pywb_server = pywb_pool.server(worker_id)
         if CONFIG.separate_collection:
-            coll_name = url_utils.calc_hostname(url)
-            coll_name = upload.BaseManager.escape(f'{pw_archive}_{coll_name}')
-            pywb_server.restart(coll_name)
+            pywb_server.select_tenant(pw_archive, url_utils.calc_hostname(url))
         if replay_archive:
             replay_archive = _replace_port(PROXYHOST, pywb_server.port)
         elif replay_archive_patch:
             replay_archive_patch = _replace_port(PROXYHOST_PATCH, pywb_server.port)
+        crawler = crawlers[worker_id]
         if not os.path.exists(chrome_data):
+            if crawler is not None:
+                crawler.reset()
             # call(['cp', '--reflink=auto', '-r', f'{chrome_data_dir}/base', chrome_data])
             call(['cp', '-r', f'{chrome_data_dir}/base', chrome_data])
             time.sleep(worker_id*5)
@@ -374,60 +440,57 @@ def record_replay_all_urls_multi(urls, file_suffix, num_workers=8,
                                replay_archive_patch=replay_archive_patch,
                                replay_ts=replay_ts,
                                patch_ts=patch_ts,
-                               arguments=arguments)
+                               arguments=arguments,
+                               uploader=uploader,
+                               crawler=crawler)
         finished_urls.update(succeed_url)
-        with id_lock:
-            active_ids.remove(worker_id)
+
+    def slot_worker(worker_id, url):
+        # * Each slot keeps its chrome data and replay server across the URLs it takes
+        record_replay_worker(url=url,
+                             file_suffix=file_suffix,
+                             file_prefix=file_prefix,
+                             chrome_data=f'{chrome_data_dir}/record_replay_{common.get_hostname()}_{worker_id}',
+                             worker_id=worker_id,
+                             write_path=write_path,
+                             upload_write_archive=upload_write_archive,
+                             download_path=download_path,
+                             wr_archive=wr_archive,
+                             pw_archive=pw_archive,
+                             remote_host=remote_host,
+                             record_live=record_live,
+                             replay_archive=replay_archive,
+                             replay_archive_patch=replay_archive_patch,
+                             replay_ts=replay_ts,
+                             patch_ts=patch_ts,
+                             arguments=arguments)
             
-    for _ in range(trials):
-        urls_remain = [url for url in urls if url not in finished_urls]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    try:
+        for _ in range(trials):
+            urls_remain = [url for url in urls if url not in finished_urls]
             for i in range(num_workers):
+                if crawlers[i] is not None:
+                    crawlers[i].reset()
                 call(['rm', '-rf', f'{chrome_data_dir}/record_replay_{common.get_hostname()}_{i}'])
-            # Keep track of futures
-            tasks = []
-            while True:
-                # Get worker id
-                sleep_time = 1
-                while True:
-                    worker_id, url = _get_worker_task()
-                    if worker_id is not None:
-                        break
-                    else:
-                        sleep_time = min(sleep_time * 2, 30)
-                        time.sleep(sleep_time)
-                assert worker_id is not None, "Worker ID is None"
-                if url:
-                    # Submit the worker thread to the pool
-                    task = executor.submit(record_replay_worker, 
-                                            url=url,
-                                            file_suffix=file_suffix,
-                                            file_prefix=file_prefix,
-                                            chrome_data=f'{chrome_data_dir}/record_replay_{common.get_hostname()}_{worker_id}',
-                                            worker_id=worker_id,
-                                            write_path=write_path,
-                                            upload_write_archive=upload_write_archive,
-                                            download_path=download_path,
-                                            wr_archive=wr_archive,
-                                            pw_archive=pw_archive,
-                                            remote_host=remote_host,
-                                            record_live=record_live,
-                                            replay_archive=replay_archive,
-                                            replay_archive_patch=replay_archive_patch,
-                                            replay_ts=replay_ts,
-                                            patch_ts=patch_ts,
-                                            arguments=arguments)
-                    tasks.append(task)
-                else:
-                    # Exit the loop if no more urls
-                    break
-                # Check for any completed threads
-                for task in tasks:
-                    if task.done():
-                        tasks.remove(task)
-                # Exit the loop if all tasks are done
-                if len(tasks) == 0 and len(active_ids) == 0:
-                    break
+            # * Each worker takes the next URL as soon as it is done with the last one
+            stats = pool.run_slots(slot_worker, urls_remain, num_workers=min(num_workers, len(urls_remain)), name='record_replay')
+            logging.info(f'record_replay: Worker utilization {[round(u, 2) for u in stats["utilization"]]}')
+            if uploader is not None:
+                # * The next trial reads the metadata of the uploaded writes
+                uploader.flush()
+    finally:
+        # * Also on errors and interrupts, so that no crawl daemon, uploader thread or server outlives the run
+        for crawler in crawlers:
+            if crawler is not None:
+                crawler.stop()
+        try:
+            if uploader is not None:
+                uploader.close()
+        finally:
+            if replay_archive or replay_archive_patch:
+                for stats in pywb_pool.stats():
+                    logging.info(f'pywb server: {stats}')
+                pywb_pool.stop()
     
     if replay_archive or replay_archive_patch:
         return []
@@ -0,0 +1,130 @@
+/*
+    Long-lived crawler of a worker, driven over JSON-RPC 2.0 on stdio (one message per line)
+    Node, its modules and Chrome stay warm across pages, instead of a node record.js/replay.js per page.
+
+    Requests (stdin):  {"jsonrpc": "2.0", "id": 1, "method": "record", "params": {"argv": [...]}}
+    Responses (stdout): {"jsonrpc": "2.0", "id": 1, "result": {...}} or {..., "error": {"code", "message", "data"}}
+    Methods:
+        record: argv of record.js (options and url). Result: {ts, url} of the recorded page
+        replay: argv of replay.js. Result: {}
+        close: Close the browser (e.g. before its chrome_data is removed). The next job starts a new one
+        ping, shutdown
+    Jobs run one at a time. The browser is reused as long as chrome_data, headless and proxy stay the same.
+    Logs go to stderr, so that stdout only carries responses.
+*/
+const readline = require('readline');
+const { Command } = require('commander');
+
+const { startChrome } = require('../utils/load');
+const { recordReplayArgs } = require('../utils/argsparse');
+const { loggerizeConsole } = require('../utils/logger');
+const { recordPage } = require('./record');
+const { replayPage } = require('./replay');
+
+// * After the requires, as record.js and replay.js loggerize the console to stdout when loaded
+loggerizeConsole(true);
+
+const JOB_ERROR = -32000;
+const METHOD_NOT_FOUND = -32601;
+const PARSE_ERROR = -32700;
+
+let current = null; // {key, browser, chromeData}
+
+function parseArgv(argv) {
+    let urlStr = null;
+    const program = recordReplayArgs(new Command());
+    program
+        .exitOverride()
+        .argument("<url>")
+        .action(url => urlStr=url);
+    program.parse(argv, { from: 'user' });
+    return { options: program.opts(), urlStr: urlStr };
+}
+
+async function closeBrowser() {
+    if (current === null)
+        return;
+    const { browser } = current;
+    current = null;
+    try {
+        await browser.close();
+    } catch (err) {
+        console.error(`Crawl daemon: closing browser: ${err.message}`);
+    }
+}
+
+async function getBrowser(options, proxy=null) {
+    const headless = options.headless ? "new": false;
+    const key = JSON.stringify([options.chrome_data, headless, proxy]);
+    if (current !== null && (current.key !== key || !current.browser.connected))
+        await closeBrowser();
+    if (current === null) {
+        const { browser, chromeData } = await startChrome(options.chrome_data, headless, proxy);
+        current = { key: key, browser: browser, chromeData: chromeData };
+        console.log(`Crawl daemon: Started browser on ${chromeData}`);
+    }
+    return current;
+}
+
+const METHODS = {
+    record: async (params) => {
+        const { options, urlStr } = parseArgv(params.argv);
+        const { browser, chromeData } = await getBrowser(options);
+        return await recordPage(browser, chromeData, urlStr, options);
+    },
+    replay: async (params) => {
+        const { options, urlStr } = parseArgv(params.argv);
+        const { browser } = await getBrowser(options, options.proxy);
+        await replayPage(browser, urlStr, options);
+        return {};
+    },
+    close: async () => {
+        await closeBrowser();
+        return {};
+    },
+    ping: async () => ({ pid: process.pid, browser: current !== null }),
+    shutdown: async () => {
+        await closeBrowser();
+        return {};
+    },
+};
+
+function respond(message) {
+    process.stdout.write(JSON.stringify({ jsonrpc: "2.0", ...message }) + '\n');
+}
+
+async function handle(line) {
+    let request = null;
+    try {
+        request = JSON.parse(line);
+    } catch (err) {
+        respond({ id: null, error: { code: PARSE_ERROR, message: err.message } });
+        return;
+    }
+    const method = METHODS[request.method];
+    if (!method) {
+        respond({ id: request.id, error: { code: METHOD_NOT_FOUND, message: `Unknown method ${request.method}` } });
+        return;
+    }
+    const start = Date.now();
+    try {
+        const result = await method(request.params || {});
+        respond({ id: request.id, result: result, time: Date.now() - start });
+    } catch (err) {
+        console.error(`Crawl daemon: ${request.method} exception: ${err.stack}`);
+        respond({ id: request.id, error: { code: JOB_ERROR, message: err.message, data: { stack: err.stack } }, time: Date.now() - start });
+    }
+    if (request.method === 'shutdown')
+        process.exit();
+}
+
+(async function(){
+    const lines = readline.createInterface({ input: process.stdin });
+    // * One job at a time: the worker's browser runs a single page
+    for await (const line of lines) {
+        if (line.trim())
+            await handle(line);
+    }
+    await closeBrowser();
+    process.exit();
+})()
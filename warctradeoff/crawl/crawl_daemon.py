@@ -0,0 +1,123 @@
+"""
+Python side of crawl_daemon.js: a long-lived node process (and Chrome) per crawl worker,
+which records and replays pages sent to it over JSON-RPC on its stdio, instead of a node process per page.
+"""
+import os
+import json
+import queue
+import signal
+import logging
+import threading
+from subprocess import Popen, PIPE, TimeoutExpired
+
+_FILEDIR = os.path.dirname(os.path.abspath(__file__))
+# * Run in _FILEDIR
+DAEMON_COMMAND = ['node', 'crawl_daemon.js']
+# * Seconds a job may take before the daemon (and its Chrome) is considered stuck and killed
+JOB_TIMEOUT = 30 * 60
+
+
+class CrawlDaemonError(Exception):
+    pass
+
+
+class CrawlDaemon:
+    def __init__(self, name=None):
+        self.name = name
+        self.process = None
+        self.responses = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.stats = {'jobs': 0, 'errors': 0, 'restarts': 0, 'job_time': 0.0}
+
+    def _read_responses(self, process, responses):
+        for line in process.stdout:
+            line = line.decode(errors='replace').strip()
+            if not line.startswith('{'):
+                if line:
+                    logging.info(f'CrawlDaemon {self.name}: {line}')
+                continue
+            try:
+                responses.put(json.loads(line))
+            except ValueError:
+                logging.error(f'CrawlDaemon {self.name}: Malformed message {line}')
+        responses.put(None) # * EOF: the daemon exited
+
+    def start(self):
+        if self.process is not None:
+            self.stats['restarts'] += 1
+        # * In its own session, so that killing it also kills its Chrome
+        self.process = Popen(DAEMON_COMMAND, stdin=PIPE, stdout=PIPE, cwd=_FILEDIR, start_new_session=True)
+        self.responses = queue.Queue()
+        threading.Thread(target=self._read_responses, args=(self.process, self.responses), daemon=True).start()
+        logging.info(f'CrawlDaemon {self.name}: Started node process {self.process.pid}')
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def _kill(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def call(self, method, params=None, timeout=JOB_TIMEOUT):
+        """Send a request and wait for its result. Raises CrawlDaemonError on an error response, or if the daemon is gone"""
+        with self.lock:
+            if not self.alive():
+                self.start()
+            self.next_id += 1
+            request_id = self.next_id
+            request = {'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params or {}}
+            try:
+                self.process.stdin.write((json.dumps(request) + '\n').encode())
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                raise CrawlDaemonError(f'{method}: daemon exited')
+            while True:
+                try:
+                    response = self.responses.get(timeout=timeout)
+                except queue.Empty:
+                    # * Chrome or the page is stuck. The next call starts a new daemon
+                    self._kill()
+                    raise CrawlDaemonError(f'{method}: no response after {timeout}s')
+                if response is None:
+                    raise CrawlDaemonError(f'{method}: daemon exited with {self.process.wait()}')
+                if response.get('id') == request_id:
+                    break
+            self.stats['jobs'] += 1
+            self.stats['job_time'] += response.get('time', 0) / 1000
+            if 'error' in response:
+                self.stats['errors'] += 1
+                raise CrawlDaemonError(f'{method}: {response["error"].get("message")}')
+            return response.get('result')
+
+    def record(self, argv) -> dict:
+        """argv of record.js. Returns {ts, url} of the recorded page"""
+        return self.call('record', {'argv': argv})
+
+    def replay(self, argv):
+        """argv of replay.js"""
+        return self.call('replay', {'argv': argv})
+
+    def reset(self):
+        """Close the browser, e.g. before its chrome_data is removed. No-op if the daemon isn't running"""
+        if not self.alive():
+            return
+        try:
+            self.call('close', timeout=60)
+        except CrawlDaemonError:
+            self._kill()
+
+    def stop(self):
+        if not self.alive():
+            return
+        try:
+            self.call('shutdown', timeout=60)
+            self.process.wait(timeout=10)
+        except (CrawlDaemonError, TimeoutExpired):
+            self._kill()
+        logging.info(f'CrawlDaemon {self.name}: Stopped, {self.stats}')
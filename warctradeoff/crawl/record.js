@@ -97,15 +97,12 @@ async function getActivePage(browser) {
 }
 /*
     Refer to README-->Record phase for the detail of this function
+    Records urlStr on browser (started with startChrome on chromeData), with options of recordReplayArgs.
+    Returns {ts, url} of the recorded page, and throws if the page can't be recorded.
+    Used by the CLI below, and by crawl_daemon.js on a browser that is kept across pages.
 */
-(async function(){
+async function recordPage(browser, chromeData, urlStr, options) {
     // * Step 0: Prepare for running
-    program = recordReplayArgs();
-    program
-        .argument("<url>")
-        .action(url => urlStr=url);
-    program.parse();
-    const options = program.opts();
     let dirname = options.dir;
     let filename = options.file;
     let scroll = options.scroll == true;
@@ -114,8 +111,6 @@ async function getActivePage(browser) {
     Archive = options.archive;
     ArchiveFile = (() => Archive.toLowerCase().replace(/ /g, '-'))();
     
-    const headless = options.headless ? "new": false;
-    const { browser, chromeData } = await startChrome(options.chrome_data, headless);
     downloadPath = options.download ? options.download : `${chromeData}/Downloads`;
     const url = new URL(urlStr);
     
@@ -292,12 +287,37 @@ async function getActivePage(browser) {
             adpt.writeAdapterInfo(dirname, filename);
 
         fs.writeFileSync(`${dirname}/${filename}_done`, "");
-        // ! Signal of the end of the program
-        console.log("recorded page:", JSON.stringify({ts: ts, url: recordURL}));
-    } catch (err) {
-        console.error(`Record exception on ${urlStr}: ${err.stack}`);
+        return {ts: ts, url: recordURL};
     } finally {
-        await browser.close();
-        process.exit();
+        // * Keep the browser clean for the next page when it is reused
+        if (!page.isClosed())
+            await page.close();
     }
-})()
\ No newline at end of file
+}
+
+if (require.main === module) {
+    (async function(){
+        program = recordReplayArgs();
+        program
+            .argument("<url>")
+            .action(url => urlStr=url);
+        program.parse();
+        const options = program.opts();
+        const headless = options.headless ? "new": false;
+        const { browser, chromeData } = await startChrome(options.chrome_data, headless);
+        try {
+            const { ts, url } = await recordPage(browser, chromeData, urlStr, options);
+            // ! Signal of the end of the program
+            console.log("recorded page:", JSON.stringify({ts: ts, url: url}));
+        } catch (err) {
+            console.error(`Record exception on ${urlStr}: ${err.stack}`);
+        } finally {
+            await browser.close();
+            process.exit();
+        }
+    })()
+}
+
+module.exports = {
+    recordPage
+}
@@ -23,19 +23,14 @@ const assert = require('assert');
 loggerizeConsole();
 const TIMEOUT = 60*1000;
 
-(async function(){
-    // * Step 0: Prepare for running
-    program = recordReplayArgs();
-    program
-        .argument("<url>")
-        .action(url => urlStr=url);
-    program.parse();
-    const options = program.opts();
+/*
+    Replays urlStr on browser (started with startChrome, with options.proxy as its proxy), with options of recordReplayArgs.
+    Throws if the page can't be replayed.
+    Used by the CLI below, and by crawl_daemon.js on a browser that is kept across pages.
+*/
+async function replayPage(browser, urlStr, options) {
     let dirname = options.dir;
     let filename = options.file;
-    
-    const headless = options.headless ? "new": false;
-    const { browser } = await startChrome(options.chrome_data, headless, options.proxy);
     const url = new URL(urlStr);
     
     if (!fs.existsSync(dirname))
@@ -169,10 +164,35 @@ const TIMEOUT = 60*1000;
         fs.writeFileSync(`${dirname}/${filename}_textualResources.json`, JSON.stringify(fetchedRS.textualResources, null, 2));       
         fs.writeFileSync(`${dirname}/${filename}_done`, "");
         
-    } catch (err) {
-        console.error(`Replay proxy=${options.proxy?true:false} exception on ${urlStr}: ${err.stack}`);
     } finally {
-        await browser.close();
-        process.exit();
+        // * Keep the browser clean for the next page when it is reused
+        if (!page.isClosed())
+            await page.close();
     }
-})()
\ No newline at end of file
+}
+
+if (require.main === module) {
+    (async function(){
+        // * Step 0: Prepare for running
+        program = recordReplayArgs();
+        program
+            .argument("<url>")
+            .action(url => urlStr=url);
+        program.parse();
+        const options = program.opts();
+        const headless = options.headless ? "new": false;
+        const { browser } = await startChrome(options.chrome_data, headless, options.proxy);
+        try {
+            await replayPage(browser, urlStr, options);
+        } catch (err) {
+            console.error(`Replay proxy=${options.proxy?true:false} exception on ${urlStr}: ${err.stack}`);
+        } finally {
+            await browser.close();
+            process.exit();
+        }
+    })()
+}
+
+module.exports = {
+    replayPage
+}
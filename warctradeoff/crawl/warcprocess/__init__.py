@@ -1,6 +1,8 @@
 from .warc_extract import list_static_warcs, extract_dynamic_warcs
 from .dynamic_other_extract import extract_dynamic_other_url_warcs
 from .static_warc_extract import extract_static_warcs
-from .valid_cached_warc_extract import extract_valid_cached_warcs
+from .valid_cached_warc_extract import extract_valid_cached_warcs, extract_valid_cached_warcs_multi, FreshnessTable
 from .resource_warc_extract import extract_resource_warcs, ResourceMatchType
-from .inferrable_warc_extract import extract_inferrable_warcs
\ No newline at end of file
+from .inferrable_warc_extract import extract_inferrable_warcs
+from .variant_warc_extract import extract_variants, StaticVariant, ResourceVariant, InferrableVariant, CacheVariant
+from .dedup import dedup_warcs
@@ -0,0 +1,167 @@
+"""
+Content-addressed payload deduplication across crawl timestamps of the same archive
+Each payload is stored once (in the first {archive_name}_{ts}.warc that has it, in ts order).
+Later captures with the same payload digest are rewritten as revisit records (identical-payload-digest profile)
+pointing back to it with WARC-Refers-To-Target-URI/Date and WARC-Refers-To-Filename.
+Revisits are resolved by warc_index.resolve_revisit (used by read_warc_responses, seek_record and IndexedResponses).
+
+The payload store ({archive_name}.payloads.json under warcs/{col}) remembers where each digest is first stored,
+and which WARCs are already deduplicated.
+Referenced WARCs should not be deleted or rewritten afterwards, otherwise the revisits become dangling.
+"""
+import logging
+import json
+import os
+from warcio.recordbuilder import RecordBuilder
+
+from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, warc_index, catalog, pool
+
+# * Records smaller than this are kept as is, since the revisit record itself takes a few hundred bytes
+MIN_DEDUP_LENGTH = 1024
+
+class PayloadStore:
+    def __init__(self, path):
+        self.path = path
+        self.warcs = {}
+        self.payloads = {}
+        if os.path.exists(path):
+            store = json.load(open(path, 'r'))
+            self.warcs = store['warcs']
+            self.payloads = store['payloads']
+
+    def deduped(self, warc) -> bool:
+        info = self.warcs.get(os.path.basename(warc))
+        if info is None:
+            return False
+        stat = os.stat(warc)
+        return info['size'] == stat.st_size and info['mtime'] == stat.st_mtime
+
+    def mark_deduped(self, warc):
+        stat = os.stat(warc)
+        self.warcs[os.path.basename(warc)] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def lookup(self, digest) -> "dict | None":
+        return self.payloads.get(digest)
+
+    def add(self, digest, warc, entry: warc_index.IndexEntry):
+        self.payloads[digest] = {
+            'warc': os.path.basename(warc),
+            'url': entry.url,
+            'date': entry.ts,
+        }
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        json.dump({'warcs': self.warcs, 'payloads': self.payloads}, open(tmp_path, 'w+'))
+        os.replace(tmp_path, self.path)
+
+
+def _refers_to_date(ts) -> str:
+    return f'{ts[:4]}-{ts[4:6]}-{ts[6:8]}T{ts[8:10]}:{ts[10:12]}:{ts[12:14]}Z'
+
+def dedup_warc(warc, store: PayloadStore) -> dict:
+    """
+    Rewrite duplicated responses in warc (already in store) as revisit records, and add new payloads to the store
+    Returns:
+        {'revisits': number of records rewritten, 'saved': bytes saved}
+    """
+    entries = sorted(warc_index.load_index(warc).entries, key=lambda e: e.offset)
+    dup_entries = {}
+    for entry in entries:
+        if entry.rec_type != 'response' or entry.digest is None:
+            continue
+        original = store.lookup(entry.digest)
+        if original is None:
+            store.add(entry.digest, warc, entry)
+        elif entry.length >= MIN_DEDUP_LENGTH and not (original['warc'] == os.path.basename(warc) and original['url'] == entry.url and original['date'] == entry.ts):
+            dup_entries[entry.offset] = original
+    if len(dup_entries) == 0:
+        return {'revisits': 0, 'saved': 0}
+
+    tmp_path = f'{warc}.dedup.tmp'
+    builder = RecordBuilder()
+    new_entries = []
+    with open(warc, 'rb') as iw, open(tmp_path, 'wb') as fw:
+        copier = warc_utils.WarcCopier(iw, fw)
+        for entry in entries:
+            if entry.offset not in dup_entries:
+                copier.copy([(entry.offset, entry.length)])
+                new_entries.append(entry)
+                continue
+            original = dup_entries[entry.offset]
+            record = warc_index.read_entry(warc, entry)
+            warc_headers_dict = {
+                'WARC-Date': record.rec_headers.get_header('WARC-Date'),
+                'WARC-Refers-To-Filename': original['warc'],
+            }
+            revisit = builder.create_revisit_record(entry.url,
+                                                    digest=entry.digest,
+                                                    refers_to_uri=original['url'],
+                                                    refers_to_date=_refers_to_date(original['date']),
+                                                    http_headers=record.http_headers,
+                                                    warc_headers_dict=warc_headers_dict)
+            copier.write(revisit)
+            new_entries.append(warc_index.entry_from_record(revisit, None))
+        spans = copier.close()
+    new_entries = [e._replace(offset=offset, length=length) for e, (offset, length) in zip(new_entries, spans)]
+    saved = os.path.getsize(warc) - os.path.getsize(tmp_path)
+    os.replace(tmp_path, warc)
+    warc_index.write_index(warc, new_entries)
+    return {'revisits': len(dup_entries), 'saved': saved}
+
+
+class WarcDeduplicator:
+    def __init__(self, archive_dir, col, archive_name):
+        self.archive_dir = archive_dir
+        self.col = col
+        self.archive_name = archive_name
+        self.dirr = f'{archive_dir}/writes/{col}/{archive_name}'
+        self.store = PayloadStore(f'{archive_dir}/warcs/{col}/{archive_name}.payloads.json')
+
+    def crawl_warcs(self) -> list:
+        """{archive_name}_{ts}.warc of all record timestamps, in ts order"""
+        metadata = json.load(open(f'{self.dirr}/metadata.json', 'r'))
+        warcs = []
+        for ts in sorted(metadata.get('record', {}).keys()):
+            warc = warc_utils.resolve_warc(f'{self.archive_dir}/warcs/{self.col}/{self.archive_name}_{ts}.warc')
+            if os.path.exists(warc):
+                warcs.append(warc)
+        return warcs
+
+    def dedup(self) -> "(str, dict) | None":
+        if not os.path.exists(f'{self.dirr}/metadata.json'):
+            logging.error("No metadata at the corresponding write directory")
+            return
+        stats = {'warcs': 0, 'revisits': 0, 'saved': 0}
+        for warc in self.crawl_warcs():
+            if self.store.deduped(warc):
+                continue
+            warc_stats = dedup_warc(warc, self.store)
+            self.store.mark_deduped(warc)
+            self.store.save()
+            catalog.update_warcs(self.col, [warc])
+            stats['warcs'] += 1
+            stats['revisits'] += warc_stats['revisits']
+            stats['saved'] += warc_stats['saved']
+            logging.info(f'WarcDeduplicator: Rewrote {warc_stats["revisits"]} records as revisits in {warc}, saved {warc_stats["saved"]} bytes')
+        return self.archive_name, stats
+
+
+def dedup_warc_worker(col, archive_name):
+    archive_dir = CONFIG.archive_dir
+    deduplicator = WarcDeduplicator(archive_dir, col, archive_name)
+    return deduplicator.dedup()
+
+
+def dedup_warcs(col, select_archives=None, num_workers=1, timeout=None) -> list:
+    """Deduplicate payloads across timestamps for each archive in col"""
+    dirrs = catalog.archive_dirs(col)
+    tasks = [{'col': col, 'archive_name': os.path.basename(dirr)} for dirr in dirrs
+             if select_archives is None or os.path.basename(dirr) in select_archives]
+
+    success = []
+    for _, res in pool.run_tasks(dedup_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        if res is not None:
+            success.append(res)
+    return success
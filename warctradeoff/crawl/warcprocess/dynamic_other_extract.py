@@ -2,11 +2,10 @@ import logging
 import os
 import json
 import random
-import glob
 from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
 
 from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, catalog, pool, url_filter
 from .warc_extract import BaseWarcExtractor
 from .valid_cached_warc_extract import valid_cached_warc_worker
 
@@ -14,7 +13,7 @@ class DynamicWarcOtherURLExtractor(BaseWarcExtractor):
     def __init__(self, archive_dir, col, archive_name, other_archive_names, file_suffix, file_prefix='record'):
         super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
         self.other_archive_names = other_archive_names
-        self.input_warcs = [f'{archive_dir}/warcs/{col}/{an}_{file_suffix}.warc' for an in other_archive_names]
+        self.input_warcs = [warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{an}_{file_suffix}.warc') for an in other_archive_names]
         self.dirrs = [f'{archive_dir}/writes/{col}/{an}' for an in other_archive_names]
 
     def extract(self) -> "(str, list) | None":
@@ -39,27 +38,35 @@ def dynamic_warc_other_url_worker(col, archive_name, other_archive_names, file_s
     return dyn_ou_extractor.extract()
 
 def valid_cached_warc_worker_adapter(col, archive_name, other_archive_names, file_suffix, static_ts):
-    archive_dir = CONFIG.archive_dir
     success_other_archive_names = []
     for oan in other_archive_names:
-        if os.path.exists(f'{archive_dir}/warcs/{col}/{oan}_{file_suffix}.{static_ts}.cache.warc'):
-            result = oan
-        else:
-            result = valid_cached_warc_worker(col, oan, file_suffix, static_ts)
+        result, _ = valid_cached_warc_worker(col, oan, file_suffix, static_ts)
         if result:
             success_other_archive_names.append(result)
     return archive_name, success_other_archive_names
 
 
-def extract_dynamic_other_url_warcs(col, file_suffix, static_extracted, file_prefix=None, num_others=1, cache_static_ts=None, num_workers=1) -> "list[(str, list[str])]":
-    """Extract dynamic warcs from other urls but under the same site"""
+def _may_contain_any(bloom, urls) -> bool:
+    return bloom is not None and any(url in bloom for url in urls)
+
+def extract_dynamic_other_url_warcs(col, file_suffix, static_extracted, file_prefix=None, num_others=1, cache_static_ts=None, num_workers=1,
+                                    match_urls=False) -> "list[(str, list[str])]":
+    """
+    Extract dynamic warcs from other urls but under the same site
+    Args:
+        match_urls: Only pick other archives whose warc may contain one of the urls in static_extracted[archive_name]
+                    (e.g. the resources excluded by extract_resource_warcs). Candidates are pruned on their URL filters
+                    (see url_filter), and sites are skipped on the filter over all their candidates, without opening the warcs
+    """
     target_hostnames = defaultdict(list)
     for an in static_extracted:
         hostname = an.split('_')[0]
         target_hostnames[hostname].append(an)
     target_archive_names = {random.choice(v): k for k, v in target_hostnames.items()}
+    hostname_targets = {v: k for k, v in target_archive_names.items()}
+    warc_dir = f'{CONFIG.archive_dir}/warcs/{col}'
 
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
+    dirrs = catalog.archive_dirs(col)
     hostname_dirrs_all = defaultdict(list)
     for dirr in dirrs:
         archive_name = os.path.basename(dirr)
@@ -69,11 +76,20 @@ def extract_dynamic_other_url_warcs(col, file_suffix, static_extracted, file_pre
         hostname_dirrs_all[hostname].append(dirr)
     hostname_dirrs = {}
     for hostname, dirrs in hostname_dirrs_all.items():
+        match = None
+        if match_urls:
+            match = static_extracted.get(hostname_targets.get(hostname)) or []
+            warcs = [f'{warc_dir}/{os.path.basename(d)}_{file_suffix}.warc' for d in dirrs]
+            if not _may_contain_any(url_filter.group_filter(warcs, url_filter.group_path(warc_dir, hostname, file_suffix)), match):
+                continue
         random.shuffle(dirrs)
         new_dirrs = []
         for dirr in dirrs:
             archive_name = os.path.basename(dirr)
-            if not os.path.exists(f'{CONFIG.archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'):
+            warc = warc_utils.resolve_warc(f'{warc_dir}/{archive_name}_{file_suffix}.warc')
+            if not os.path.exists(warc):
+                continue
+            if match is not None and not _may_contain_any(url_filter.warc_filter(warc), match):
                 continue
             # if not os.path.exists(f'{CONFIG.archive_dir}/writes/{col}/{archive_name}/replay-{file_suffix}_done'):
             #     continue
@@ -84,34 +100,25 @@ def extract_dynamic_other_url_warcs(col, file_suffix, static_extracted, file_pre
             continue
         hostname_dirrs[hostname] = new_dirrs[:num_others]
 
+    if cache_static_ts is None:
+        worker, worker_args = dynamic_warc_other_url_worker, {'file_prefix': file_prefix}
+    else:
+        worker, worker_args = valid_cached_warc_worker_adapter, {'static_ts': cache_static_ts}
+    tasks = []
+    for archive_name in target_archive_names:
+        hostname = archive_name.split('_')[0]
+        if hostname not in hostname_dirrs:
+            continue
+        dirrs = hostname_dirrs[hostname]
+        other_archive_names = [os.path.basename(dirr) for dirr in dirrs]
+        tasks.append({'col': col,
+                      'archive_name': archive_name,
+                      'other_archive_names': other_archive_names,
+                      'file_suffix': file_suffix,
+                      **worker_args})
+
     success = []
-    results = []
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        for archive_name in target_archive_names:
-            hostname = archive_name.split('_')[0]
-            if hostname not in hostname_dirrs:
-                continue
-            dirrs = hostname_dirrs[hostname]
-            other_archive_names = [os.path.basename(dirr) for dirr in dirrs]
-            if cache_static_ts is None:
-                results.append(executor.submit(dynamic_warc_other_url_worker,
-                                               col=col,
-                                               archive_name=archive_name,
-                                               other_archive_names=other_archive_names,
-                                               file_suffix=file_suffix,
-                                               file_prefix=file_prefix))
-            else:
-                results.append(executor.submit(valid_cached_warc_worker_adapter,
-                                                col=col,
-                                                archive_name=archive_name,
-                                                other_archive_names=other_archive_names,
-                                                file_suffix=file_suffix,
-                                                static_ts=cache_static_ts))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                print(f"Exception occurred: {e}", flush=True)
-    return success
\ No newline at end of file
+    for _, res in pool.run_tasks(worker, tasks, num_workers=num_workers):
+        if res is not None:
+            success.append(res)
+    return success
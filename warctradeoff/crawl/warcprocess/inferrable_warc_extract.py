@@ -1,58 +1,60 @@
 import logging
 import json
 import os
-import glob
 from urllib.parse import urlsplit, unquote
 from collections import defaultdict
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
-from concurrent.futures import ProcessPoolExecutor
 
 from .static_warc_extract import StaticWarcExtractor
-from .resource_warc_extract import ResourceMatchType, ResourceTypeWARCExtractor
+from .resource_warc_extract import ResourceMatchType, ResourceTypeWARCExtractor, ExcludeClassifier
+from .warc_extract import params_digest
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import url_utils
+from warctradeoff.utils import url_utils, warc_utils, warc_index, catalog, pool
 
 host_extractor = url_utils.HostExtractor()
 
 class InferrableWARCExtractor(StaticWarcExtractor):
     def __init__(self, archive_dir, col, archive_name, file_suffix,
                  resource_match_type: ResourceMatchType, non_inferrable_urls: list,
-                 file_prefix='record'):
+                 file_prefix='record', virtual=False):
         super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
         self.resource_match_type = resource_match_type
+        self.virtual = virtual
         self.non_inferrable_urls = non_inferrable_urls
-        self.input_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
         self.output_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.{resource_match_type.short_str("inferrable")}.warc'
 
+    def params(self) -> dict:
+        return {
+            'resource_match_type': str(self.resource_match_type),
+            'non_inferrable_urls': params_digest(self.non_inferrable_urls),
+            'virtual': self.virtual,
+        }
+
+    def classifier(self) -> ExcludeClassifier:
+        """Whether a record is a response to exclude. page_url, fetches and static_urls are set by inferrable_extract"""
+        return ExcludeClassifier(self.resource_match_type, self.page_url, self.fetches, self.static_urls,
+                                 only_urls=self.non_inferrable_urls)
+
     def inferrable_extract(self):
         metadata = json.load(open(f'{self.dirr}/metadata.json', 'r'))
-        fetches = {f['url']: f for f in json.load(open(f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_fetches.json'))}
-        page_url = metadata[self.file_prefix][self.file_suffix]['url']
-        static_urls = self.static_fetches(page_url)
-        input_num, output_num = 0, 0
-        include_urls, exclude_urls = set(), []
-        with open(self.input_warc, 'rb') as iw:
-            for record in ArchiveIterator(iw):
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                if record.rec_type == 'response':
-                    if not static_urls.get(url, True) \
-                       and not ResourceTypeWARCExtractor.target_resource(self.resource_match_type, 
-                                                                     url, page_url, record.http_headers,
-                                                                     fetches.get(url)) \
-                       and url in self.non_inferrable_urls:
-                        exclude_urls.append(url)
-                        continue
-                    include_urls.add(url)
-        with open(self.input_warc, 'rb') as iw, open(self.output_warc, 'wb') as fw:
-            writer = WARCWriter(fw)
-            for record in ArchiveIterator(iw):
-                input_num += record.rec_type == 'response'
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                if url in exclude_urls:
-                    continue
-                writer.write_record(record)
-                output_num += record.rec_type == 'response'
+        self.page_url = metadata[self.file_prefix][self.file_suffix]['url']
+        # * Classified fetches carry resourceType, which is what target_resource needs from a fetch
+        self.fetches = self.fetch_classification(self.page_url)
+        self.static_urls = {url: c['is_static'] for url, c in self.fetches.items()}
+        # * Large WARCs are scanned in parallel shards (see warc_index.scan_sharded)
+        scanned = warc_index.scan_sharded(self.input_warc, classify=self.classifier())
+        entries = [e for e, _ in scanned]
+        exclude_urls = [e.url for e, excluded in scanned if excluded]
+        if not warc_index.index_fresh(self.input_warc):
+            warc_index.write_index(self.input_warc, entries)
+        exclude_set = set(exclude_urls)
+        keep_entries = [e for e in entries if e.url not in exclude_set]
+        if self.virtual:
+            warc_index.write_exclusion_manifest(self.input_warc, self.output_warc, [e for e in entries if e.url in exclude_set])
+        else:
+            warc_index.write_filtered(self.input_warc, self.output_warc, keep_entries, compress=CONFIG.compress_warcs)
+        input_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in entries)
+        output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
         logging.info(f'InferrableWARCExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {self.output_warc}')
         return exclude_urls
     
@@ -71,16 +73,23 @@ class InferrableWARCExtractor(StaticWarcExtractor):
         return self.archive_name, exclude_urls
 
 
-def inferrable_warc_worker(col, archive_name, file_suffix, resource_match_type, non_inferrable_urls, file_prefix=None):
+def inferrable_warc_worker(col, archive_name, file_suffix, resource_match_type, non_inferrable_urls, file_prefix=None, virtual=False, force=False):
     archive_dir = CONFIG.archive_dir
     rtw_extractor = InferrableWARCExtractor(archive_dir, col, archive_name,
-                                          file_suffix, resource_match_type, non_inferrable_urls, file_prefix)
-    return rtw_extractor.extract()
+                                          file_suffix, resource_match_type, non_inferrable_urls, file_prefix,
+                                          virtual=virtual)
+    return rtw_extractor.extract_incremental(force=force)
 
 
-def extract_inferrable_warcs(col, file_suffix, resource_match_type, inferrable_file, select_archives=None, file_prefix=None, num_workers=1) -> "list[(str, list[str])]":
-    """Extract warcs that only contain certain types of resources (exclude certain types of resources)"""
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
+def extract_inferrable_warcs(col, file_suffix, resource_match_type, inferrable_file, select_archives=None, file_prefix=None, num_workers=1,
+                             virtual=False, force=False, timeout=None) -> "list[(str, list[str])]":
+    """
+    Extract warcs that only contain certain types of resources (exclude certain types of resources)
+    If virtual is set, only write exclusion manifests of the output warcs (see warc_index.write_exclusion_manifest)
+    Outputs that are up to date with their inputs and parameters are reused, unless force is set
+    timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    """
+    dirrs = catalog.archive_dirs(col)
     inferrable_list = json.load(open(inferrable_file, 'r'))
     inferrable_urls = defaultdict(lambda: {True: [], False: []})
     for inferrable_obj in inferrable_list:
@@ -91,23 +100,20 @@ def extract_inferrable_warcs(col, file_suffix, resource_match_type, inferrable_f
         select_archives = set([h for h in inferrable_urls])
     dirrs = [d for d in dirrs if os.path.basename(d) in select_archives]
 
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = []
-        success = []
-        for dirr in dirrs:
-            archive_name = os.path.basename(dirr) 
-            results.append(executor.submit(inferrable_warc_worker, 
-                                           col=col, 
-                                           archive_name=archive_name, 
-                                           file_suffix=file_suffix,
-                                           resource_match_type=resource_match_type,
-                                           non_inferrable_urls=inferrable_urls[archive_name][False],
-                                           file_prefix=file_prefix))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
-    return success
\ No newline at end of file
+    tasks = [{'col': col,
+              'archive_name': os.path.basename(dirr),
+              'file_suffix': file_suffix,
+              'resource_match_type': resource_match_type,
+              'non_inferrable_urls': inferrable_urls[os.path.basename(dirr)][False],
+              'file_prefix': file_prefix,
+              'virtual': virtual,
+              'force': force} for dirr in dirrs]
+
+    success = []
+    reused = 0
+    for _, (res, res_reused) in pool.run_tasks(inferrable_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        reused += res_reused
+        if res is not None:
+            success.append(res)
+    logging.info(f'extract_inferrable_warcs: Reused {reused} up-to-date outputs out of {len(tasks)}')
+    return success
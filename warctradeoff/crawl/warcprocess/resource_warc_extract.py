@@ -2,17 +2,14 @@ import logging
 import json
 import os
 import re
-import glob
 import datetime
 from enum import Enum
 from urllib.parse import urlsplit, unquote
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
-from concurrent.futures import ProcessPoolExecutor
 
 from .static_warc_extract import StaticWarcExtractor
+from .warc_extract import params_digest
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import url_utils
+from warctradeoff.utils import url_utils, warc_utils, warc_index, catalog, pool
 
 host_extractor = url_utils.HostExtractor()
 
@@ -66,19 +63,30 @@ class ResourceTypeWARCExtractor(StaticWarcExtractor):
     def __init__(self, archive_dir, col, archive_name, file_suffix,
                  resource_match_type: ResourceMatchType, failed_fetches=None,
                  num_throw_resources=float('inf'), run_id=None,
-                 file_prefix='record'):
+                 file_prefix='record', virtual=False):
         super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
         self.resource_match_type = resource_match_type
+        self.virtual = virtual
         self.failed_fetches = failed_fetches
         self.num_throw_resources = num_throw_resources
         self.run_id = run_id
-        self.input_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
         self.output_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.{resource_match_type.short_str(self.run_id)}.warc'
 
+    def params(self) -> dict:
+        return {
+            'resource_match_type': str(self.resource_match_type),
+            'failed_fetches': params_digest(self.failed_fetches),
+            'num_throw_resources': self.num_throw_resources,
+            'run_id': self.run_id,
+            'virtual': self.virtual,
+        }
+
     @staticmethod
     def target_resource(resource_match_type: ResourceMatchType,
                         url, page_url, response_headers,
                         fetch: None):
+        """fetch is either the entry in _fetches.json or in the classification sidecar (see StaticWarcExtractor.fetch_classification)"""
         def is_xhr(response_headers, fetch):
             xhr_keywords = ['json', 'plain']
             if fetch and fetch['resourceType'] in ['XHR', 'Fetch']:
@@ -120,25 +128,23 @@ class ResourceTypeWARCExtractor(StaticWarcExtractor):
         else:
             return True
 
+    def classifier(self) -> "ExcludeClassifier":
+        """Whether a record is a response to exclude. page_url, fetches and static_urls are set by resource_match_extract"""
+        return ExcludeClassifier(self.resource_match_type, self.page_url, self.fetches, self.static_urls,
+                                 skip_urls=self.failed_fetches)
+
     def resource_match_extract(self):
         metadata = json.load(open(f'{self.dirr}/metadata.json', 'r'))
-        fetches = {f['url']: f for f in json.load(open(f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_fetches.json'))}
-        page_url = metadata[self.file_prefix][self.file_suffix]['url']
-        static_urls = self.static_fetches(page_url)
-        input_num, output_num = 0, 0
-        include_urls, exclude_urls = set(), []
-        with open(self.input_warc, 'rb') as iw:
-            for record in ArchiveIterator(iw):
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                if record.rec_type == 'response':
-                    if not static_urls.get(url, True) \
-                       and not ResourceTypeWARCExtractor.target_resource(self.resource_match_type, 
-                                                                     url, page_url, record.http_headers,
-                                                                     fetches.get(url)) \
-                       and (self.failed_fetches is None or url not in self.failed_fetches):
-                        exclude_urls.append(url)
-                        continue
-                    include_urls.add(url)
+        self.page_url = metadata[self.file_prefix][self.file_suffix]['url']
+        # * Classified fetches carry resourceType, which is what target_resource needs from a fetch
+        self.fetches = self.fetch_classification(self.page_url)
+        self.static_urls = {url: c['is_static'] for url, c in self.fetches.items()}
+        # * Large WARCs are scanned in parallel shards (see warc_index.scan_sharded)
+        scanned = warc_index.scan_sharded(self.input_warc, classify=self.classifier())
+        entries = [e for e, _ in scanned]
+        exclude_urls = [e.url for e, excluded in scanned if excluded]
+        if not warc_index.index_fresh(self.input_warc):
+            warc_index.write_index(self.input_warc, entries)
         size = min(self.num_throw_resources, len(exclude_urls))
         if size == 0:
             logging.info(f'ResourceTypeWarcExtractor: No resources to exclude in {self.input_warc}')
@@ -151,15 +157,14 @@ class ResourceTypeWARCExtractor(StaticWarcExtractor):
             return []
         else:
             exclude_urls = exclude_urls[self.run_id]
-        with open(self.input_warc, 'rb') as iw, open(self.output_warc, 'wb') as fw:
-            writer = WARCWriter(fw)
-            for record in ArchiveIterator(iw):
-                input_num += record.rec_type == 'response'
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                if url in exclude_urls:
-                    continue
-                writer.write_record(record)
-                output_num += record.rec_type == 'response'
+        exclude_set = set(exclude_urls)
+        keep_entries = [e for e in entries if e.url not in exclude_set]
+        if self.virtual:
+            warc_index.write_exclusion_manifest(self.input_warc, self.output_warc, [e for e in entries if e.url in exclude_set])
+        else:
+            warc_index.write_filtered(self.input_warc, self.output_warc, keep_entries, compress=CONFIG.compress_warcs)
+        input_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in entries)
+        output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
         logging.info(f'ResourceTypeWarcExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {self.output_warc}')
         return exclude_urls
     
@@ -180,19 +185,51 @@ class ResourceTypeWARCExtractor(StaticWarcExtractor):
         return self.archive_name, exclude_urls
 
 
+class ExcludeClassifier:
+    """
+    classify of warc_index.scan_sharded for ResourceTypeWARCExtractor and InferrableWARCExtractor:
+    whether a record is a non-static response that is not a target resource.
+    Only keeps what it needs (fetches of non-static urls), as it is pickled for each shard
+    """
+    def __init__(self, resource_match_type, page_url, fetches, static_urls, only_urls=None, skip_urls=None):
+        self.resource_match_type = resource_match_type
+        self.page_url = page_url
+        self.fetches = {url: fetches.get(url) for url, is_static in static_urls.items() if not is_static}
+        # * Only exclude urls in only_urls (if set), and never exclude urls in skip_urls
+        self.only_urls = set(only_urls) if only_urls is not None else None
+        self.skip_urls = set(skip_urls or [])
+
+    def __call__(self, record) -> bool:
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        return record.rec_type in warc_utils.RESPONSE_TYPES \
+               and url in self.fetches \
+               and not ResourceTypeWARCExtractor.target_resource(self.resource_match_type,
+                                                                 url, self.page_url, record.http_headers,
+                                                                 self.fetches[url]) \
+               and url not in self.skip_urls \
+               and (self.only_urls is None or url in self.only_urls)
+
+
 def resource_warc_worker(col, archive_name, file_suffix, resource_match_type, 
-                         failed_fetches, num_throw_resources, run_id):
+                         failed_fetches, num_throw_resources, run_id, virtual=False, force=False):
     archive_dir = CONFIG.archive_dir
     rtw_extractor = ResourceTypeWARCExtractor(archive_dir, col, archive_name,
                                           file_suffix, resource_match_type, 
-                                          failed_fetches, num_throw_resources, run_id)
-    return rtw_extractor.extract()
+                                          failed_fetches, num_throw_resources, run_id,
+                                          virtual=virtual)
+    return rtw_extractor.extract_incremental(force=force)
 
 
 def extract_resource_warcs(col, file_suffix, resource_match_type, num_throw_resources=float('inf'), 
-                           run_id=None, failed_fetch_file=None, select_archives=None, num_workers=1) -> "list[(str, list[str])]":
-    """Extract warcs that only contain certain types of resources (exclude certain types of resources)"""
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
+                           run_id=None, failed_fetch_file=None, select_archives=None, num_workers=1,
+                           virtual=False, force=False, timeout=None) -> "list[(str, list[str])]":
+    """
+    Extract warcs that only contain certain types of resources (exclude certain types of resources)
+    If virtual is set, only write exclusion manifests of the output warcs (see warc_index.write_exclusion_manifest)
+    Outputs that are up to date with their inputs and parameters are reused, unless force is set
+    timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    """
+    dirrs = catalog.archive_dirs(col)
     failed_fetches = {}
     if failed_fetch_file is not None:
         failed_fetches = json.load(open(failed_fetch_file, 'r'))
@@ -203,27 +240,29 @@ def extract_resource_warcs(col, file_suffix, resource_match_type, num_throw_reso
         
     if select_archives is not None:
         dirrs = [d for d in dirrs if os.path.basename(d) in select_archives]
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = []
-        success = []
+
+    def tasks():
         for dirr in dirrs:
             archive_name = os.path.basename(dirr) 
             ff = failed_fetches.get(archive_name)
             if ff:
                 ff = [f['url'] for f in ff]
-            results.append(executor.submit(resource_warc_worker, 
-                                           col=col, 
-                                           archive_name=archive_name, 
-                                           file_suffix=file_suffix,
-                                           resource_match_type=resource_match_type,
-                                           failed_fetches=ff,
-                                           num_throw_resources=num_throw_resources,
-                                           run_id=run_id))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
-    return success
\ No newline at end of file
+            yield {'col': col,
+                   'archive_name': archive_name,
+                   'file_suffix': file_suffix,
+                   'resource_match_type': resource_match_type,
+                   'failed_fetches': ff,
+                   'num_throw_resources': num_throw_resources,
+                   'run_id': run_id,
+                   'virtual': virtual,
+                   'force': force}
+
+    success = []
+    reused = 0
+    for _, (res, res_reused) in pool.run_tasks(resource_warc_worker, tasks(), num_workers=num_workers,
+                                               timeout=timeout, total=len(dirrs)):
+        reused += res_reused
+        if res is not None:
+            success.append(res)
+    logging.info(f'extract_resource_warcs: Reused {reused} up-to-date outputs out of {len(dirrs)}')
+    return success
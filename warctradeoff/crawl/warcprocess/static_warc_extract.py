@@ -1,36 +1,42 @@
 import logging
 import json
 import os
-import glob
 from urllib.parse import urlsplit, unquote
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
-from concurrent.futures import ProcessPoolExecutor
 
 from warctradeoff.config import CONFIG
-from .warc_extract import BaseWarcExtractor
+from warctradeoff.utils import warc_utils, warc_index, catalog, pool
+from .warc_extract import BaseWarcExtractor, fingerprint
+
+CLASSIFICATION_SUFFIX = '_classification.json'
+# * initiator kinds (see StaticWarcExtractor.initiator_kind) of fetches that are static
+STATIC_INITIATOR_KINDS = ['other', 'document', 'stylesheet']
 
 class StaticWarcExtractor(BaseWarcExtractor):
     def __init__(self, archive_dir, col, archive_name, file_suffix, file_prefix='record'):
         super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
-        self.input_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
         self.output_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.static.warc'
 
     @staticmethod
-    def is_static(url, fetches, stackInfo, html_url):
+    def initiator_kind(url, fetches, stackInfo, html_url) -> str:
+        """
+        How the fetch of url is initiated:
+            'excluded' (never static, e.g. POST or blob:), 'other' (no JS stack),
+            'document' (the page itself), 'stylesheet' (a css) or 'script'
+        """
         target_fetch = fetches[url]
         
         exclude_method = ['POST']
         if target_fetch['method'] in exclude_method:
-            return False
+            return 'excluded'
 
         exclude_prefix = ['blob:', 'chrome-extension:', 'javascript:']
         for prefix in exclude_prefix:
             if url.startswith(prefix):
-                return False
+                return 'excluded'
 
         if len(stackInfo) == 0:
-            return True # * Likely to be initiated by Others, which is static
+            return 'other' # * Likely to be initiated by Others, which is static
         for request_stack in stackInfo:
             
             static_initiator_mime = ['css']
@@ -40,20 +46,46 @@ class StaticWarcExtractor(BaseWarcExtractor):
                 initiator_url = request_stack['callFrames'][0]['url']
                 # initiator_url = unquote(initiator_url)
                 if unquote(initiator_url) == html_url:
-                    return True # * Initiated by the page itself
+                    return 'document' # * Initiated by the page itself
                 initiator_fetch = fetches.get(initiator_url, {'mime': ''})
                 for sie in static_initiator_mime:
                     if sie in initiator_fetch['mime']:
-                        return True
+                        return 'stylesheet'
                 initiator_path = urlsplit(initiator_url).path
                 initiator_ext = os.path.splitext(initiator_path)[1]
                 if initiator_ext in static_initiator_ext:
-                    return True
-        return False
+                    return 'stylesheet'
+        return 'script'
 
-    def static_fetches(self, html_url) -> dict:
-        fetches = {f['url']: f for f in json.load(open(f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_fetches.json'))}
-        request_stacks = json.load(open(f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_requestStacks.json'))
+    @staticmethod
+    def is_static(url, fetches, stackInfo, html_url):
+        return StaticWarcExtractor.initiator_kind(url, fetches, stackInfo, html_url) in STATIC_INITIATOR_KINDS
+
+    def dependencies(self) -> list:
+        return [self.input_warc,
+                f'{self.dirr}/metadata.json',
+                self.fetches_path,
+                self.request_stacks_path]
+
+    @property
+    def fetches_path(self) -> str:
+        return f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_fetches.json'
+
+    @property
+    def request_stacks_path(self) -> str:
+        return f'{self.dirr}/{self.file_prefix}-{self.file_suffix}_requestStacks.json'
+
+    @property
+    def classification_path(self) -> str:
+        return f'{self.dirr}/{self.file_prefix}-{self.file_suffix}{CLASSIFICATION_SUFFIX}'
+
+    def load_fetches(self) -> dict:
+        return {f['url']: f for f in json.load(open(self.fetches_path))}
+
+    def classify_fetches(self, html_url) -> dict:
+        """{url: {is_static, resourceType, mime, method, initiator}} of each fetch (see initiator_kind)"""
+        fetches = self.load_fetches()
+        request_stacks = json.load(open(self.request_stacks_path))
         initiators = {}
         for rs in request_stacks:
             for url in rs['urls']:
@@ -61,28 +93,58 @@ class StaticWarcExtractor(BaseWarcExtractor):
                     initiators[url] = rs['stackInfo']
                 else:
                     initiators[url] = min([initiators[url], rs['stackInfo']], key=lambda x: len(x))
-        fetches_static = {}
+        classification = {}
         for fetch in fetches.values():
             url = fetch['url']
-            is_static = StaticWarcExtractor.is_static(url, fetches, initiators.get(url, []), html_url)
-            fetches_static[url] = is_static
-        return fetches_static
+            kind = StaticWarcExtractor.initiator_kind(url, fetches, initiators.get(url, []), html_url)
+            classification[url] = {
+                'is_static': kind in STATIC_INITIATOR_KINDS,
+                'resourceType': fetch.get('resourceType'),
+                'mime': fetch.get('mime'),
+                'method': fetch.get('method'),
+                'initiator': kind,
+            }
+        return classification
+
+    def fetch_classification(self, html_url) -> dict:
+        """
+        classify_fetches, persisted as a sidecar ({file_prefix}-{file_suffix}_classification.json) in the write directory
+        so that it is computed once for all extractors of the same crawl.
+        The sidecar is recomputed if fetches/requestStacks changed since it was written, or html_url is different
+        """
+        sources = {os.path.basename(path): fingerprint(path) for path in [self.fetches_path, self.request_stacks_path]}
+        if os.path.exists(self.classification_path):
+            try:
+                sidecar = json.load(open(self.classification_path, 'r'))
+                if sidecar['sources'] == json.loads(json.dumps(sources)) and sidecar['html_url'] == html_url:
+                    return sidecar['fetches']
+            except (json.JSONDecodeError, KeyError):
+                pass
+        classification = self.classify_fetches(html_url)
+        tmp_path = f'{self.classification_path}.tmp'
+        json.dump({'sources': sources, 'html_url': html_url, 'fetches': classification},
+                  open(tmp_path, 'w+'), separators=(',', ':'))
+        os.replace(tmp_path, self.classification_path)
+        return classification
+
+    def static_fetches(self, html_url) -> dict:
+        return {url: c['is_static'] for url, c in self.fetch_classification(html_url).items()}
 
     def static_warc(self):
         metadata = json.load(open(f'{self.dirr}/metadata.json'))
         url = metadata[self.file_prefix][self.file_suffix]['url']
         self.url = url
         include_urls = self.static_fetches(url)
-        input_num, output_num = 0, 0
-        with open(self.input_warc, 'rb') as iw, open(self.output_warc, 'wb') as fw:
-            writer = WARCWriter(fw)
-            for record in ArchiveIterator(iw):
-                input_num += record.rec_type == 'response'
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                if not include_urls.get(url, True):
-                    continue
-                writer.write_record(record)
-                output_num += record.rec_type == 'response'
+        if warc_index.index_fresh(self.input_warc):
+            entries = sorted(warc_index.load_index(self.input_warc).entries, key=lambda e: e.offset)
+        else:
+            # * Large WARCs are scanned in parallel shards (see warc_index.scan_sharded)
+            entries = [e for e, _ in warc_index.scan_sharded(self.input_warc)]
+            warc_index.write_index(self.input_warc, entries)
+        keep_entries = [e for e in entries if include_urls.get(e.url, True)]
+        warc_index.write_filtered(self.input_warc, self.output_warc, keep_entries, compress=CONFIG.compress_warcs)
+        input_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in entries)
+        output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
         logging.info(f'StaticWarcExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {self.output_warc}')
     
     def extract(self) -> "str, list | None":
@@ -100,30 +162,30 @@ class StaticWarcExtractor(BaseWarcExtractor):
         return self.archive_name, [self.url]
 
 
-def static_warc_worker(col, archive_name, file_suffix, file_prefix=None):
+def static_warc_worker(col, archive_name, file_suffix, file_prefix=None, force=False):
     archive_dir = CONFIG.archive_dir
     sw_extractor = StaticWarcExtractor(archive_dir, col, archive_name, file_suffix, file_prefix)
-    return sw_extractor.extract()
-
-
-def extract_static_warcs(col, file_suffix, file_prefix=None, num_workers=1) -> list:
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
-
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = []
-        success = []
-        for dirr in dirrs:
-            archive_name = os.path.basename(dirr) 
-            results.append(executor.submit(static_warc_worker, 
-                                           col=col, 
-                                           archive_name=archive_name, 
-                                           file_suffix=file_suffix,
-                                           file_prefix=file_prefix))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
-    return success
\ No newline at end of file
+    return sw_extractor.extract_incremental(force=force)
+
+
+def extract_static_warcs(col, file_suffix, file_prefix=None, num_workers=1, force=False, timeout=None) -> list:
+    """
+    Args:
+        force: Re-extract even if the output is up to date with its inputs
+        timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    """
+    dirrs = catalog.archive_dirs(col)
+    tasks = [{'col': col,
+              'archive_name': os.path.basename(dirr),
+              'file_suffix': file_suffix,
+              'file_prefix': file_prefix,
+              'force': force} for dirr in dirrs]
+
+    success = []
+    reused = 0
+    for _, (res, res_reused) in pool.run_tasks(static_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        reused += res_reused
+        if res is not None:
+            success.append(res)
+    logging.info(f'extract_static_warcs: Reused {reused} up-to-date outputs out of {len(tasks)}')
+    return success
@@ -1,17 +1,21 @@
 import logging
 import os
-import glob
+import json
 import datetime
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
-from concurrent.futures import ProcessPoolExecutor
 
 from warctradeoff.config import CONFIG
-from .warc_extract import BaseWarcExtractor
+from warctradeoff.utils import warc_utils, warc_index, catalog, pool
+from .warc_extract import BaseWarcExtractor, fingerprint, load_fresh_deps, write_deps
+
+FRESHNESS_SUFFIX = '.freshness.json'
+WINDOW_TS_FORMAT = '%Y%m%d%H%M%S'
+
+def parse_static_ts(static_ts: str) -> datetime.datetime:
+    return datetime.datetime.strptime(static_ts, '%Y%m%d%H%M').replace(tzinfo=datetime.timezone.utc)
 
 class CacheController:
     """Logic referred from github.com/psf/cachecontrol/blob/master/cachecontrol/controller.py"""
-    def __init__(self, warc_record, static_ts: datetime.datetime):
+    def __init__(self, warc_record, static_ts: datetime.datetime = None):
         self.warc_record = warc_record
         self.date = warc_record.rec_headers.get_header('WARC-Date')
         self.date = datetime.datetime.fromisoformat(self.date.rstrip('Z')).replace(tzinfo=datetime.timezone.utc)
@@ -59,15 +63,15 @@ class CacheController:
                     pass
         return retval
 
-    @property
-    def cacheable(self):
+    def freshness_window(self) -> "(datetime.datetime, datetime.datetime) | None":
+        """(fresh_from, fresh_until) of the response, or None if it is not cacheable"""
         self.cache_control = self.parse_cache_control()
         if not self.cache_control:
-            return False
+            return None
         if "no-store" in self.cache_control:
-            return False
+            return None
         if "*" in self.http_headers.get("vary", ""):
-            return False    
+            return None
         max_age = self.cache_control.get("max-age")
         expire_time = None
         if max_age is not None and max_age > 0:
@@ -78,26 +82,40 @@ class CacheController:
                 expire_time =datetime.datetime.strptime(expire_time, "%a, %d %b %Y %H:%M:%S GMT").replace(tzinfo=datetime.timezone.utc) 
             except:
                 expire_time = None
-        if expire_time and self.date <= self.static_ts <= expire_time:
+        if expire_time:
+            return self.date, expire_time
+        return None
+
+    @property
+    def cacheable(self):
+        window = self.freshness_window()
+        if window and window[0] <= self.static_ts <= window[1]:
             return True
 
 class ValidCachedWarcExtractor(BaseWarcExtractor):
     def __init__(self, archive_dir, col, archive_name, file_suffix, static_ts: str, file_prefix='record'):
         super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
-        self.static_ts = datetime.datetime.strptime(static_ts, '%Y%m%d%H%M').replace(tzinfo=datetime.timezone.utc)
-        self.input_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'
+        self.static_ts_str = static_ts
+        self.static_ts = parse_static_ts(static_ts)
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
         self.output_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.{static_ts}.cache.warc'
-        
+
+    def params(self) -> dict:
+        return {'static_ts': self.static_ts_str}
+
     def valid_cached_warc(self):
-        input_num, output_num = 0, 0
-        with open(self.input_warc, 'rb') as iw, open(self.output_warc, 'wb') as fw:
-            writer = WARCWriter(fw)
-            for record in ArchiveIterator(iw):
-                input_num += record.rec_type == 'response'
-                if record.rec_type == 'response' and not CacheController(record, self.static_ts).cacheable:
-                    continue
-                writer.write_record(record)
-                output_num += record.rec_type == 'response'
+        entries, drop_idxs = [], set()
+        with open(self.input_warc, 'rb') as iw:
+            for record, offset in warc_utils.iter_warc_records(iw):
+                if record.rec_type in warc_utils.RESPONSE_TYPES and not CacheController(record, self.static_ts).cacheable:
+                    drop_idxs.add(len(entries))
+                entries.append(warc_index.entry_from_record(record, offset))
+            spans = warc_utils.record_spans([e.offset for e in entries], os.fstat(iw.fileno()).st_size)
+        entries = [e._replace(length=length) for e, (_, length) in zip(entries, spans)]
+        keep_entries = [e for i, e in enumerate(entries) if i not in drop_idxs]
+        warc_index.write_filtered(self.input_warc, self.output_warc, keep_entries, compress=CONFIG.compress_warcs)
+        input_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in entries)
+        output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
         logging.info(f'ValidCachedWarcExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {self.output_warc}')
 
     def extract(self) -> "str | None":
@@ -107,30 +125,194 @@ class ValidCachedWarcExtractor(BaseWarcExtractor):
         self.valid_cached_warc()
         return self.archive_name
 
-def valid_cached_warc_worker(col, archive_name, file_suffix, static_ts):
+def valid_cached_warc_worker(col, archive_name, file_suffix, static_ts, force=False):
     archive_dir = CONFIG.archive_dir
     vcw_extractor = ValidCachedWarcExtractor(archive_dir, col, archive_name,
                                              file_suffix, static_ts)
-    return vcw_extractor.extract()
-
-def extract_valid_cached_warcs(col, file_suffix, static_ts, num_workers=1) -> list:
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
-
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = []
-        success = []
-        for dirr in dirrs:
-            archive_name = os.path.basename(dirr) 
-            results.append(executor.submit(valid_cached_warc_worker, 
-                                           col=col, 
-                                           archive_name=archive_name, 
-                                           file_suffix=file_suffix,
-                                           static_ts=static_ts))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
-    return success
\ No newline at end of file
+    return vcw_extractor.extract_incremental(force=force)
+
+def extract_valid_cached_warcs(col, file_suffix, static_ts, num_workers=1, force=False, timeout=None) -> list:
+    """
+    Args:
+        force: Re-extract even if the output is up to date with its inputs
+        timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    """
+    dirrs = catalog.archive_dirs(col)
+    tasks = [{'col': col,
+              'archive_name': os.path.basename(dirr),
+              'file_suffix': file_suffix,
+              'static_ts': static_ts,
+              'force': force} for dirr in dirrs]
+
+    success = []
+    reused = 0
+    for _, (res, res_reused) in pool.run_tasks(valid_cached_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        reused += res_reused
+        if res is not None:
+            success.append(res)
+    logging.info(f'extract_valid_cached_warcs: Reused {reused} up-to-date outputs out of {len(tasks)}')
+    return success
+
+class FreshnessTable:
+    """
+    (url, fresh_from, fresh_until) of every cacheable response in a WARC ({warc}.freshness.json)
+    Answers which responses are valid cache at any static_ts without reading the WARC again.
+    """
+    def __init__(self, windows: list):
+        # * [{url, offset, fresh_from, fresh_until}], where fresh_* are 14-digit timestamps
+        self.windows = windows
+
+    @staticmethod
+    def path(warc) -> str:
+        return f'{warc}{FRESHNESS_SUFFIX}'
+
+    @classmethod
+    def load(cls, warc) -> "FreshnessTable | None":
+        """Load the table of warc. Return None if missing or stale"""
+        path = cls.path(warc)
+        if not os.path.exists(path):
+            return None
+        table = json.load(open(path, 'r'))
+        if table['source'] != fingerprint(warc):
+            return None
+        return cls(table['windows'])
+
+    def save(self, warc):
+        tmp_path = f'{self.path(warc)}.tmp'
+        json.dump({'source': fingerprint(warc), 'windows': self.windows}, open(tmp_path, 'w+'))
+        os.replace(tmp_path, self.path(warc))
+
+    def _valid(self, static_ts) -> list:
+        ts = parse_static_ts(static_ts).strftime(WINDOW_TS_FORMAT)
+        return [w for w in self.windows if w['fresh_from'] <= ts <= w['fresh_until']]
+
+    def valid_urls(self, static_ts: str) -> set:
+        """URLs that have a response valid in cache at static_ts"""
+        return set(w['url'] for w in self._valid(static_ts))
+
+    def valid_offsets(self, static_ts: str) -> set:
+        return set(w['offset'] for w in self._valid(static_ts))
+
+
+class MultiCachedWarcExtractor(BaseWarcExtractor):
+    """
+    ValidCachedWarcExtractor for a list of static timestamps
+    The input WARC is read once, and each response's freshness window is parsed once.
+    Outputs are the same .{static_ts}.cache.warc as ValidCachedWarcExtractor (sharing its dependency manifests),
+    plus the FreshnessTable of the input WARC.
+    """
+    def __init__(self, archive_dir, col, archive_name, file_suffix, static_tss: list, table_only=False, file_prefix='record'):
+        super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
+        self.static_tss = static_tss
+        self.table_only = table_only
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
+
+    def ts_output_warc(self, static_ts) -> str:
+        return f'{self.archive_dir}/warcs/{self.col}/{self.archive_name}_{self.file_suffix}.{static_ts}.cache.warc'
+
+    def scan(self) -> "(list, list)":
+        """
+        Returns:
+            entries of the input WARC, and freshness window of each entry
+            (None for non-response records, False for responses that are not cacheable)
+        """
+        entries, windows = [], []
+        with open(self.input_warc, 'rb') as iw:
+            for record, offset in warc_utils.iter_warc_records(iw):
+                window = None
+                if record.rec_type in warc_utils.RESPONSE_TYPES:
+                    window = CacheController(record).freshness_window() or False
+                entries.append(warc_index.entry_from_record(record, offset))
+                windows.append(window)
+            spans = warc_utils.record_spans([e.offset for e in entries], os.fstat(iw.fileno()).st_size)
+        entries = [e._replace(length=length) for e, (_, length) in zip(entries, spans)]
+        if not warc_index.index_fresh(self.input_warc):
+            warc_index.write_index(self.input_warc, entries)
+        return entries, windows
+
+    def write_table(self, entries, windows):
+        table = FreshnessTable([{'url': e.url,
+                                 'offset': e.offset,
+                                 'fresh_from': w[0].strftime(WINDOW_TS_FORMAT),
+                                 'fresh_until': w[1].strftime(WINDOW_TS_FORMAT)}
+                                for e, w in zip(entries, windows) if w])
+        table.save(self.input_warc)
+
+    def write_ts_warc(self, static_ts, entries, windows):
+        static_dt = parse_static_ts(static_ts)
+        keep_entries = [e for e, w in zip(entries, windows) if w is None or (w and w[0] <= static_dt <= w[1])]
+        output_warc = self.ts_output_warc(static_ts)
+        warc_index.write_filtered(self.input_warc, output_warc, keep_entries, compress=CONFIG.compress_warcs)
+        input_num = sum(w is not None for w in windows)
+        output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
+        logging.info(f'MultiCachedWarcExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {output_warc}')
+
+    def extract(self) -> "dict | None":
+        result = self.extract_incremental(force=True)
+        return result[0] if result is not None else None
+
+    def extract_incremental(self, force=False) -> "(dict, int) | None":
+        """
+        Only write outputs that are not up to date
+        Returns:
+            ({static_ts: archive_name}, number of outputs reused from the last run)
+        """
+        if not os.path.exists(self.input_warc):
+            logging.error("No input warc file")
+            return
+        stale_tss = []
+        if not self.table_only:
+            for static_ts in self.static_tss:
+                fresh, _ = load_fresh_deps(self.ts_output_warc(static_ts), [self.input_warc], {'static_ts': static_ts})
+                if force or not fresh:
+                    stale_tss.append(static_ts)
+        table_fresh = not force and FreshnessTable.load(self.input_warc) is not None
+        reused = len(self.static_tss) - len(stale_tss) if not self.table_only else int(table_fresh)
+        if len(stale_tss) > 0 or not table_fresh:
+            entries, windows = self.scan()
+            self.write_table(entries, windows)
+            for static_ts in stale_tss:
+                self.write_ts_warc(static_ts, entries, windows)
+                write_deps(self.ts_output_warc(static_ts), [self.input_warc], {'static_ts': static_ts}, self.archive_name)
+            catalog.update_warcs(self.col, [self.ts_output_warc(static_ts) for static_ts in stale_tss])
+        if self.table_only:
+            return {}, reused
+        return {static_ts: self.archive_name for static_ts in self.static_tss}, reused
+
+
+def multi_cached_warc_worker(col, archive_name, file_suffix, static_tss, table_only=False, force=False):
+    archive_dir = CONFIG.archive_dir
+    mcw_extractor = MultiCachedWarcExtractor(archive_dir, col, archive_name,
+                                             file_suffix, static_tss, table_only)
+    return mcw_extractor.extract_incremental(force=force)
+
+def extract_valid_cached_warcs_multi(col, file_suffix, static_tss: list, table_only=False, num_workers=1, force=False,
+                                    timeout=None) -> "dict[str, list]":
+    """
+    Same as extract_valid_cached_warcs for each of static_tss, with one pass over each dynamic WARC
+    Args:
+        table_only: Only write the FreshnessTable of each WARC (query with FreshnessTable.load(warc).valid_urls(static_ts))
+        force: Re-extract even if the outputs are up to date with their inputs
+        timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    Returns:
+        {static_ts: [archive_name]}
+    """
+    dirrs = catalog.archive_dirs(col)
+    tasks = [{'col': col,
+              'archive_name': os.path.basename(dirr),
+              'file_suffix': file_suffix,
+              'static_tss': static_tss,
+              'table_only': table_only,
+              'force': force} for dirr in dirrs]
+
+    success = {static_ts: [] for static_ts in static_tss}
+    reused = 0
+    for _, res in pool.run_tasks(multi_cached_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        if res is None:
+            continue
+        res, res_reused = res
+        reused += res_reused
+        for static_ts, archive_name in res.items():
+            success[static_ts].append(archive_name)
+    logging.info(f'extract_valid_cached_warcs_multi: Reused {reused} up-to-date outputs')
+    return success
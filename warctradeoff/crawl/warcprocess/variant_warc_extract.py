@@ -0,0 +1,409 @@
+"""
+Extract multiple WARC variants (.static, .exjs, .exxhr, .inferrable, .{ts}.cache) from one dynamic WARC
+The input WARC is only decoded once. Each registered variant sees every record,
+and the kept records are then copied as raw byte ranges of the input.
+"""
+import logging
+import os
+import json
+from collections import defaultdict
+
+from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, warc_index, catalog, pool
+from .static_warc_extract import StaticWarcExtractor
+from .warc_extract import params_digest, load_fresh_deps, write_deps, write_filter
+from .resource_warc_extract import ResourceMatchType, ResourceTypeWARCExtractor
+from .valid_cached_warc_extract import CacheController, parse_static_ts
+
+class WarcVariant:
+    """
+    One output WARC of MultiVariantExtractor
+    The extractor calls start() for each archive, observe() for each record, and finish() after the pass.
+    """
+    need_metadata = True
+    # * Archive names the variant is extracted for, None for all archives
+    archives = None
+
+    def suffix(self) -> str:
+        raise NotImplementedError
+
+    def params(self) -> dict:
+        """Parameters that the output depends on (see BaseWarcExtractor.params)"""
+        return {}
+
+    def for_archive(self, archive_name) -> "WarcVariant":
+        """Return the variant with only the information needed by archive_name (to keep worker arguments small)"""
+        return self
+
+    def start(self, extractor):
+        self.extractor = extractor
+
+    def observe(self, idx, record, url):
+        pass
+
+    def finish(self, entries) -> "set | None":
+        """Return indexes of entries to drop, or None if the variant should not be written"""
+        return set()
+
+    def result(self):
+        return self.extractor.archive_name
+
+
+class StaticVariant(WarcVariant):
+    def suffix(self):
+        return 'static'
+
+    def finish(self, entries):
+        include_urls = self.extractor.static_urls
+        return {i for i, e in enumerate(entries) if not include_urls.get(e.url, True)}
+
+    def result(self):
+        return self.extractor.archive_name, [self.extractor.page_url]
+
+
+class ResourceVariant(WarcVariant):
+    """Same as ResourceTypeWARCExtractor"""
+    def __init__(self, resource_match_type: ResourceMatchType, failed_fetches=None,
+                 num_throw_resources=float('inf'), run_id=None):
+        self.resource_match_type = resource_match_type
+        # * {archive_name: [url]}
+        self.failed_fetches = failed_fetches
+        self.num_throw_resources = num_throw_resources
+        self.run_id = run_id
+
+    @classmethod
+    def from_file(cls, resource_match_type, failed_fetch_file, num_throw_resources=float('inf'), run_id=None):
+        failed_fetches = json.load(open(failed_fetch_file, 'r'))
+        failed_fetches = {f['hostname']: [ff['url'] for ff in f['missing_script']['failFetchScripts']] for f in failed_fetches}
+        variant = cls(resource_match_type, failed_fetches, num_throw_resources, run_id)
+        # * Same as extract_resource_warcs: only archives with failed fetches
+        variant.archives = set(failed_fetches)
+        return variant
+
+    def suffix(self):
+        return self.resource_match_type.short_str(self.run_id)
+
+    def params(self):
+        return {
+            'resource_match_type': str(self.resource_match_type),
+            'failed_fetches': params_digest(self.failed_fetches),
+            'num_throw_resources': self.num_throw_resources,
+            'run_id': self.run_id,
+        }
+
+    def for_archive(self, archive_name):
+        failed_fetches = None
+        if self.failed_fetches is not None:
+            failed_fetches = {archive_name: self.failed_fetches.get(archive_name)}
+        return ResourceVariant(self.resource_match_type, failed_fetches, self.num_throw_resources, self.run_id)
+
+    def start(self, extractor):
+        super().start(extractor)
+        self.exclude_urls = []
+        self.archive_failed_fetches = None
+        if self.failed_fetches is not None and self.failed_fetches.get(extractor.archive_name):
+            self.archive_failed_fetches = set(self.failed_fetches[extractor.archive_name])
+
+    def _excluded(self, record, url) -> bool:
+        return not self.extractor.static_urls.get(url, True) \
+               and not ResourceTypeWARCExtractor.target_resource(self.resource_match_type,
+                                                                 url, self.extractor.page_url, record.http_headers,
+                                                                 self.extractor.fetches.get(url)) \
+               and self._url_filter(url)
+
+    def _url_filter(self, url) -> bool:
+        return self.archive_failed_fetches is None or url not in self.archive_failed_fetches
+
+    def observe(self, idx, record, url):
+        if record.rec_type in warc_utils.RESPONSE_TYPES and self._excluded(record, url):
+            self.exclude_urls.append(url)
+
+    def finish(self, entries):
+        size = min(self.num_throw_resources, len(self.exclude_urls))
+        if size == 0:
+            logging.info(f'ResourceVariant: No resources to exclude in {self.extractor.input_warc}')
+            self.exclude_urls = []
+            return
+        exclude_urls = [self.exclude_urls[i:i+size] for i in range(0, len(self.exclude_urls), size)]
+        if self.run_id is None:
+            self.exclude_urls = exclude_urls[0]
+        elif self.run_id >= len(exclude_urls):
+            logging.info(f'ResourceVariant: run_id {self.run_id} exceeds the number of exclude urls')
+            self.exclude_urls = []
+            return
+        else:
+            self.exclude_urls = exclude_urls[self.run_id]
+        exclude_urls = set(self.exclude_urls)
+        return {i for i, e in enumerate(entries) if e.url in exclude_urls}
+
+    def result(self):
+        if len(self.exclude_urls) == 0:
+            return None
+        return self.extractor.archive_name, self.exclude_urls
+
+
+class InferrableVariant(ResourceVariant):
+    """Same as InferrableWARCExtractor"""
+    def __init__(self, resource_match_type: ResourceMatchType, non_inferrable_urls: dict):
+        super().__init__(resource_match_type)
+        # * {archive_name: [url]}
+        self.non_inferrable_urls = non_inferrable_urls
+
+    @classmethod
+    def from_file(cls, resource_match_type, inferrable_file):
+        non_inferrable_urls = defaultdict(list)
+        hostnames = set()
+        for inferrable_obj in json.load(open(inferrable_file, 'r')):
+            hostnames.add(inferrable_obj['hostname'])
+            if not inferrable_obj['inferrable']:
+                non_inferrable_urls[inferrable_obj['hostname']].append(inferrable_obj['url'])
+        variant = cls(resource_match_type, dict(non_inferrable_urls))
+        # * Same as extract_inferrable_warcs: only archives in the inferrable file
+        variant.archives = hostnames
+        return variant
+
+    def suffix(self):
+        return self.resource_match_type.short_str('inferrable')
+
+    def params(self):
+        return {
+            'resource_match_type': str(self.resource_match_type),
+            'non_inferrable_urls': params_digest(self.non_inferrable_urls),
+        }
+
+    def for_archive(self, archive_name):
+        return InferrableVariant(self.resource_match_type, {archive_name: self.non_inferrable_urls.get(archive_name, [])})
+
+    def start(self, extractor):
+        super().start(extractor)
+        self.archive_non_inferrable_urls = set(self.non_inferrable_urls.get(extractor.archive_name, []))
+
+    def _url_filter(self, url) -> bool:
+        return url in self.archive_non_inferrable_urls
+
+    def finish(self, entries):
+        exclude_urls = set(self.exclude_urls)
+        return {i for i, e in enumerate(entries) if e.url in exclude_urls}
+
+    def result(self):
+        return self.extractor.archive_name, self.exclude_urls
+
+
+class CacheVariant(WarcVariant):
+    """Same as ValidCachedWarcExtractor"""
+    need_metadata = False
+
+    def __init__(self, static_ts: str):
+        self.static_ts = static_ts
+        self.static_dt = parse_static_ts(static_ts)
+
+    def suffix(self):
+        return f'{self.static_ts}.cache'
+
+    def params(self):
+        return {'static_ts': self.static_ts}
+
+    def start(self, extractor):
+        super().start(extractor)
+        self.drop_idxs = set()
+
+    def observe(self, idx, record, url):
+        if record.rec_type not in warc_utils.RESPONSE_TYPES:
+            return
+        window = self.extractor.freshness_window(idx, record)
+        if not (window and window[0] <= self.static_dt <= window[1]):
+            self.drop_idxs.add(idx)
+
+    def finish(self, entries):
+        return self.drop_idxs
+
+
+def variant_from_str(variant: str) -> WarcVariant:
+    """
+    Parse variant by its output suffix: static, exjs, exxhr, exxhr1, exxhr3 (optionally with -{run_id}), {ts}.cache
+    Inferrable variants need the inferrable information, so they need to be constructed with InferrableVariant
+    """
+    if variant == 'static':
+        return StaticVariant()
+    if variant.endswith('.cache'):
+        return CacheVariant(variant[:-len('.cache')])
+    short_str, run_id = variant, None
+    if '-' in variant:
+        short_str, run_id = variant.split('-', 1)
+        run_id = int(run_id)
+    for resource_match_type in ResourceMatchType:
+        if short_str and resource_match_type.short_str() == short_str:
+            return ResourceVariant(resource_match_type, run_id=run_id)
+    raise ValueError(f"Unknown variant: {variant}")
+
+
+class MultiVariantExtractor(StaticWarcExtractor):
+    def __init__(self, archive_dir, col, archive_name, file_suffix, variants: "list[WarcVariant]", file_prefix='record', virtual=False):
+        super().__init__(archive_dir, col, archive_name, file_suffix, file_prefix)
+        self.variants = variants
+        self.virtual = virtual
+        self.input_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc')
+        self.page_url = None
+        self.fetches = {}
+        self.static_urls = {}
+        self._window = (None, None)
+
+    def variant_output_warc(self, variant: WarcVariant) -> str:
+        return f'{self.archive_dir}/warcs/{self.col}/{self.archive_name}_{self.file_suffix}.{variant.suffix()}.warc'
+
+    def freshness_window(self, idx, record):
+        """CacheController.freshness_window of the record, parsed once for all CacheVariants"""
+        if self._window[0] != idx:
+            self._window = (idx, CacheController(record).freshness_window())
+        return self._window[1]
+
+    def _load_metadata(self) -> bool:
+        if not os.path.exists(f'{self.dirr}/metadata.json'):
+            logging.error("No metadata at the corresponding write directory")
+            return False
+        metadata = json.load(open(f'{self.dirr}/metadata.json', 'r'))
+        if self.file_prefix not in metadata or self.file_suffix not in metadata['record']:
+            logging.error(f"No file suffix {self.file_suffix} found in metadata")
+            return False
+        self.page_url = metadata[self.file_prefix][self.file_suffix]['url']
+        self.fetches = self.fetch_classification(self.page_url)
+        self.static_urls = {url: c['is_static'] for url, c in self.fetches.items()}
+        return True
+
+    def variant_extract(self, variants) -> dict:
+        self._window = (None, None)
+        for variant in variants:
+            variant.start(self)
+        entries = []
+        with open(self.input_warc, 'rb') as iw:
+            for record, offset in warc_utils.iter_warc_records(iw):
+                url = record.rec_headers.get_header('WARC-Target-URI')
+                entries.append(warc_index.entry_from_record(record, offset))
+                for variant in variants:
+                    variant.observe(len(entries) - 1, record, url)
+            spans = warc_utils.record_spans([e.offset for e in entries], os.fstat(iw.fileno()).st_size)
+        entries = [e._replace(length=length) for e, (_, length) in zip(entries, spans)]
+        if not warc_index.index_fresh(self.input_warc):
+            warc_index.write_index(self.input_warc, entries)
+        input_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in entries)
+        results = {}
+        for variant in variants:
+            drop_idxs = variant.finish(entries)
+            if drop_idxs is not None:
+                keep_entries = [e for i, e in enumerate(entries) if i not in drop_idxs]
+                output_warc = self.variant_output_warc(variant)
+                if self.virtual:
+                    warc_index.write_exclusion_manifest(self.input_warc, output_warc, [e for i, e in enumerate(entries) if i in drop_idxs])
+                else:
+                    warc_index.write_filtered(self.input_warc, output_warc, keep_entries, compress=CONFIG.compress_warcs)
+                output_num = sum(e.rec_type in warc_utils.RESPONSE_TYPES for e in keep_entries)
+                logging.info(f'MultiVariantExtractor: Extracted {output_num} responses from {input_num} responses in {self.input_warc} to {output_warc}')
+            results[variant.suffix()] = variant.result()
+        return results
+
+    def extract(self) -> "dict | None":
+        if not os.path.exists(self.input_warc):
+            logging.error("No input warc file")
+            return
+        variants = self.variants
+        if any(v.need_metadata for v in variants) and not self._load_metadata():
+            variants = [v for v in variants if not v.need_metadata]
+        if len(variants) == 0:
+            return
+        return self.variant_extract(variants)
+
+    def variant_dependencies(self, variant: WarcVariant) -> list:
+        if variant.need_metadata:
+            return self.dependencies()
+        return [self.input_warc]
+
+    def variant_params(self, variant: WarcVariant) -> dict:
+        return json.loads(json.dumps({**variant.params(), 'virtual': self.virtual}))
+
+    def extract_incremental(self, force=False) -> "(dict | None, int)":
+        """
+        Only extract variants whose output is not up to date
+        Returns:
+            (results same as extract, number of variants reused from the last run)
+        """
+        results, stale_variants = {}, []
+        for variant in self.variants:
+            fresh, result = False, None
+            if not force:
+                fresh, result = load_fresh_deps(self.variant_output_warc(variant),
+                                                self.variant_dependencies(variant), self.variant_params(variant))
+            if fresh:
+                results[variant.suffix()] = result
+            else:
+                stale_variants.append(variant)
+        reused = len(self.variants) - len(stale_variants)
+        if len(stale_variants) == 0:
+            return results, reused
+        all_variants, self.variants = self.variants, stale_variants
+        stale_results = self.extract()
+        self.variants = all_variants
+        if stale_results is None:
+            return (results if len(results) > 0 else None), reused
+        for variant in stale_variants:
+            if variant.suffix() in stale_results:
+                write_deps(self.variant_output_warc(variant), self.variant_dependencies(variant),
+                           self.variant_params(variant), stale_results[variant.suffix()])
+                write_filter(self.variant_output_warc(variant))
+        catalog.update_warcs(self.col, [self.variant_output_warc(v) for v in stale_variants])
+        results.update(stale_results)
+        return results, reused
+
+
+def variant_warc_worker(col, archive_name, file_suffix, variants, file_prefix=None, virtual=False, force=False):
+    archive_dir = CONFIG.archive_dir
+    mv_extractor = MultiVariantExtractor(archive_dir, col, archive_name, file_suffix, variants, file_prefix, virtual)
+    return mv_extractor.extract_incremental(force=force)
+
+
+def extract_variants(col, file_suffix, variants: "list[WarcVariant | str]", file_prefix=None,
+                     select_archives=None, num_workers=1, virtual=False, force=False, timeout=None) -> "dict[str, list]":
+    """
+    Extract all variants of {archive_name}_{file_suffix}.warc in one pass per WARC
+    Args:
+        variants: WarcVariant objects, or their suffix string (see variant_from_str)
+                  Each variant is only extracted for the archives in its archives (if set)
+        virtual: Only write exclusion manifests of the outputs instead of copying the records
+        force: Re-extract variants even if their outputs are up to date with the inputs
+        timeout: Seconds an archive may take before it is given up on (see pool.run_tasks)
+    Returns:
+        {variant suffix: [result]}, where each result is the same as what the single-variant extract_* returns
+    """
+    variants = [variant_from_str(v) if isinstance(v, str) else v for v in variants]
+    dirrs = catalog.archive_dirs(col)
+    if select_archives is not None:
+        dirrs = [d for d in dirrs if os.path.basename(d) in select_archives]
+
+    archive_variants = {}
+    for dirr in dirrs:
+        archive_name = os.path.basename(dirr)
+        selected = [v for v in variants if v.archives is None or archive_name in v.archives]
+        if len(selected) > 0:
+            archive_variants[archive_name] = selected
+
+    def tasks():
+        for archive_name, selected in archive_variants.items():
+            yield {'col': col,
+                   'archive_name': archive_name,
+                   'file_suffix': file_suffix,
+                   'variants': [v.for_archive(archive_name) for v in selected],
+                   'file_prefix': file_prefix,
+                   'virtual': virtual,
+                   'force': force}
+
+    success = {v.suffix(): [] for v in variants}
+    reused = 0
+    for _, (res, res_reused) in pool.run_tasks(variant_warc_worker, tasks(), num_workers=num_workers,
+                                               timeout=timeout, total=len(archive_variants)):
+        reused += res_reused
+        if res is None:
+            continue
+        for suffix, variant_res in res.items():
+            if variant_res is not None:
+                success[suffix].append(variant_res)
+    logging.info(f'extract_variants: Reused {reused} up-to-date outputs out of {sum(len(v) for v in archive_variants.values())}')
+    return success
@@ -1,7 +1,67 @@
 import os
-import glob
+import json
+import hashlib
 
 from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, warc_index, catalog, url_filter
+
+# * Dependency manifest of an output warc: fingerprints of its inputs and the extraction parameters
+DEPS_SUFFIX = '.deps.json'
+
+def fingerprint(path) -> "dict | None":
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def output_fingerprint(output_warc) -> "dict | None":
+    """Fingerprint of output_warc, or of its exclusion manifest if it is virtual"""
+    if warc_index.is_virtual(output_warc):
+        return fingerprint(warc_index.manifest_path(output_warc))
+    return fingerprint(warc_utils.resolve_warc(output_warc))
+
+def params_digest(obj) -> str:
+    """Short digest of a (large) parameter such as a list of urls"""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+def deps_path(output_warc) -> str:
+    return f'{output_warc}{DEPS_SUFFIX}'
+
+def load_fresh_deps(output_warc, inputs, params) -> "(bool, object)":
+    """
+    Whether output_warc is up to date with inputs and params. If so, also return the recorded extraction result
+    Output is up to date only if none of the inputs, params or the output itself changed since write_deps
+    """
+    path = deps_path(output_warc)
+    if not os.path.exists(path):
+        return False, None
+    try:
+        deps = json.load(open(path, 'r'))
+    except Exception:
+        return False, None
+    if deps.get('params') != params:
+        return False, None
+    if deps.get('inputs') != {i: fingerprint(i) for i in inputs}:
+        return False, None
+    if deps.get('output') != output_fingerprint(output_warc):
+        return False, None
+    return True, deps.get('result')
+
+def write_filter(output_warc):
+    """Build the URL filter ({warc}.bloom, see url_filter) of output_warc along with it. Virtual outputs have none"""
+    if os.path.exists(warc_utils.resolve_warc(output_warc)):
+        url_filter.warc_filter(output_warc)
+
+def write_deps(output_warc, inputs, params, result):
+    deps = {
+        'inputs': {i: fingerprint(i) for i in inputs},
+        'params': params,
+        'output': output_fingerprint(output_warc),
+        'result': result,
+    }
+    tmp_path = f'{deps_path(output_warc)}.tmp'
+    json.dump(deps, open(tmp_path, 'w+'), indent=2)
+    os.replace(tmp_path, deps_path(output_warc))
 
 
 class BaseWarcExtractor:
@@ -18,31 +78,61 @@ class BaseWarcExtractor:
         else:
             self.file_prefix = 'replay'
 
+    def dependencies(self) -> list:
+        """Input files that the output depends on"""
+        return [self.input_warc]
+
+    def params(self) -> dict:
+        """Parameters that the output depends on"""
+        return {}
+
+    def extract(self):
+        raise NotImplementedError
+
+    def extract_incremental(self, force=False) -> "(object, bool)":
+        """
+        Extract only if the output is not up to date (see load_fresh_deps)
+        Returns:
+            (result of extract, whether the result is reused from the last run)
+        """
+        # * Round-trip params through json so that they compare equal to the recorded ones
+        inputs, params = self.dependencies(), json.loads(json.dumps(self.params()))
+        if not force:
+            fresh, result = load_fresh_deps(self.output_warc, inputs, params)
+            if fresh:
+                return result, True
+        result = self.extract()
+        if os.path.exists(self.input_warc):
+            write_deps(self.output_warc, inputs, params, result)
+        write_filter(self.output_warc)
+        catalog.update_warcs(self.col, [self.output_warc])
+        return result, False
+
 def extract_dynamic_warcs(col, file_suffix, selected_archives=None, num_workers=1) -> list:
     """Dummy functions, just get the available warcs"""
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
-
+    cat = catalog.get_catalog()
+    cat.refresh(col)
+    archive_names = set(cat.archive_names(col))
     success = []
-    for dirr in dirrs:
-        archive_name = os.path.basename(dirr)
+    for archive_name in sorted(set(w['archive_name'] for w in cat.warcs(col, file_suffix=file_suffix, variant=''))):
+        if archive_name not in archive_names:
+            continue
         if selected_archives is not None and archive_name not in selected_archives:
             continue
-        if os.path.exists(f'{CONFIG.archive_dir}/warcs/{col}/{archive_name}_{file_suffix}.warc'):
-            success.append(archive_name)
+        success.append(archive_name)
     return success
 
 def list_static_warcs(col, file_suffix, bypass_replay=False) -> list:
-    warcs = glob.glob(f'{CONFIG.archive_dir}/warcs/{col}/*_{file_suffix}.static.warc')
+    cat = catalog.get_catalog()
+    cat.refresh(col)
+    warcs = [w for w in cat.warcs(col, file_suffix=file_suffix, variant='static') if not w['virtual']]
     available_hostnames = set()
     if bypass_replay:
-        available_replays = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*/replay-{file_suffix}_done')
-        available_hostnames = set([os.path.dirname(r).split('/')[-1] for r in available_replays])
+        available_hostnames = set(cat.archive_names(col, done=[f'replay-{file_suffix}']))
     success = []
     for warc in warcs:
-        archive_name = os.path.basename(warc)
-        archive_name = archive_name.split('_')[:2]
-        archive_name = '_'.join(archive_name)
+        archive_name = warc['archive_name']
         if bypass_replay and archive_name not in available_hostnames:
             continue
         success.append((archive_name, []))
-    return success
\ No newline at end of file
+    return success
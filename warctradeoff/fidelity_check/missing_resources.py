@@ -2,7 +2,7 @@
 import json
 import os
 
-from warctradeoff.utils import url_utils, warc_utils
+from warctradeoff.utils import url_utils, warc_utils, url_filter
 
 
 def missing_scripts(writes_dir, dirr, LEFT, RIGHT):
@@ -49,8 +49,22 @@ def missing_updated_scripts(writes_dir, warc_dir, dirr, LEFT, RIGHT, left_ts, ri
     right_fail_fetches = json.load(open(f'{writes_dir}/{dirr}/{RIGHT}_exception_failfetch.json'))
     right_fail_fetches = {f['url']: f for obj in right_fail_fetches for f in obj['failedFetches']}
     
-    left_content = warc_utils.read_warc_responses(f'{warc_dir}/{dirr}_{left_ts}.warc')
-    right_content = warc_utils.read_warc_responses(f'{warc_dir}/{dirr}_{right_ts}.warc')
+    left_warc, right_warc = f'{warc_dir}/{dirr}_{left_ts}.warc', f'{warc_dir}/{dirr}_{right_ts}.warc'
+    # * Only XHRs archived in both crawls can have updated contents. The bloom filters rule out the others,
+    # * so the WARCs are only read if some XHR may be in both
+    left_bloom, right_bloom = url_filter.warc_filter(left_warc), url_filter.warc_filter(right_warc)
+    candidate_xhrs = set()
+    if left_bloom is not None and right_bloom is not None:
+        for right_fetch in right_fetches:
+            url = right_fetch['url']
+            if url not in right_fail_fetches and right_fetch['resourceType'] in ['XHR', 'Fetch'] \
+                and url in left_bloom and url in right_bloom:
+                candidate_xhrs.add(url)
+    left_content, right_content = {}, {}
+    if len(candidate_xhrs) > 0:
+        # * Only whether the contents intersect matters, so compare payload digests instead of payloads
+        left_content = warc_utils.read_warc_digests(left_warc)
+        right_content = warc_utils.read_warc_digests(right_warc)
     right_ff_scripts = {}
     for right_fetch in right_fetches:
         url = right_fetch['url']
@@ -68,7 +82,7 @@ def missing_updated_scripts(writes_dir, warc_dir, dirr, LEFT, RIGHT, left_ts, ri
             #     f['jscrawlMatch'] = 'netloc_dir'
             #     right_ff_scripts[(f['url'], f['method'])] = f
         elif right_fetch['resourceType'] in ['XHR', 'Fetch']:
-            url_strip = strip_url(url)
+            url_strip = warc_utils.strip_url(url)
             if url_strip in left_content and url_strip in right_content:
                 if len(left_content[url_strip] & right_content[url_strip]) <= 0:
                     right_ff_scripts[(url, right_fetch['method'])] = {
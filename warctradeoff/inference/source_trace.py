@@ -8,7 +8,7 @@ from urllib.parse import urlsplit, unquote
 from collections import defaultdict
 
 from warctradeoff.config import CONFIG
-from warctradeoff.utils import warc_utils, url_utils
+from warctradeoff.utils import warc_index, url_utils, url_filter
 
 WARC_PATH = f'{CONFIG.archive_dir}/warcs/{CONFIG.collection}'
 
@@ -19,10 +19,15 @@ def cache_read_warc(hostname, ts):
     path = f'{WARC_PATH}/{hostname}_{ts}.warc'
     if path in WARC_CACHE:
         return WARC_CACHE[path]
-    warc = warc_utils.read_warc_responses(path)
+    warc = warc_index.IndexedResponses(path)
     WARC_CACHE[path] = warc
     return warc
 
+def crawl_contains(hostname, ts, url) -> bool:
+    """Whether the crawl of hostname at ts has a response of url. Most misses are answered by the URL filter of the warc alone"""
+    path = f'{WARC_PATH}/{hostname}_{ts}.warc'
+    return url_filter.may_contain(path, url) and url in cache_read_warc(hostname, ts)
+
 def split_text(text):
     """Split text into words and filter out non-words"""
     # tokens = nltk.word_tokenize(text)
@@ -1,16 +1,13 @@
 import os, io
 import json
 import logging
-import glob
 from urllib.parse import quote
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
-from concurrent.futures import ProcessPoolExecutor
+from warcio.recordbuilder import RecordBuilder
 
 from warctradeoff.patch import match as patch_match
 from warctradeoff.patch import parse as patch_parse
 from warctradeoff.patch.initiator import build_initiators
-from warctradeoff.utils import logger, upload
+from warctradeoff.utils import logger, upload, warc_utils, warc_index, catalog, pool
 from warctradeoff.config import CONFIG
 
 class Patcher:
@@ -44,11 +41,9 @@ class Patcher:
         return quote(url, safe=':/?&=') # Encode URL to be valid for WARC
     
     def _get_html(self, warc, url):
-        with open(warc, 'rb') as iw:
-            for record in ArchiveIterator(iw):
-                if record.rec_type == 'response':
-                    if record.rec_headers.get('WARC-Target-URI') == url:
-                        return record.content_stream().read().decode()
+        record = warc_index.seek_record(warc, url)
+        if record is not None:
+            return record.content_stream().read().decode()
         raise Exception(f'Target URL not found in {warc} for {url}')
 
     def _get_page_ts(self, prefix):
@@ -71,7 +66,7 @@ class Patcher:
     
     @property
     def _patched_warc(self):
-        warc_dir, warc_file = os.path.split(self.static_warc)
+        warc_dir, warc_file = os.path.split(warc_utils.strip_gzip_suffix(self.static_warc))
         warc_file, _ = os.path.splitext(warc_file)
         return f'{warc_dir}/{warc_file}.patched.warc'
     
@@ -108,10 +103,19 @@ class Patcher:
         static_html = self.s_parser.replace_tags(s_taglists, d_taglists)
         static_html = static_html.encode('utf-8')
         static_html_length = str(len(static_html))
-        with open(self.static_warc, 'rb') as iw, open(self._patched_warc, 'wb') as fw:
-            writer = WARCWriter(fw)
-            for record in ArchiveIterator(iw):
-                if record.rec_type == 'response' and record.rec_headers.get('WARC-Target-URI') == self.s_page_url:
+        # * Only the page's response is re-serialized. All other records are copied as raw bytes
+        entries = sorted(warc_index.load_index(self.static_warc).entries, key=lambda e: e.offset)
+        warc_index.remove_outputs(self._patched_warc)
+        patched_warc = self._patched_warc
+        if CONFIG.compress_warcs:
+            patched_warc = f'{patched_warc}{warc_utils.GZIP_SUFFIX}'
+        with open(self.static_warc, 'rb') as iw, open(patched_warc, 'wb') as fw:
+            builder = RecordBuilder()
+            copier = warc_utils.WarcCopier(iw, fw, compress=CONFIG.compress_warcs)
+            patched_entries = []
+            for entry in entries:
+                if entry.rec_type in warc_utils.RESPONSE_TYPES and entry.url == self.s_page_url:
+                    record = warc_index.read_entry(self.static_warc, entry)
                     # Change content to s_html_new, and content-length
                     record.http_headers.replace_header('Content-Length', static_html_length)
                     warc_headers_dict = {
@@ -119,22 +123,26 @@ class Patcher:
                         'WARC-Target-URI': record.rec_headers.get('WARC-Target-URI'),
                         'WARC-Date': record.rec_headers.get('WARC-Date'),
                     }
-                    new_record = writer.create_warc_record(self.s_page_url,
-                                                            'response',
-                                                            payload=io.BytesIO(static_html),
-                                                            warc_headers_dict=warc_headers_dict,
-                                                            http_headers=record.http_headers)
-                    writer.write_record(new_record)
+                    new_record = builder.create_warc_record(self.s_page_url,
+                                                             'response',
+                                                             payload=io.BytesIO(static_html),
+                                                             warc_headers_dict=warc_headers_dict,
+                                                             http_headers=record.http_headers)
+                    copier.write(new_record)
+                    patched_entries.append(warc_index.entry_from_record(new_record, None))
                 else:
-                    writer.write_record(record)
-        return self._patched_warc
+                    copier.copy([(entry.offset, entry.length)])
+                    patched_entries.append(entry)
+            spans = copier.close()
+        warc_index.write_index(patched_warc, [e._replace(offset=offset, length=length) for e, (offset, length) in zip(patched_entries, spans)])
+        return patched_warc
 
 
 def patch_warc_worker(col, archive_name, dynamic_suffix, static_suffix):
     logging.info(f"Patching {archive_name}")
     archive_dir = CONFIG.archive_dir
-    dynamic_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{dynamic_suffix}.warc'
-    static_warc = f'{archive_dir}/warcs/{col}/{archive_name}_{static_suffix}.static.warc'
+    dynamic_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{dynamic_suffix}.warc')
+    static_warc = warc_utils.resolve_warc(f'{archive_dir}/warcs/{col}/{archive_name}_{static_suffix}.static.warc')
     if not os.path.exists(dynamic_warc) or not os.path.exists(static_warc):
         logging.error(f"No input warc file: dynamic={os.path.exists(dynamic_warc)} static={os.path.exists(static_warc)}")
         return
@@ -157,31 +165,23 @@ def patch_warc_worker(col, archive_name, dynamic_suffix, static_suffix):
             static_warc=static_warc
         )
         patcher.build_initiators()
-        patcher.patch()
+        patched_warc = patcher.patch()
+        catalog.update_warcs(col, [patched_warc])
         return archive_name
     except Exception as e:
         logging.error(f"Exception occurred in patching: {e}")
         return None
 
 
-def patch_warcs(col, dynamic_suffix, static_suffix, num_workers=1):
-    dirrs = glob.glob(f'{CONFIG.archive_dir}/writes/{col}/*')
+def patch_warcs(col, dynamic_suffix, static_suffix, num_workers=1, timeout=None):
+    dirrs = catalog.archive_dirs(col)
+    tasks = [{'col': col,
+              'archive_name': os.path.basename(dirr),
+              'dynamic_suffix': dynamic_suffix,
+              'static_suffix': static_suffix} for dirr in dirrs]
 
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = []
-        success = []
-        for dirr in dirrs:
-            archive_name = os.path.basename(dirr) 
-            results.append(executor.submit(patch_warc_worker, 
-                                           col=col, 
-                                           archive_name=archive_name,
-                                           dynamic_suffix=dynamic_suffix,
-                                           static_suffix=static_suffix))
-        for r in results:
-            try:
-                res = r.result()
-                if res is not None:
-                    success.append(res)
-            except Exception as e:
-                logging.error(f"Exception occurred: {e}")
-    return success
\ No newline at end of file
+    success = []
+    for _, res in pool.run_tasks(patch_warc_worker, tasks, num_workers=num_workers, timeout=timeout):
+        if res is not None:
+            success.append(res)
+    return success
@@ -1,6 +1,10 @@
-const { program } = require('commander');
+const { program: defaultProgram } = require('commander');
 
-function recordReplayArgs() {
+/**
+ * Options of record.js and replay.js
+ * @param {Command} program Program to add the options to. crawl_daemon.js passes a new one for each job
+ */
+function recordReplayArgs(program=defaultProgram) {
     program
         .option('-d --dir <directory>', 'Directory to save page info', 'pageinfo/test')
         .option('--download <downloadPath>', 'Directory to save downloads. If not specified, will be saved under chrome_data dir')
@@ -0,0 +1,356 @@
+"""
+SQLite catalog of crawl metadata and WARC inventory, so that scripts don't need to glob writes/{col}/* and warcs/{col}/*
+and load every metadata.json to find out what has been crawled and extracted.
+
+The catalog is a single database ({archive_dir}/catalog.sqlite, or the "catalog" config key) with tables:
+    archives: archive_name and hostname of each writes/{col}/{archive_name} directory
+    runs: page url and ts of each metadata[file_prefix][file_suffix], and whether {file_prefix}-{file_suffix}_done exists
+    artifacts: files under writes/{col}/{archive_name} and their sizes
+    warcs: warcs/{col}/{archive_name}_{file_suffix}[.{variant}].warc[.gz] and exclusion manifests of virtual warcs, with their sizes
+
+It is kept up to date incrementally:
+    - autorun.record_replay updates the archive it crawled, extractors/dedup/patch update the warcs they wrote.
+      Their pool workers hand the updates to the parent process (see pool.in_parent), which is the only one writing
+    - refresh(col) only lists a directory again if its mtime changed, and only reads the entries that appeared.
+      Archives are re-read when the mtime of their directory (e.g. a new _done file) or of their metadata.json changed,
+      which also picks up archives written by other hosts (e.g. remote crawls uploaded to this archive_dir).
+      refresh(col, full=True) re-reads everything (e.g. after files are changed outside of this package)
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from urllib.parse import urlsplit
+
+from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, warc_index, pool
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS archives (
+    col TEXT,
+    archive_name TEXT,
+    hostname TEXT,
+    metadata_mtime REAL,
+    PRIMARY KEY (col, archive_name)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    col TEXT,
+    archive_name TEXT,
+    file_prefix TEXT,
+    file_suffix TEXT,
+    ts TEXT,
+    url TEXT,
+    done INTEGER,
+    PRIMARY KEY (col, archive_name, file_prefix, file_suffix)
+);
+CREATE INDEX IF NOT EXISTS runs_by_suffix ON runs (col, file_prefix, file_suffix);
+CREATE TABLE IF NOT EXISTS artifacts (
+    col TEXT,
+    archive_name TEXT,
+    name TEXT,
+    size INTEGER,
+    PRIMARY KEY (col, archive_name, name)
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_name ON artifacts (col, name);
+CREATE TABLE IF NOT EXISTS warcs (
+    col TEXT,
+    name TEXT,
+    archive_name TEXT,
+    file_suffix TEXT,
+    variant TEXT,
+    compressed INTEGER,
+    virtual INTEGER,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (col, name)
+);
+CREATE INDEX IF NOT EXISTS warcs_by_archive ON warcs (col, archive_name, file_suffix);
+"""
+
+# * {archive_name}_{file_suffix}[.{variant}].warc[.gz], or the exclusion manifest of a virtual warc
+WARC_NAME = re.compile(r'^(?P<archive_name>.+)_(?P<file_suffix>\d{12})(?:\.(?P<variant>.+?))?\.warc'
+                       rf'(?P<gzip>{re.escape(warc_utils.GZIP_SUFFIX)})?(?P<manifest>{re.escape(warc_index.MANIFEST_SUFFIX)})?$')
+DONE_SUFFIX = '_done'
+# * Wait this long (seconds) for other connections (e.g. crawl or upload threads) holding the write lock
+BUSY_TIMEOUT = 60
+
+def catalog_path() -> str:
+    return CONFIG.config.get('catalog', f'{CONFIG.archive_dir}/catalog.sqlite')
+
+def parse_warc_name(name) -> "dict | None":
+    """archive_name, file_suffix, variant ('' for the crawled warc), compressed and virtual of a warc file name"""
+    m = WARC_NAME.match(name)
+    if m is None:
+        return None
+    return {
+        'archive_name': m.group('archive_name'),
+        'file_suffix': m.group('file_suffix'),
+        'variant': m.group('variant') or '',
+        'compressed': m.group('gzip') is not None,
+        'virtual': m.group('manifest') is not None,
+    }
+
+
+class Catalog:
+    def __init__(self, path=None, archive_dir=None):
+        self.path = path if path is not None else catalog_path()
+        self.archive_dir = archive_dir if archive_dir is not None else CONFIG.archive_dir
+        self.conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        self.conn.row_factory = sqlite3.Row
+        # * Readers don't block the writer (and the other way around), and writers wait for each other
+        self.conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def writes_dir(self, col) -> str:
+        return f'{self.archive_dir}/writes/{col}'
+
+    def warcs_dir(self, col) -> str:
+        return f'{self.archive_dir}/warcs/{col}'
+
+    def _dir_changed(self, path) -> "(bool, float | None)":
+        row = self.conn.execute('SELECT mtime FROM dirs WHERE path = ?', (path,)).fetchone()
+        mtime = os.stat(path).st_mtime if os.path.isdir(path) else None
+        return row is None or row['mtime'] != mtime, mtime
+
+    # * Updates
+    def update_archive(self, col, archive_name):
+        """Re-read metadata.json and the file listing of writes/{col}/{archive_name}"""
+        dirr = f'{self.writes_dir(col)}/{archive_name}'
+        with self.conn:
+            self.conn.execute('DELETE FROM runs WHERE col = ? AND archive_name = ?', (col, archive_name))
+            self.conn.execute('DELETE FROM artifacts WHERE col = ? AND archive_name = ?', (col, archive_name))
+            if not os.path.isdir(dirr):
+                self.conn.execute('DELETE FROM archives WHERE col = ? AND archive_name = ?', (col, archive_name))
+                self.conn.execute('DELETE FROM dirs WHERE path = ?', (dirr,))
+                return
+            # * Before the listing, so that files added while it is read change the mtime again
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (dirr, os.stat(dirr).st_mtime))
+            artifacts = {}
+            for entry in os.scandir(dirr):
+                if entry.is_file():
+                    artifacts[entry.name] = entry.stat().st_size
+            metadata, metadata_mtime = {}, None
+            if 'metadata.json' in artifacts:
+                metadata_mtime = os.stat(f'{dirr}/metadata.json').st_mtime
+                try:
+                    metadata = json.load(open(f'{dirr}/metadata.json', 'r'))
+                except json.JSONDecodeError as e:
+                    logging.error(f'Catalog: Cannot load metadata of {dirr}: {e}')
+            runs, hostname = [], None
+            for file_prefix, suffixes in metadata.items():
+                if not isinstance(suffixes, dict):
+                    continue
+                for file_suffix, info in suffixes.items():
+                    url = info.get('url')
+                    if hostname is None and url:
+                        hostname = urlsplit(url).hostname
+                    done = f'{file_prefix}-{file_suffix}{DONE_SUFFIX}' in artifacts
+                    runs.append((col, archive_name, file_prefix, file_suffix, info.get('ts'), url, done))
+            self.conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)',
+                              (col, archive_name, hostname, metadata_mtime))
+            self.conn.executemany('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)', runs)
+            self.conn.executemany('INSERT INTO artifacts VALUES (?, ?, ?, ?)',
+                                  [(col, archive_name, name, size) for name, size in artifacts.items()])
+
+    def update_warcs(self, col, warcs):
+        """
+        Re-stat warcs (paths or names under warcs/{col}).
+        A path without .gz also covers its gzip form and exclusion manifest, since an output may be written as either
+        """
+        names = set()
+        for warc in warcs:
+            name = os.path.basename(warc)
+            names.add(name)
+            if not name.endswith(warc_utils.GZIP_SUFFIX) and not name.endswith(warc_index.MANIFEST_SUFFIX):
+                names.update([f'{name}{warc_utils.GZIP_SUFFIX}', f'{name}{warc_index.MANIFEST_SUFFIX}'])
+        with self.conn:
+            self._update_warc_names(col, names)
+
+    def _update_warc_names(self, col, names):
+        warcs_dir = self.warcs_dir(col)
+        for name in names:
+            info = parse_warc_name(name)
+            if info is None:
+                continue
+            try:
+                stat = os.stat(f'{warcs_dir}/{name}')
+            except FileNotFoundError:
+                self.conn.execute('DELETE FROM warcs WHERE col = ? AND name = ?', (col, name))
+                continue
+            self.conn.execute('INSERT OR REPLACE INTO warcs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (col, name, info['archive_name'], info['file_suffix'], info['variant'],
+                               info['compressed'], info['virtual'], stat.st_size, stat.st_mtime))
+
+    def _archive_changed(self, col, archive_name, dir_mtimes, metadata_mtimes) -> bool:
+        dirr = f'{self.writes_dir(col)}/{archive_name}'
+        try:
+            if os.stat(dirr).st_mtime != dir_mtimes.get(dirr):
+                return True
+        except FileNotFoundError:
+            return True
+        # * metadata.json rewritten in place doesn't change the directory mtime
+        try:
+            return os.stat(f'{dirr}/metadata.json').st_mtime != metadata_mtimes.get(archive_name)
+        except FileNotFoundError:
+            return metadata_mtimes.get(archive_name) is not None
+
+    def refresh(self, col, full=False):
+        """
+        Pick up archives and warcs added, removed or changed since the last refresh.
+        writes/{col} and warcs/{col} are only listed again if their mtime changed, and each known archive
+        is only re-read if its directory or metadata.json changed. With full, every archive and warc is re-read.
+        """
+        start = time.time()
+        writes_dir = self.writes_dir(col)
+        changed, mtime = self._dir_changed(writes_dir)
+        known = set(r['archive_name'] for r in
+                    self.conn.execute('SELECT archive_name FROM archives WHERE col = ?', (col,)))
+        names = known
+        if changed or full:
+            names = set(os.listdir(writes_dir)) if mtime is not None else set()
+        if full:
+            stale = known | names
+        else:
+            dir_mtimes = {r['path']: r['mtime'] for r in
+                          self.conn.execute('SELECT path, mtime FROM dirs WHERE path LIKE ?', (f'{writes_dir}/%',))}
+            metadata_mtimes = {r['archive_name']: r['metadata_mtime'] for r in
+                               self.conn.execute('SELECT archive_name, metadata_mtime FROM archives WHERE col = ?', (col,))}
+            stale = (known - names) | (names - known)
+            stale |= set(a for a in names & known if self._archive_changed(col, a, dir_mtimes, metadata_mtimes))
+        for archive_name in stale:
+            self.update_archive(col, archive_name)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (writes_dir, mtime))
+
+        warcs_dir = self.warcs_dir(col)
+        changed, mtime = self._dir_changed(warcs_dir)
+        if changed or full:
+            names = set(os.listdir(warcs_dir)) if mtime is not None else set()
+            known = set(r['name'] for r in self.conn.execute('SELECT name FROM warcs WHERE col = ?', (col,)))
+            with self.conn:
+                self._update_warc_names(col, (known - names) | (names if full else names - known))
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (warcs_dir, mtime))
+        logging.info(f'Catalog: Refreshed {col} in {time.time() - start:.2f}s')
+
+    # * Queries
+    def archive_names(self, col, done=None, runs=None) -> list:
+        """
+        Archives in col, optionally only those with all of done ({file_prefix}-{file_suffix}_done exists)
+        and all of runs (metadata[file_prefix][file_suffix] exists)
+        e.g. archive_names(col, done=['record-202401010000', 'replay-202401020000'])
+        """
+        query, args = 'SELECT archive_name FROM archives WHERE col = ?', [col]
+        for run in done or []:
+            query += ' AND archive_name IN (SELECT archive_name FROM artifacts WHERE col = ? AND name = ?)'
+            args += [col, f'{run}{DONE_SUFFIX}']
+        for run in runs or []:
+            file_prefix, file_suffix = run.rsplit('-', 1)
+            query += ' AND archive_name IN (SELECT archive_name FROM runs WHERE col = ? AND file_prefix = ? AND file_suffix = ?)'
+            args += [col, file_prefix, file_suffix]
+        return sorted(r['archive_name'] for r in self.conn.execute(query, args))
+
+    def runs(self, col, file_prefix=None, file_suffix=None, archive_name=None) -> list:
+        """Rows of (archive_name, file_prefix, file_suffix, ts, url, done)"""
+        query, args = 'SELECT archive_name, file_prefix, file_suffix, ts, url, done FROM runs WHERE col = ?', [col]
+        for column, value in [('file_prefix', file_prefix), ('file_suffix', file_suffix), ('archive_name', archive_name)]:
+            if value is not None:
+                query += f' AND {column} = ?'
+                args.append(value)
+        return [dict(r) for r in self.conn.execute(query, args)]
+
+    def suffixes(self, col, file_prefix=None) -> list:
+        """All file suffixes (crawl timestamps) in col"""
+        query, args = 'SELECT DISTINCT file_suffix FROM runs WHERE col = ?', [col]
+        if file_prefix is not None:
+            query += ' AND file_prefix = ?'
+            args.append(file_prefix)
+        return sorted(r['file_suffix'] for r in self.conn.execute(query, args))
+
+    def artifacts(self, col, archive_name) -> dict:
+        """{file name: size} of writes/{col}/{archive_name}"""
+        return {r['name']: r['size'] for r in
+                self.conn.execute('SELECT name, size FROM artifacts WHERE col = ? AND archive_name = ?', (col, archive_name))}
+
+    def warcs(self, col, file_suffix=None, variant=None, archive_name=None) -> list:
+        """
+        Rows of (name, archive_name, file_suffix, variant, compressed, virtual, size) with path under warcs/{col}
+        variant is '' for the crawled warc, e.g. 'static' or '{static_ts}.cache' for extracted ones
+        """
+        query = 'SELECT name, archive_name, file_suffix, variant, compressed, virtual, size FROM warcs WHERE col = ?'
+        args = [col]
+        for column, value in [('file_suffix', file_suffix), ('variant', variant), ('archive_name', archive_name)]:
+            if value is not None:
+                query += f' AND {column} = ?'
+                args.append(value)
+        rows = []
+        for r in self.conn.execute(query, args):
+            r = dict(r)
+            r['path'] = f'{self.warcs_dir(col)}/{r["name"]}'
+            rows.append(r)
+        return rows
+
+    def total_size(self, col, variant=None) -> int:
+        query, args = 'SELECT COALESCE(SUM(size), 0) AS size FROM warcs WHERE col = ?', [col]
+        if variant is not None:
+            query += ' AND variant = ?'
+            args.append(variant)
+        return self.conn.execute(query, args).fetchone()['size']
+
+
+_CATALOGS = {}
+
+def get_catalog() -> Catalog:
+    """
+    Catalog of CONFIG.archive_dir, one connection per process and thread
+    (sqlite connections can't be shared across fork, nor used by another thread, e.g. crawl workers or uploaders)
+    """
+    key = (os.getpid(), threading.get_ident(), catalog_path())
+    if key not in _CATALOGS:
+        _CATALOGS[key] = Catalog()
+    return _CATALOGS[key]
+
+def archive_dirs(col, done=None, runs=None) -> list:
+    """Drop-in for glob.glob(f'{archive_dir}/writes/{col}/*'), from the catalog"""
+    catalog = get_catalog()
+    catalog.refresh(col)
+    return [f'{catalog.writes_dir(col)}/{a}' for a in catalog.archive_names(col, done=done, runs=runs)]
+
+def _update_archive(col, archive_name):
+    try:
+        get_catalog().update_archive(col, archive_name)
+    except sqlite3.Error as e:
+        logging.error(f'Catalog: Cannot update archive {col}/{archive_name}: {e}')
+
+def _update_warcs(col, warcs):
+    try:
+        get_catalog().update_warcs(col, warcs)
+    except sqlite3.Error as e:
+        logging.error(f'Catalog: Cannot update warcs in {col}: {e}')
+
+# * In pool.run_tasks workers, updates are made by the parent process once the task is done (see pool.in_parent)
+def update_archive(col, archive_name):
+    pool.in_parent(_update_archive, col, archive_name)
+
+def update_warcs(col, warcs):
+    pool.in_parent(_update_warcs, col, list(warcs))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Refresh the catalog of collections')
+    parser.add_argument('collections', nargs='+', help='Collections to refresh')
+    parser.add_argument('--full', action='store_true', help='If true, re-read every archive and warc')
+    args = parser.parse_args()
+    for col in args.collections:
+        get_catalog().refresh(col, full=args.full)
@@ -0,0 +1,205 @@
+"""
+FIFO lock of a pywb collection, built on fcntl.flock
+Waiters form a queue (as in a CLH lock): each takes a ticket, holds a flock on its own ticket file,
+and blocks (without polling) on the flock of its predecessor's ticket file. So the lock is granted in ticket order.
+
+The kernel drops the flocks of a process when it exits, so a holder that died usually never blocks the queue.
+Each ticket file records the pid and state of its owner, so a waiter can tell a released predecessor from a dead one,
+and skip predecessors that died before they got the lock.
+A flock outlives its owner if a child inherited the ticket file (e.g. a forked worker), so waiters also check that
+the owner's pid is still running, and take over its ticket once it is gone.
+
+Only depends on the standard library, so it can be copied to a remote host and run as a helper:
+    python collection_lock.py {lock_dir}
+prints "locked" once the lock is held, and holds it until stdin is closed (e.g. the SSH channel goes away).
+    python collection_lock.py {lock_dir} {command} [args ...]
+runs command under the lock instead, and exits with its status (e.g. as a step of a remote upload pipeline).
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import logging
+import threading
+
+QUEUE_DIR = 'lock.queue'
+COUNTER_FILE = 'counter'
+# * Waiters warn about the holder once they have waited this long (seconds)
+DEFAULT_LEASE = 600
+# * How often waiters check that the owner of the ticket they wait for is running (seconds)
+STALE_CHECK_INTERVAL = 1
+
+# * Wait time metrics of the locks acquired by this process
+LOCK_STATS = {'acquired': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+def record_wait(waited):
+    LOCK_STATS['acquired'] += 1
+    LOCK_STATS['wait_total'] += waited
+    LOCK_STATS['wait_max'] = max(LOCK_STATS['wait_max'], waited)
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CollectionLock:
+    def __init__(self, lock_dir, lease=DEFAULT_LEASE, name=None):
+        """
+        Args:
+            lock_dir: Directory to keep the queue in (e.g. the collection's directory)
+            lease: Seconds after which a waiter reports the holder as possibly stale.
+                A live holder's lock is never broken, only the ticket of an owner whose process is gone is taken over
+        """
+        self.queue_dir = f'{lock_dir}/{QUEUE_DIR}'
+        self.lease = lease
+        self.name = name or lock_dir
+        self.ticket = None
+        self.ticket_file = None
+
+    def _ticket_path(self, ticket) -> str:
+        return f'{self.queue_dir}/{ticket}'
+
+    def _write_state(self, state, waiting_for=None):
+        self.ticket_file.seek(0)
+        self.ticket_file.truncate()
+        self.ticket_file.write(json.dumps({'pid': os.getpid(), 'state': state, 'time': time.time(), 'waiting_for': waiting_for}))
+        self.ticket_file.flush()
+
+    def _take_ticket(self) -> int:
+        os.makedirs(self.queue_dir, exist_ok=True)
+        with open(f'{self.queue_dir}/{COUNTER_FILE}', 'a+') as counter:
+            fcntl.flock(counter, fcntl.LOCK_EX)
+            counter.seek(0)
+            content = counter.read().strip()
+            ticket = int(content) if content else 0
+            counter.seek(0)
+            counter.truncate()
+            counter.write(str(ticket + 1))
+            counter.flush()
+            # * The ticket file is locked before the counter is released, so a successor always finds it held
+            self.ticket_file = open(self._ticket_path(ticket), 'w')
+            fcntl.flock(self.ticket_file, fcntl.LOCK_EX)
+            self.ticket = ticket
+            self._write_state('waiting', waiting_for=ticket - 1)
+        return ticket
+
+    def _warn_stale(self, pred_path):
+        try:
+            holder = json.load(open(pred_path))
+        except (OSError, ValueError):
+            return
+        alive = 'alive' if _pid_alive(holder['pid']) else 'not running'
+        logging.warning(f'CollectionLock: Waited over {self.lease}s for {self.name}, '
+                        f'ticket {pred_path} is {holder["state"]} by pid {holder["pid"]} ({alive})')
+
+    def _owner_gone(self, pred_path) -> bool:
+        try:
+            owner = json.load(open(pred_path))
+        except (OSError, ValueError):
+            return False # * Not written yet
+        return not _pid_alive(owner['pid'])
+
+    def _lock_pred(self, pred_file, pred_path) -> str:
+        """
+        Block on the flock of pred's ticket file, and take it over if its owner is gone while the flock is still held
+        (see the module docstring). Returns the content of the ticket file, and closes pred_file
+        """
+        acquired = threading.Event()
+        guard = threading.Lock()
+        taken_over = False
+        def lock():
+            fcntl.flock(pred_file, fcntl.LOCK_EX)
+            with guard:
+                acquired.set()
+                if taken_over:
+                    pred_file.close()
+        # * flock can't be interrupted, so it blocks in a thread and is left behind if the ticket is taken over
+        thread = threading.Thread(target=lock, daemon=True)
+        thread.start()
+        start = time.time()
+        warned = self.lease is None
+        while not acquired.wait(STALE_CHECK_INTERVAL):
+            if not warned and time.time() - start >= self.lease:
+                self._warn_stale(pred_path)
+                warned = True
+            if self._owner_gone(pred_path):
+                with guard:
+                    if not acquired.is_set():
+                        taken_over = True
+                        logging.warning(f'CollectionLock: Owner of {pred_path} is gone but its flock is held, taking over')
+                        with open(pred_path) as f:
+                            return f.read()
+        thread.join()
+        with pred_file:
+            content = pred_file.read()
+            fcntl.flock(pred_file, fcntl.LOCK_UN)
+        return content
+
+    def _wait_for(self, pred):
+        """Block until ticket pred and every live ticket before it are done"""
+        while pred is not None and pred >= 0:
+            self._write_state('waiting', waiting_for=pred)
+            pred_path = self._ticket_path(pred)
+            try:
+                pred_file = open(pred_path, 'r')
+            except FileNotFoundError:
+                return # * Removed by its successor, so everything up to pred is done
+            try:
+                state = json.loads(self._lock_pred(pred_file, pred_path) or '{}')
+            except ValueError:
+                state = {}
+            if os.path.exists(pred_path):
+                os.remove(pred_path)
+            if state.get('state') == 'waiting':
+                # * pred died before it got the lock, so the ticket it was waiting for may still be ahead
+                pred = state.get('waiting_for')
+                continue
+            if state.get('state') == 'held':
+                logging.warning(f'CollectionLock: Holder pid {state.get("pid")} of {self.name} exited without releasing')
+            return
+
+    def acquire(self) -> float:
+        """Block until the lock is held. Returns the seconds waited"""
+        start = time.time()
+        ticket = self._take_ticket()
+        self._wait_for(ticket - 1)
+        self._write_state('held')
+        waited = time.time() - start
+        record_wait(waited)
+        logging.info(f'CollectionLock: Acquired {self.name} (ticket {ticket}) after waiting {waited:.2f}s')
+        return waited
+
+    def release(self):
+        if self.ticket_file is None:
+            return
+        self._write_state('released')
+        fcntl.flock(self.ticket_file, fcntl.LOCK_UN)
+        self.ticket_file.close()
+        self.ticket_file = None
+        self.ticket = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+if __name__ == '__main__':
+    lock = CollectionLock(sys.argv[1])
+    lock.acquire()
+    try:
+        if len(sys.argv) > 2:
+            import subprocess
+            sys.exit(subprocess.call(sys.argv[2:]))
+        print('locked', flush=True)
+        sys.stdin.read()
+    finally:
+        lock.release()
@@ -3,7 +3,11 @@ const originalError = console.error;
 const originalWarn = console.warn;
 const originalInfo = console.info;
 
-function loggerizeConsole() {
+/**
+ * Prefix console output with a timestamp and level
+ * @param {boolean} toStderr Write all levels to stderr (e.g. when stdout carries crawl_daemon.js's messages)
+ */
+function loggerizeConsole(toStderr=false) {
     function getCurrentTimestamp() {
         const now = new Date();
         const year = now.getFullYear();
@@ -16,8 +20,11 @@ function loggerizeConsole() {
         return `${year}-${month}-${day} ${hours}:${minutes}:${seconds}`;
     }
 
+    const log = toStderr ? originalError : originalLog;
+    const warn = toStderr ? originalError : originalWarn;
+    const info = toStderr ? originalError : originalInfo;
     console.log = (...args) => {
-        originalLog(`[${getCurrentTimestamp()} INFO JS]`, ...args);
+        log(`[${getCurrentTimestamp()} INFO JS]`, ...args);
     };
 
     console.error = (...args) => {
@@ -25,11 +32,11 @@ function loggerizeConsole() {
     };
 
     console.warn = (...args) => {
-        originalWarn(`[${getCurrentTimestamp()} WARN JS]`, ...args);
+        warn(`[${getCurrentTimestamp()} WARN JS]`, ...args);
     };
 
     console.info = (...args) => {
-        originalInfo(`[${getCurrentTimestamp()} INFO JS]`, ...args);
+        info(`[${getCurrentTimestamp()} INFO JS]`, ...args);
     };
 }
 
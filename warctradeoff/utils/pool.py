@@ -0,0 +1,325 @@
+"""
+Process pool runner shared by the per-archive pools (extract_*, dedup_warcs, patch_warcs)
+Each worker process is only handed a task once it is idle, and results are yielded as soon as they complete,
+so a slow early task doesn't hold back the others and pending arguments don't pile up in memory.
+A task that runs longer than the timeout gets its worker killed and replaced right away.
+Workers run in their own process groups, out of reach of a Ctrl-C at the terminal, so the parent kills their groups
+when it gets SIGINT/SIGTERM or exits.
+
+Each worker gets a share of the CPUs (worker_budget) for its own parallel work, e.g. warc_index.scan_sharded,
+so that nested pools don't multiply into more processes than CPUs.
+Workers can leave calls to the parent process (in_parent), e.g. writes to the catalog, so that only one process writes.
+
+run_slots is the thread counterpart for long-lived workers that each own resources
+(e.g. a browser profile and a replay server in autorun.record_replay_all_urls_multi).
+"""
+import os
+import time
+import atexit
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+
+# * Seconds between progress reports
+PROGRESS_INTERVAL = 60
+# * Seconds an idle worker has to exit at the end of run_tasks before it is killed
+SHUTDOWN_TIMEOUT = 10
+
+# * Process groups of the live run_tasks workers of this process
+_worker_groups = set()
+# * Handlers of SIGINT/SIGTERM before _install_handlers, called after the worker groups are killed
+_previous_handlers = {}
+
+# * Processes the current run_tasks worker may use, set by _init_worker. None outside of run_tasks
+_worker_budget = None
+# * Calls the current run_tasks worker leaves to its parent (see in_parent). None outside of run_tasks
+_parent_calls = None
+
+def _init_worker(budget):
+    global _worker_budget, _parent_calls
+    _worker_budget = budget
+    _parent_calls = []
+
+def in_parent(fn, *args):
+    """
+    Call fn(*args) in the parent process. In a run_tasks worker, the call is sent back with the result of the
+    current task and made by the parent, otherwise it is made right away. fn and args need to be picklable
+    """
+    if _parent_calls is None:
+        return fn(*args)
+    _parent_calls.append((fn, args))
+
+def _take_parent_calls() -> list:
+    calls = _parent_calls[:]
+    _parent_calls.clear()
+    return calls
+
+def _run_parent_calls(name, calls):
+    for fn, args in calls:
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.error(f'{name}: Exception occurred on {fn.__name__}{args}: {e}')
+
+def worker_budget(default=None) -> int:
+    """
+    Number of processes the caller may use for its own parallel work (including itself)
+    In a run_tasks worker, this is its share of the CPUs. Otherwise default, capped at the number of CPUs
+    """
+    if _worker_budget is not None:
+        return _worker_budget
+    cpus = os.cpu_count() or 1
+    return cpus if default is None else max(1, min(default, cpus))
+
+
+def _kill_worker_groups():
+    for pgid in list(_worker_groups):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    _worker_groups.clear()
+
+def _on_signal(signum, frame):
+    _kill_worker_groups()
+    previous = _previous_handlers.get(signum)
+    if previous == signal.SIG_IGN:
+        return
+    if callable(previous):
+        previous(signum, frame)
+    else:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+def _install_handlers():
+    """Kill the worker groups on SIGINT/SIGTERM and at exit. Signal handlers can only be set from the main thread"""
+    if len(_previous_handlers) > 0 or threading.current_thread() is not threading.main_thread():
+        return
+    atexit.register(_kill_worker_groups)
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        _previous_handlers[signum] = signal.getsignal(signum)
+        signal.signal(signum, _on_signal)
+
+def _task_worker(fn, conn, budget):
+    """Worker process of run_tasks: run fn(**task) for each task received on conn, and send back its start time and result"""
+    # * In its own process group, so that killing it also kills the processes it started (e.g. shard workers)
+    os.setpgid(0, 0)
+    # * The groups and handlers of the parent are not this worker's
+    _worker_groups.clear()
+    for signum, handler in _previous_handlers.items():
+        signal.signal(signum, handler if handler is not None else signal.SIG_DFL)
+    _previous_handlers.clear()
+    _init_worker(budget)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        conn.send(('start', time.time(), None))
+        try:
+            result = fn(**task)
+            conn.send(('done', result, _take_parent_calls()))
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}', _take_parent_calls()))
+
+
+class _TaskWorker:
+    def __init__(self, fn, budget):
+        self.conn, child_conn = multiprocessing.Pipe()
+        # * Not daemonic, so that tasks can start their own pools
+        self.process = multiprocessing.Process(target=_task_worker, args=(fn, child_conn, budget))
+        self.process.start()
+        # * Also set here, so that the group exists before kill (the child may not have run setpgid yet)
+        try:
+            os.setpgid(self.process.pid, self.process.pid)
+        except OSError:
+            pass
+        _worker_groups.add(self.process.pid)
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def submit(self, task):
+        self.task, self.started = task, None
+        self.conn.send(task)
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.join()
+        self.conn.close()
+        _worker_groups.discard(self.process.pid)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+            _worker_groups.discard(self.process.pid)
+
+
+def run_tasks(fn, tasks, num_workers=1, timeout=None, name=None, total=None):
+    """
+    Run fn(**task) for each task (dict of keyword arguments) in a pool of num_workers processes
+    Args:
+        timeout: Seconds a task may run (from when a worker starts it) before its worker is killed and replaced
+        name: Name in progress reports (default: fn.__name__)
+        total: Number of tasks, for progress reports when tasks is a generator
+    Yields:
+        (task, result) in the order tasks complete. Tasks that raise, time out or crash their worker are logged and skipped
+    """
+    name = name or fn.__name__
+    if total is None and hasattr(tasks, '__len__'):
+        total = len(tasks)
+    tasks = iter(tasks)
+    stats = {'done': 0, 'failed': 0, 'timeout': 0}
+    start = last_report = time.time()
+
+    def report(final=False):
+        elapsed = time.time() - start
+        finished = stats['done'] + stats['failed'] + stats['timeout']
+        progress = f'{finished}/{total}' if total is not None else f'{finished}'
+        logging.info(f'{name}: {"Finished" if final else "Progress"} {progress} tasks in {elapsed:.0f}s '
+                     f'({finished / max(elapsed, 1e-6):.2f}/s), {stats["failed"]} failed, {stats["timeout"]} timed out')
+
+    _install_handlers()
+    # * The budget of this process is split among its workers
+    budget = max(1, worker_budget() // num_workers)
+    workers = [_TaskWorker(fn, budget) for _ in range(num_workers)]
+    try:
+        exhausted = False
+        while True:
+            for worker in workers:
+                if worker.task is None and not exhausted:
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    worker.submit(task)
+            busy = [w for w in workers if w.task is not None]
+            if len(busy) == 0:
+                break
+            wait_time = PROGRESS_INTERVAL if timeout is None else min(PROGRESS_INTERVAL, timeout)
+            ready = wait([w.conn for w in busy], timeout=wait_time)
+            now = time.time()
+            for i, worker in enumerate(workers):
+                if worker.task is None:
+                    continue
+                task = worker.task
+                if worker.conn in ready:
+                    try:
+                        kind, value, calls = worker.conn.recv()
+                    except EOFError:
+                        # * The worker died in the task (e.g. killed by the OOM killer)
+                        stats['failed'] += 1
+                        logging.error(f'{name}: Worker exited with {worker.process.exitcode} on {task}')
+                        worker.kill()
+                        workers[i] = _TaskWorker(fn, budget)
+                        continue
+                    if calls:
+                        _run_parent_calls(name, calls)
+                    if kind == 'start':
+                        worker.started = value
+                    elif kind == 'error':
+                        worker.task = None
+                        stats['failed'] += 1
+                        logging.error(f'{name}: Exception occurred on {task}: {value}')
+                    else:
+                        worker.task = None
+                        stats['done'] += 1
+                        yield task, value
+                if worker.task is not None and timeout is not None \
+                   and worker.started is not None and now - worker.started > timeout:
+                    stats['timeout'] += 1
+                    logging.error(f'{name}: Task {task} timed out after {timeout}s')
+                    worker.kill()
+                    workers[i] = _TaskWorker(fn, budget)
+            if now - last_report >= PROGRESS_INTERVAL:
+                report()
+                last_report = now
+    finally:
+        for worker in workers:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+    report(final=True)
+
+
+def run_slots(fn, items, num_workers=1, name=None) -> dict:
+    """
+    Run fn(slot, item) for each item on num_workers threads ("slots", numbered 0..num_workers-1)
+    Each slot takes the next item from a shared queue as soon as it is done with the last one, so no slot idles
+    while items remain. Exceptions of fn are logged, and the slot goes on with the next item.
+    Queue depth and slot utilization (busy time / wall time) are reported every PROGRESS_INTERVAL
+    Returns:
+        stats: {'done', 'failed', 'elapsed', 'utilization': [per slot]}
+    """
+    name = name or fn.__name__
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    total = pending.qsize()
+    busy = [0.0] * num_workers
+    stats = {'done': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    finished = threading.Event()
+    running = [num_workers]
+    start = time.time()
+
+    def slot_worker(slot):
+        try:
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                item_start = time.time()
+                try:
+                    fn(slot, item)
+                    outcome = 'done'
+                except Exception as e:
+                    logging.error(f'{name}: Exception occurred on {item}: {e}')
+                    outcome = 'failed'
+                with stats_lock:
+                    busy[slot] += time.time() - item_start
+                    stats[outcome] += 1
+        finally:
+            with stats_lock:
+                running[0] -= 1
+                if running[0] == 0:
+                    finished.set()
+
+    def report(final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        with stats_lock:
+            utilization = [b / elapsed for b in busy]
+            finished_items = stats['done'] + stats['failed']
+        logging.info(f'{name}: {"Finished" if final else "Progress"} {finished_items}/{total} items in {elapsed:.0f}s '
+                     f'({finished_items / elapsed:.2f}/s), {stats["failed"]} failed, queue depth {pending.qsize()}, '
+                     f'slot utilization {sum(utilization) / max(len(utilization), 1):.0%}')
+        return utilization
+
+    threads = [threading.Thread(target=slot_worker, args=(slot,), name=f'{name}-{slot}', daemon=True) for slot in range(num_workers)]
+    for thread in threads:
+        thread.start()
+    if num_workers == 0:
+        finished.set()
+    while not finished.wait(PROGRESS_INTERVAL):
+        report()
+    for thread in threads:
+        thread.join()
+    utilization = report(final=True)
+    return {**stats, 'elapsed': time.time() - start, 'utilization': utilization}
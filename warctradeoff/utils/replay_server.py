@@ -0,0 +1,445 @@
+"""
+In-process replay server for measurement replays, as an alternative to the wayback subprocesses of PYWBServer
+It only does what replay.js needs from pywb: proxy-mode serving of archived responses (plain HTTP, and HTTPS
+through CONNECT with certificates of the same CA as pywb), with the capture closest to Accept-Datetime (--proxy-ts).
+
+Responses are read straight from the WARCs with the offsets in the collection's CDXJ index.
+All servers of a ReplayServerPool run on one asyncio loop in a thread of the calling process,
+and share the loaded collection indexes and an LRU cache of hot payloads.
+"""
+import os
+import ssl
+import json
+import glob
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from email.utils import parsedate_to_datetime, formatdate
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_index, tenant_index
+
+ARCHIVEDIR = CONFIG.archive_dir
+# * Same CA as pywb's proxy mode, so browsers that trust pywb trust this server too
+CA_NAME = 'pywb HTTPS Proxy CA'
+CA_FILE = f'{ARCHIVEDIR}/proxy-certs/pywb-ca.pem'
+CERT_DIR = f'{ARCHIVEDIR}/proxy-certs/hosts'
+# * Bytes of payloads kept in memory, shared by all servers of a pool
+CACHE_BYTES = 256 << 20
+# * Headers of archived responses that don't apply to the replayed (decoded, non-chunked) body
+SKIP_HEADERS = {'transfer-encoding', 'content-encoding', 'content-length', 'connection', 'keep-alive'}
+LATENCY_WINDOW = 1000
+# * Tenant indexes kept in memory, shared by all servers of a pool
+MAX_TENANT_INDEXES = 256
+# * Ways for a replay request to select a tenant of its server's collection (see tenant_index):
+# * a header, or a query parameter of the URL
+TENANT_HEADER = 'X-Archive-Tenant'
+TENANT_PARAM = 'archive_tenant'
+
+def _now_ts() -> str:
+    return datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+
+def accept_ts(accept_datetime) -> str:
+    """14-digit timestamp of an Accept-Datetime header (latest capture if there is none)"""
+    if not accept_datetime:
+        return _now_ts()
+    try:
+        return parsedate_to_datetime(accept_datetime).astimezone(timezone.utc).strftime('%Y%m%d%H%M%S')
+    except (TypeError, ValueError):
+        return _now_ts()
+
+def request_tenant(url, headers=None) -> "str | None":
+    """Tenant selected by a replay request, from TENANT_HEADER or the TENANT_PARAM query parameter"""
+    for k, v in (headers or {}).items():
+        if k.lower() == TENANT_HEADER.lower():
+            return v
+    values = [v for k, v in parse_qsl(urlsplit(url).query) if k == TENANT_PARAM]
+    return values[0] if values else None
+
+def _ts_seconds(ts) -> float:
+    ts = (ts + '0' * 14)[:14]
+    return datetime.strptime(ts, '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+class CollectionIndex:
+    """Captures of a collection by surt, each list sorted by timestamp"""
+    def __init__(self, archive_dir, lines):
+        self.archive_dir = archive_dir
+        self.captures = defaultdict(list)
+        for line in lines:
+            key, ts, _ = line.split(' ', 2)
+            self.captures[key].append((ts, line))
+        for captures in self.captures.values():
+            captures.sort()
+
+    @classmethod
+    def from_collection(cls, col_dir) -> "CollectionIndex":
+        lines = []
+        for index_file in sorted(glob.glob(f'{col_dir}/indexes/*.cdxj')):
+            with open(index_file) as f:
+                lines += [line.rstrip('\n') for line in f if line.strip() and not line.startswith('!')]
+        return cls(f'{col_dir}/archive', lines)
+
+    def closest(self, url, ts) -> "(IndexEntry, str) | None":
+        """
+        Capture of url closest to ts, as pywb selects it: by distance in time, the earlier one on ties
+        Returns:
+            (entry, path of the WARC)
+        """
+        captures = self.captures.get(warc_index._surt(url))
+        if not captures:
+            return None
+        target = _ts_seconds(ts)
+        i = bisect_left(captures, (ts,))
+        candidates = captures[max(i - 1, 0):i + 1]
+        _, line = min(candidates, key=lambda c: (abs(_ts_seconds(c[0]) - target), c[0]))
+        return self._entry(line)
+
+    def original(self, url, digest, ts) -> "(IndexEntry, str) | None":
+        """Closest non-revisit capture of url with payload digest (what a revisit refers to)"""
+        digest = (digest or '').replace('sha1:', '')
+        target = _ts_seconds(ts)
+        found = []
+        for cts, line in self.captures.get(warc_index._surt(url), []):
+            entry, path = self._entry(line)
+            if entry.mime != 'warc/revisit' and (entry.digest or '').replace('sha1:', '') == digest:
+                found.append((abs(_ts_seconds(cts) - target), cts, entry, path))
+        if not found:
+            return None
+        _, _, entry, path = min(found, key=lambda f: f[:2])
+        return entry, path
+
+    def _entry(self, line) -> "(IndexEntry, str)":
+        entry = warc_index.parse_line(line)
+        filename = json.loads(f'"{warc_index.FILENAME_FIELD.search(line).group(1)}"')
+        return entry, f'{self.archive_dir}/{filename}'
+
+
+class PayloadCache:
+    """LRU of replayable responses (status line, headers, body), bounded by the total size of the bodies"""
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value[2])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, body) = self.items.popitem(last=False)
+                self.size -= len(body)
+
+
+class ReplayHub:
+    """The asyncio loop (in a daemon thread) and the state shared by the servers of a pool"""
+    def __init__(self, cache_bytes=CACHE_BYTES):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.cache = PayloadCache(cache_bytes)
+        self.indexes = {}
+        self.tenant_indexes = OrderedDict()
+        self.index_lock = threading.Lock()
+        self.ssl_contexts = {}
+        self.ca = None
+
+    def run(self, coro):
+        """Run coro on the loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def collection_index(self, col_dir) -> CollectionIndex:
+        """Index of the collection at col_dir, reloaded when its index files change"""
+        fingerprint = tuple((f, os.path.getmtime(f), os.path.getsize(f)) for f in sorted(glob.glob(f'{col_dir}/indexes/*.cdxj')))
+        with self.index_lock:
+            cached = self.indexes.get(col_dir)
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1]
+            index = CollectionIndex.from_collection(col_dir)
+            self.indexes[col_dir] = (fingerprint, index)
+            return index
+
+    def tenant_index(self, col_dir, tenant) -> CollectionIndex:
+        """
+        Index of tenant of the shared collection at col_dir (see tenant_index), reloaded when the shared index changes
+        The latest MAX_TENANT_INDEXES are kept. Blocks on file reads, so it isn't called on the loop
+        """
+        index_file = tenant_index.tenant_index_path(col_dir)
+        fingerprint = (os.path.getmtime(index_file), os.path.getsize(index_file)) if os.path.exists(index_file) else None
+        key = (col_dir, tenant, fingerprint)
+        with self.index_lock:
+            index = self.tenant_indexes.get(key)
+            if index is not None:
+                self.tenant_indexes.move_to_end(key)
+                return index
+            index = CollectionIndex(f'{col_dir}/archive', tenant_index.tenant_lines(col_dir, tenant))
+            self.tenant_indexes[key] = index
+            while len(self.tenant_indexes) > MAX_TENANT_INDEXES:
+                self.tenant_indexes.popitem(last=False)
+            return index
+
+    def ssl_context(self, host) -> ssl.SSLContext:
+        if host not in self.ssl_contexts:
+            if self.ca is None:
+                # * Optional dependency (installed with pywb), only needed for HTTPS
+                from certauth.certauth import CertificateAuthority
+                os.makedirs(CERT_DIR, exist_ok=True)
+                self.ca = CertificateAuthority(CA_NAME, CA_FILE, cert_cache=CERT_DIR)
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.ca.cert_for_host(host))
+            self.ssl_contexts[host] = context
+        return self.ssl_contexts[host]
+
+    def stop(self):
+        async def cancel_connections():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.run(cancel_connections())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async def _read_request(reader) -> "(str, str, dict) | None":
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+    length = int(headers.get('content-length', 0) or 0)
+    if length > 0:
+        await reader.readexactly(length)
+    return method, target, headers
+
+
+class ReplayServer:
+    """
+    Drop-in alternative to upload.PYWBServer (start/stop/use/stats/switch_collection/select_tenant)
+    Only proxy mode is supported
+    """
+    def __init__(self, hub, archive='test', proxy=True):
+        if not proxy:
+            raise ValueError("ReplayServer only serves in proxy mode")
+        self.hub = hub
+        self.archive = archive
+        self.proxy = proxy
+        self.port = None
+        self.server = None
+        self.index = None
+        self.col_dir = None
+        self.tenant = None
+        self.uses = 0
+        self.stats_counts = {'requests': 0, 'found': 0, 'not_found': 0, 'errors': 0}
+        self.latencies = []
+
+    # * Lifecycle
+    def start(self) -> int:
+        self.switch_collection(self.archive)
+        self.server = self.hub.run(asyncio.start_server(self._handle, 'localhost', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f'ReplayServer: Serving {self.archive} on port {self.port}')
+        return self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.hub.run(self.server.wait_closed())
+            self.server = None
+
+    def alive(self) -> bool:
+        return self.server is not None and self.server.is_serving()
+
+    def restart(self, archive=None):
+        if archive:
+            self.switch_collection(archive)
+        if not self.alive():
+            self.start()
+        return True
+
+    def use(self):
+        """Count a use (e.g. a replay), and pick up changes of the collection's index"""
+        if self.server is None:
+            return
+        if self.tenant is None:
+            self.index = self.hub.collection_index(self.col_dir)
+        else:
+            self.index = self.hub.tenant_index(self.col_dir, self.tenant)
+        self.uses += 1
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'port': self.port,
+            'archive': self.archive,
+            'tenant': self.tenant,
+            'alive': self.alive(),
+            'uses': self.uses,
+            **self.stats_counts,
+            'cache_hits': self.hub.cache.hits,
+            'cache_misses': self.hub.cache.misses,
+            'latency_median': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+    # * Collection selection
+    def switch_collection(self, archive):
+        self.archive, self.tenant = archive, None
+        self.col_dir = f'{ARCHIVEDIR}/collections/{archive}'
+        self.index = self.hub.collection_index(self.col_dir)
+
+    def select_tenant(self, col_name, tenant):
+        """Replay only tenant of the shared collection col_name (see tenant_index)"""
+        self.archive, self.tenant = col_name, tenant
+        self.col_dir = f'{ARCHIVEDIR}/collections/{col_name}'
+        self.index = self.hub.tenant_index(self.col_dir, tenant)
+
+    # * Serving
+    def _request_index(self, url, headers) -> "(CollectionIndex, str)":
+        """Index for a request, which can select a tenant of the collection itself (see request_tenant)"""
+        tenant = request_tenant(url, headers)
+        if tenant is None:
+            return self.index, url
+        us = urlsplit(url)
+        query = urlencode([(k, v) for k, v in parse_qsl(us.query, keep_blank_values=True) if k != TENANT_PARAM])
+        url = urlunsplit(us._replace(query=query))
+        return self.hub.tenant_index(self.col_dir, tenant), url
+
+    def _response(self, url, headers) -> "(str, list, bytes) | None":
+        """Runs in the loop's executor, as the index of a tenant and the WARC may need to be read"""
+        index, url = self._request_index(url, headers)
+        ts = accept_ts(headers.get('accept-datetime'))
+        found = index.closest(url, ts)
+        if found is None:
+            return None
+        entry, path = found
+        key = (path, entry.offset)
+        response = self.hub.cache.get(key)
+        if response is not None:
+            return response
+        record = warc_index.read_entry(path, entry)
+        if record.rec_type == 'revisit':
+            original = index.original(url, entry.digest, entry.ts)
+            if original is not None:
+                record = warc_index.read_entry(original[1], original[0])
+            else:
+                record = warc_index.resolve_revisit(path, record)
+            if record is None:
+                return None
+        body = record.content_stream().read()
+        if record.http_headers is not None:
+            statusline = record.http_headers.statusline
+            headers = [(k, v) for k, v in record.http_headers.headers if k.lower() not in SKIP_HEADERS]
+        else: # * resource records
+            statusline = '200 OK'
+            headers = [('Content-Type', record.rec_headers.get_header('Content-Type', 'application/octet-stream'))]
+        headers += [('Content-Length', str(len(body))),
+                    ('Memento-Datetime', formatdate(_ts_seconds(entry.ts), usegmt=True))]
+        response = (statusline, headers, body)
+        self.hub.cache.put(key, response)
+        return response
+
+    async def _respond(self, writer, url, headers):
+        start = time.time()
+        self.stats_counts['requests'] += 1
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(None, self._response, url, headers)
+        except Exception as e:
+            logging.error(f'ReplayServer: Exception on {url}: {e}')
+            self.stats_counts['errors'] += 1
+            response = ('500 Internal Server Error', [('Content-Length', '0')], b'')
+        if response is None:
+            self.stats_counts['not_found'] += 1
+            response = ('404 Not Found', [('Content-Length', '0')], b'')
+        else:
+            self.stats_counts['found'] += 1
+        statusline, response_headers, body = response
+        head = f'HTTP/1.1 {statusline}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in response_headers) + '\r\n'
+        writer.write(head.encode('latin-1', errors='replace') + body)
+        await writer.drain()
+        self.latencies = (self.latencies + [time.time() - start])[-LATENCY_WINDOW:]
+
+    async def _handle(self, reader, writer):
+        """One client connection, kept alive across requests. CONNECT switches it to TLS"""
+        tls_host = None
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers = request
+                if method == 'CONNECT':
+                    tls_host = target.split(':')[0]
+                    writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                    await writer.drain()
+                    await writer.start_tls(self.hub.ssl_context(tls_host))
+                    continue
+                if target.startswith('http://') or target.startswith('https://'):
+                    url = target
+                else:
+                    scheme = 'https' if tls_host else 'http'
+                    url = f'{scheme}://{headers.get("host", tls_host)}{target}'
+                await self._respond(writer, url, headers)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, ssl.SSLError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            pass # * Cancelled by ReplayHub.stop
+        finally:
+            writer.close()
+
+
+class ReplayServerPool:
+    """Drop-in alternative to upload.PYWBServerPool: one server per worker, all on one loop of this process"""
+    def __init__(self, archives, proxy=True, cache_bytes=CACHE_BYTES):
+        self.hub = ReplayHub(cache_bytes)
+        self.servers = [ReplayServer(self.hub, archive=archive, proxy=proxy) for archive in archives]
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+
+    def server(self, worker_id) -> ReplayServer:
+        server = self.servers[worker_id]
+        server.use()
+        return server
+
+    def __getitem__(self, worker_id) -> ReplayServer:
+        return self.servers[worker_id]
+
+    def stats(self) -> list:
+        return [server.stats() for server in self.servers]
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+        self.hub.stop()
@@ -0,0 +1,192 @@
+"""
+Shared multi-tenant index of a pywb collection, for per-page isolation without a collection per page
+Each tenant (archive_name) only sees its own records. Their WARCs are all in the collection's archive directory,
+and their lines are in one sorted file ({col_dir}/tenants/index.cdxj) keyed by (tenant, surt, ts):
+    "{tenant} {surt} {ts} {json}"
+pywb itself doesn't know about tenants, so a tenant is replayed through a view collection:
+its archive directory links to the shared one, and its indexes to the tenant's slice of the shared index.
+pywb picks up index changes without a restart, so in proxy mode one view per replay server is switched between
+tenants (PYWBServer.select_tenant), and the server replays one tenant at a time.
+In URL mode, each selected tenant gets its own view next to the collection (tenant_view), which pywb discovers
+like any other collection, so the tenant is selected by the URL path (/{view}/{ts}/{url}).
+pywb can't select a collection by header; replay_server.ReplayServer also selects tenants by header or query parameter.
+"""
+import os
+import re
+import heapq
+import shutil
+import hashlib
+
+from warctradeoff.utils import warc_utils, warc_index
+
+TENANT_DIR = 'tenants'
+# * Between the collection and the tenant in the name of a tenant's view (see view_name)
+VIEW_SEPARATOR = '--'
+
+def tenant_index_path(col_dir) -> str:
+    return f'{col_dir}/{TENANT_DIR}/{warc_index.COLLECTION_INDEX}'
+
+def _link_virtual(col_dir, source) -> str:
+    """Link source into the archive directory as {source}.virtual (see LocalUploadManager._add_virtual_warc)"""
+    link_name = f'{os.path.basename(source)}.virtual'
+    link_path = f'{col_dir}/archive/{link_name}'
+    if not os.path.lexists(link_path):
+        os.symlink(os.path.abspath(source), link_path)
+    return link_name
+
+def _tenant_lines(col_dir, tenant, warcs) -> list:
+    """Lines of tenant's warcs, and of the original records their revisits refer to. Links the warcs into the archive"""
+    lines = []
+    names = set(os.path.basename(w) for w in warcs)
+    revisit_entries = {}
+    for warc in warcs:
+        if warc_index.is_virtual(warc):
+            source, entries = warc_index.virtual_entries(warc)
+            filename = _link_virtual(col_dir, source)
+        else:
+            source = warc_utils.resolve_warc(warc)
+            entries = warc_index.load_index(source).entries
+            filename = os.path.basename(source)
+            if not os.path.exists(f'{col_dir}/archive/{filename}'):
+                warc_utils.place_file(source, f'{col_dir}/archive/{filename}')
+        lines += warc_index.pywb_lines(entries, filename)
+        for original, original_entries in warc_index.revisit_targets(warc).items():
+            if os.path.basename(original) not in names:
+                revisit_entries.setdefault(original, {}).update({e.offset: e for e in original_entries})
+    for original, entries in revisit_entries.items():
+        lines += warc_index.pywb_lines(entries.values(), _link_virtual(col_dir, original))
+    return [f'{tenant} {line}' for line in lines]
+
+def add_tenants(col_dir, tenant_warcs) -> int:
+    """
+    Add {tenant: [warcs]} to the collection at col_dir: the warcs are copied (virtual ones linked) to its archive,
+    and their lines merged into the shared index in one pass. Lines of these tenants are replaced
+    """
+    index_file = tenant_index_path(col_dir)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    os.makedirs(f'{col_dir}/archive', exist_ok=True)
+    new_lines = []
+    for tenant, warcs in tenant_warcs.items():
+        new_lines += _tenant_lines(col_dir, tenant, warcs)
+    new_lines.sort()
+    _rewrite_index(index_file, set(tenant_warcs), new_lines)
+    return len(new_lines)
+
+def _rewrite_index(index_file, removed, new_lines=()):
+    """Rewrite the shared index without the lines of removed tenants, merging in new_lines (sorted)"""
+    tmp_file = f'{index_file}.tmp'
+    old = open(index_file) if os.path.exists(index_file) else []
+    try:
+        kept = (line.rstrip('\n') for line in old if line.strip() and line.split(' ', 1)[0] not in removed)
+        with open(tmp_file, 'w') as f:
+            for line in heapq.merge(kept, new_lines):
+                f.write(line + '\n')
+    finally:
+        if not isinstance(old, list):
+            old.close()
+    os.replace(tmp_file, index_file)
+
+def remove_tenants(col_dir, removed=None) -> set:
+    """
+    Remove tenants (all of them if removed is None) from the collection at col_dir, with their views (see tenant_view).
+    Their warcs stay in the archive, as other tenants may refer to them, unless all tenants are removed
+    Returns the removed tenants
+    """
+    index_file = tenant_index_path(col_dir)
+    if not os.path.exists(index_file):
+        return set()
+    if removed is None:
+        removed = tenants(col_dir)
+        shutil.rmtree(f'{col_dir}/archive', ignore_errors=True)
+        os.makedirs(f'{col_dir}/archive')
+    removed = set(removed)
+    _rewrite_index(index_file, removed)
+    col_path = os.path.abspath(col_dir)
+    for tenant in removed:
+        shutil.rmtree(f'{os.path.dirname(col_path)}/{view_name(os.path.basename(col_path), tenant)}', ignore_errors=True)
+    return removed
+
+def _seek_prefix(f, prefix: bytes):
+    """Position f (binary, sorted lines) at the last line before the first one >= prefix"""
+    lo, hi = 0, os.fstat(f.fileno()).st_size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        if mid > 0:
+            f.readline()
+        line = f.readline()
+        if not line or line >= prefix:
+            hi = mid
+        else:
+            lo = mid + 1
+    f.seek(max(lo - 1, 0))
+    if lo > 1:
+        f.readline()
+
+def tenant_lines(col_dir, tenant) -> list:
+    """pywb lines of tenant, found by binary search in the shared index"""
+    index_file = tenant_index_path(col_dir)
+    if not os.path.exists(index_file):
+        return []
+    prefix = f'{tenant} '.encode()
+    lines = []
+    with open(index_file, 'rb') as f:
+        _seek_prefix(f, prefix)
+        for line in f:
+            if line.startswith(prefix):
+                lines.append(line[len(prefix):].decode().rstrip('\n'))
+            elif line > prefix:
+                break
+    return lines
+
+def tenants(col_dir) -> set:
+    index_file = tenant_index_path(col_dir)
+    if not os.path.exists(index_file):
+        return set()
+    return set(line.split(' ', 1)[0] for line in open(index_file) if line.strip())
+
+def _replace_symlink(link_path, target):
+    tmp_path = f'{link_path}.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(target, tmp_path)
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        shutil.rmtree(link_path) # * e.g. empty directories created by init_collection
+    os.replace(tmp_path, link_path)
+
+def point_view(view_dir, archive_dir, indexes_dir):
+    """Make the pywb collection at view_dir serve archive_dir with the indexes in indexes_dir, by swapping symlinks"""
+    os.makedirs(view_dir, exist_ok=True)
+    _replace_symlink(f'{view_dir}/archive', os.path.abspath(archive_dir))
+    _replace_symlink(f'{view_dir}/indexes', os.path.abspath(indexes_dir))
+
+def write_view(col_dir, view_dir, tenant) -> int:
+    """Make view_dir (a pywb collection) show only tenant of the collection at col_dir"""
+    tenant_dir = f'{view_dir}/{TENANT_DIR}'
+    os.makedirs(tenant_dir, exist_ok=True)
+    lines = tenant_lines(col_dir, tenant)
+    index_file = f'{tenant_dir}/{warc_index.COLLECTION_INDEX}'
+    tmp_file = f'{index_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+    os.replace(tmp_file, index_file)
+    point_view(view_dir, f'{col_dir}/archive', tenant_dir)
+    return len(lines)
+
+def view_name(col_name, tenant) -> str:
+    """Name of tenant's view of collection col_name. pywb collection names only have word characters and '-'"""
+    name = re.sub(r'[^\w-]', '-', tenant)
+    if name != tenant:
+        name += '-' + hashlib.sha1(tenant.encode()).hexdigest()[:8]
+    return f'{col_name}{VIEW_SEPARATOR}{name}'
+
+def tenant_view(col_dir, tenant) -> str:
+    """
+    Write the view of tenant next to the collection at col_dir, and return its name (a collection name).
+    Views are only written for the tenants that are replayed, so there is no collection per tenant up front
+    """
+    col_path = os.path.abspath(col_dir)
+    view = view_name(os.path.basename(col_path), tenant)
+    write_view(col_path, f'{os.path.dirname(col_path)}/{view}', tenant)
+    return view
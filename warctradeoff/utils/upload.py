@@ -5,16 +5,23 @@ Remove the files after uploading
 import os
 import re
 import glob
+import shutil
+import filecmp
 import paramiko
 import json
 import time
+import random
 import socket, threading
+import fcntl
+import shlex
+import tarfile
+import urllib.request, urllib.error
 from collections import defaultdict
 from scp import SCPClient
-from subprocess import check_call, call, check_output, Popen, DEVNULL, PIPE
-from concurrent import futures
+from subprocess import check_call, check_output, Popen, DEVNULL, PIPE, TimeoutExpired
 
 from warctradeoff.config import CONFIG
+from warctradeoff.utils import warc_utils, warc_index, url_filter, collection_lock, tenant_index
 from fidex.utils import common
 
 # SERVER is from the .ssh/config file
@@ -24,55 +31,307 @@ with open(os.path.expanduser('~/.ssh/config')) as f:
     ssh_config.parse(f)
 ARCHIVEDIR = CONFIG.archive_dir
 PYWBENV = CONFIG.pywb_env
+# * Where SSHClientManager copies collection_lock.py to on the server, to run it as the lock helper
+LOCK_HELPER = f'{ARCHIVEDIR}/.collection_lock.py'
+# * Moved along with a warc, so they are not rebuilt after the upload (see warc_utils.move_path)
+WARC_SIDECARS = [warc_index.INDEX_SUFFIX, url_filter.BLOOM_SUFFIX]
+
+def init_collection(col_name):
+    """In-process `wb-manager init`: create the directories of collection col_name if it doesn't exist, and its lock file"""
+    for sub_dir in ['archive', 'indexes', 'static', 'templates']:
+        os.makedirs(f'{ARCHIVEDIR}/collections/{col_name}/{sub_dir}', exist_ok=True)
+    open(f'{ARCHIVEDIR}/collections/{col_name}/lock', 'a').close()
+
+def add_to_collection(col_name, warc_paths):
+    """
+    In-process `wb-manager add` of a batch of warcs: place them in the collection's archive directory
+    (hardlinked where possible, see warc_utils.place_file, so a warc added to several collections is stored once)
+    and merge their entries into its index.cdxj in one pass (see warc_index.merge_pywb_index)
+    """
+    archive_dir = f'{ARCHIVEDIR}/collections/{col_name}/archive'
+    for warc_path in warc_paths:
+        archive_path = f'{archive_dir}/{os.path.basename(warc_path)}'
+        if os.path.abspath(warc_path) != os.path.abspath(archive_path):
+            warc_utils.place_file(warc_path, archive_path)
+    index_file = f'{ARCHIVEDIR}/collections/{col_name}/indexes/{warc_index.COLLECTION_INDEX}'
+    # * Entries come from the sidecars of the source warcs, which have the same offsets as the copies
+    return warc_index.merge_pywb_index(index_file, [(w, os.path.basename(w)) for w in warc_paths])
+
+
+# * Ports of running servers are reserved with a flock on {PORT_LOCK_DIR}/{port}.lock
+PORT_LOCK_DIR = f'{ARCHIVEDIR}/.ports'
+# * Seconds to wait for a server to answer before it is given up on
+READY_TIMEOUT = 60
+READY_INTERVAL = 0.2
+# * Attempts to bring a server up (each on a newly reserved port, after the first restart on the same port)
+START_ATTEMPTS = 3
+# * Number of latest probe latencies kept per server
+LATENCY_WINDOW = 100
+
+
+class ServerNotReadyError(Exception):
+    pass
+
+
+def _ephemeral_ports() -> "(int, int)":
+    """Range the kernel picks local ports of outgoing connections from"""
+    try:
+        with open('/proc/sys/net/ipv4/ip_local_port_range') as f:
+            first, last = f.read().split()
+            return int(first), int(last)
+    except (OSError, ValueError):
+        return 32768, 60999
+
+def reserve_port() -> "(int, file)":
+    """
+    Pick a free port of CONFIG.replay_ports and reserve it for as long as the returned lock file is open
+    Ports in the ephemeral range are never picked, so an outgoing connection can't take the port before the server binds it.
+    The port is checked again after it is locked, so two processes can't reserve the same port
+    """
+    os.makedirs(PORT_LOCK_DIR, exist_ok=True)
+    first, last = CONFIG.replay_ports
+    ephemeral_first, ephemeral_last = _ephemeral_ports()
+    ports = [p for p in range(first, last + 1) if not ephemeral_first <= p <= ephemeral_last]
+    # * Start at a random port, so that processes reserving at the same time don't all contend for the first ones
+    offset = random.randrange(len(ports)) if ports else 0
+    for port in ports[offset:] + ports[:offset]:
+        lock_file = open(f'{PORT_LOCK_DIR}/{port}.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(('localhost', port))
+            s.close()
+            return port, lock_file
+        except OSError:
+            lock_file.close()
+    raise OSError(f"No free port in {first}-{last} outside of the ephemeral range {ephemeral_first}-{ephemeral_last}")
+
+def _rss(pid) -> "int | None":
+    """Resident memory of pid in bytes"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
 
 class PYWBServer:
-    def __init__(self, proxy=False, archive='test'):
+    _view_count = 0
+
+    def __init__(self, proxy=False, archive='test', max_uses=None, max_rss=None):
+        """
+        Args:
+            archive: Collection to serve. In proxy mode the server serves its own view collection,
+                     which is pointed at archive (see switch_collection), so it can be changed without a restart
+            max_uses: Recycle (restart) the server after this many uses (see use)
+            max_rss: Recycle the server once its resident memory exceeds this many bytes
+        """
         self.port = None
         self.server = None
-        self.thread = None
+        self.port_lock = None
         self.archive = archive
         self.proxy = proxy
+        self.max_uses = max_uses
+        self.max_rss = max_rss
+        self.uses = 0
+        self.restarts = 0
+        self.latencies = []
+        PYWBServer._view_count += 1
+        self.view = f'view-{socket.gethostname()}-{os.getpid()}-{PYWBServer._view_count}'
+        self.view_target = None
 
     def _start_server(self):
-        if self.proxy:
-            cmd = f'{PYWBENV} && cd {ARCHIVEDIR} && wayback --proxy {self.archive} -p {self.port} > /dev/null 2>&1 & echo $!'
-        else:
-            cmd = f'{PYWBENV} && cd {ARCHIVEDIR} && wayback -p {self.port} > /dev/null 2>&1 & echo $!'
-        server = Popen(cmd, shell=True, stdout=PIPE)
-        self.server = server.communicate()[0].decode().strip()
-        print(f"Started pywb server port:{self.port} process:{self.server}")
+        collection = f'--proxy {self.view} ' if self.proxy else ''
+        cmd = f'{PYWBENV} && cd {ARCHIVEDIR} && exec wayback {collection}-p {self.port}'
+        self.server = Popen(cmd, shell=True, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+        print(f"Started pywb server port:{self.port} process:{self.server.pid}")
+
+    def probe(self, timeout=5) -> "float | None":
+        """Seconds the server took to answer a request, or None if it didn't"""
+        start = time.time()
+        try:
+            urllib.request.urlopen(f'http://localhost:{self.port}/', timeout=timeout).read()
+        except urllib.error.HTTPError:
+            pass # * Any HTTP response means that the server is up
+        except (urllib.error.URLError, OSError):
+            return None
+        latency = time.time() - start
+        self.latencies = (self.latencies + [latency])[-LATENCY_WINDOW:]
+        return latency
+
+    def wait_ready(self, timeout=READY_TIMEOUT) -> bool:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.server is None or self.server.poll() is not None:
+                return False
+            if self.probe() is not None:
+                return True
+            time.sleep(READY_INTERVAL)
+        return False
 
     def start(self) -> int:
-        # Get free port
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('localhost', 0))
-        self.port = s.getsockname()[1]
-        s.close()
-        self.thread = threading.Thread(target=self._start_server)
-        self.thread.daemon = True
-        self.thread.start()
+        """Start the server on a newly reserved port. Raises ServerNotReadyError if it doesn't come up"""
+        if self.proxy:
+            self.switch_collection(self.archive)
+        self.port, self.port_lock = reserve_port()
+        self._start_server()
+        self._ensure_ready()
         return self.port
+
+    def _ensure_ready(self):
+        """Wait for the server, restarting it (first on its port, then on new ones) until it answers or attempts run out"""
+        for attempt in range(START_ATTEMPTS):
+            if attempt > 0:
+                self._kill()
+                if attempt > 1:
+                    self.port_lock.close()
+                    self.port, self.port_lock = reserve_port()
+                self._start_server()
+            if self.wait_ready():
+                return
+            print(f"pywb server port:{self.port} is not ready after {READY_TIMEOUT}s (attempt {attempt})", flush=True)
+        self.stop()
+        raise ServerNotReadyError(f"pywb server is not ready after {START_ATTEMPTS} attempts")
     
-    def stop(self):
+    def _kill(self):
         if self.server:
             print(f"Killing server {self.port}")
-            call(f"kill -9 {self.server}", shell=True)
-            self.thread = None
+            self.server.terminate()
+            try:
+                self.server.wait(timeout=10)
+            except TimeoutExpired:
+                self.server.kill()
+                self.server.wait()
             self.server = None
-    
+
+    def stop(self):
+        self._kill()
+        if self.port_lock:
+            self.port_lock.close()
+            self.port_lock = None
+
+    def alive(self) -> bool:
+        return self.server is not None and self.server.poll() is None
+
+    def recycle(self):
+        """Restart the server on the same (still reserved) port. Raises ServerNotReadyError if it doesn't come up"""
+        self._kill()
+        self.restarts += 1
+        self._start_server()
+        self._ensure_ready()
+
+    def use(self):
+        """Count a use (e.g. a replay) of the server. Recycles it first if it is unhealthy or past its limits"""
+        if self.server is None:
+            return
+        rss = _rss(self.server.pid)
+        healthy = self.alive() and self.probe() is not None
+        if not healthy or (self.max_uses is not None and self.uses >= self.max_uses) \
+            or (self.max_rss is not None and rss is not None and rss > self.max_rss):
+            print(f"Recycling pywb server port:{self.port} after {self.uses} uses (healthy: {healthy}, rss: {rss})", flush=True)
+            self.recycle()
+            self.uses = 0
+        self.uses += 1
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'port': self.port,
+            'pid': self.server.pid if self.server else None,
+            'archive': self.archive,
+            'alive': self.alive(),
+            'uses': self.uses,
+            'restarts': self.restarts,
+            'rss': _rss(self.server.pid) if self.server else None,
+            'latency_median': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+    def switch_collection(self, archive):
+        """Serve collection archive from now on. In proxy mode, no restart is needed"""
+        self.archive = archive
+        if not self.proxy:
+            return
+        col_dir = f'{ARCHIVEDIR}/collections/{archive}'
+        if not os.path.exists(col_dir):
+            init_collection(archive)
+        if self.view_target != archive:
+            tenant_index.point_view(f'{ARCHIVEDIR}/collections/{self.view}', f'{col_dir}/archive', f'{col_dir}/indexes')
+            self.view_target = archive
+
+    def select_tenant(self, col_name, tenant):
+        """
+        Replay only tenant of the shared collection col_name (see tenant_index). No restart is needed,
+        as pywb picks up new indexes and collections on the next request.
+        In proxy mode, this server's view is pointed at the tenant's slice of the index.
+        Otherwise archive becomes the tenant's own view, so replay URLs (/{archive}/{ts}/{url}) select the tenant
+        """
+        if not self.proxy:
+            self.archive = tenant_index.tenant_view(f'{ARCHIVEDIR}/collections/{col_name}', tenant)
+            print(f"Selected tenant {tenant} of {col_name} as collection {self.archive} on {self.port}", flush=True)
+            return
+        num_lines = tenant_index.write_view(f'{ARCHIVEDIR}/collections/{col_name}',
+                                            f'{ARCHIVEDIR}/collections/{self.view}', tenant)
+        self.archive, self.view_target = col_name, None
+        print(f"Selected tenant {tenant} of {col_name} ({num_lines} index lines) on {self.port}", flush=True)
+
     def restart(self, archive=None):
-        self.stop()
+        """Switch to archive, (re)starting the server only if it isn't running"""
         if archive:
-            self.archive = archive
-        if not os.path.exists(f'{ARCHIVEDIR}/collections/{self.archive}'):
-            call(f"{PYWBENV} && cd {ARCHIVEDIR} && wb-manager init {self.archive} > /dev/null", shell=True)
-        self.thread = threading.Thread(target=self._start_server)
-        self.thread.daemon = True
-        self.thread.start()
+            self.switch_collection(archive)
+        if not self.alive():
+            self.stop()
+            self.start()
         return True
 
     def __del__(self):
         self.stop()
+        if self.proxy:
+            shutil.rmtree(f'{ARCHIVEDIR}/collections/{self.view}', ignore_errors=True)
+
+
+class PYWBServerPool:
+    """Persistent pywb servers, one per worker, that are started once and recycled when unhealthy"""
+    def __init__(self, archives, proxy=True, max_uses=None, max_rss=None):
+        self.servers = [PYWBServer(proxy=proxy, archive=archive, max_uses=max_uses, max_rss=max_rss) for archive in archives]
+
+    def start(self):
+        """Start all servers concurrently, and wait for them to be ready. Raises ServerNotReadyError if any of them isn't"""
+        errors = []
+        def start_server(server):
+            try:
+                server.start()
+            except (ServerNotReadyError, OSError) as e:
+                errors.append(e)
+        threads = [threading.Thread(target=start_server, args=(server,), daemon=True) for server in self.servers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            self.stop()
+            raise ServerNotReadyError(f"{len(errors)} of {len(self.servers)} pywb servers failed to start: {errors[0]}")
+
+    def server(self, worker_id) -> PYWBServer:
+        """Server of worker_id, checked (see PYWBServer.use) before it is handed out"""
+        server = self.servers[worker_id]
+        server.use()
+        return server
+
+    def __getitem__(self, worker_id) -> PYWBServer:
+        return self.servers[worker_id]
+
+    def stats(self) -> list:
+        return [server.stats() for server in self.servers]
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
 
 class WBManager:
     def __init__(self, split=False, worker_id=None):
@@ -88,23 +347,49 @@ class WBManager:
             return f"{col_name}-{self.hostname}-{self.id}"
     
     @staticmethod
-    def merge_collections(col_name):
-        def rm_col(col):
-            rm_col_cmd = f"cd {ARCHIVEDIR} && rm -rf collections/{col}"
-            call(rm_col_cmd, shell=True)
-        rm_col(col_name)
-        sub_cols_cmd = f"{PYWBENV} && cd {ARCHIVEDIR} && wb-manager list | grep {col_name}"
-        sub_cols = check_output(sub_cols_cmd, shell=True).decode().strip().split('\n')
-        sub_cols = [s for s in sub_cols if re.search(rf"- {col_name}-.*-.*", s)]
-        sub_cols = [s.split('- ')[1] for s in sub_cols]
-        init_cmd = f"{PYWBENV} && cd {ARCHIVEDIR} && wb-manager init {col_name}"
-        call(init_cmd, shell=True)
-        for sub_col in sub_cols:
-            mv_cmd = f"mv {ARCHIVEDIR}/collections/{sub_col}/archive/* {ARCHIVEDIR}/collections/{col_name}/archive/"
-            call(mv_cmd, shell=True)
-            rm_col(sub_col)
-        reindex_cmd = f"{PYWBENV} && cd {ARCHIVEDIR} && wb-manager reindex {col_name}"
-        call(reindex_cmd, shell=True)
+    def merge_collections(col_name, incremental=False):
+        """
+        Merge the per-worker sub-collections ({col_name}-{hostname}-{id}) into col_name
+        WARCs are renamed into col_name's archive directory, and the sub-collections' sorted indexes
+        are k-way merged into col_name's index (see warc_index.merge_index_files), so no WARC is re-read.
+        Merged WARCs leave their sub-collection, so col_name is added to rather than rebuilt.
+        A WARC whose name is already in col_name is skipped if both are identical, otherwise FileExistsError is raised
+        before anything of its sub-collection is moved.
+        Args:
+            incremental: Keep the (emptied) sub-collections, so that the merge can be re-run
+                         while workers are still uploading. Each sub-collection is locked while it is drained.
+        """
+        collections_dir = f'{ARCHIVEDIR}/collections'
+        init_collection(col_name)
+        sub_cols = sorted(c for c in os.listdir(collections_dir) if re.fullmatch(rf"{re.escape(col_name)}-.*-.*", c))
+        col_dir = f'{collections_dir}/{col_name}'
+        with collection_lock.CollectionLock(col_dir, name=col_name):
+            for sub_col in sub_cols:
+                sub_dir = f'{collections_dir}/{sub_col}'
+                with collection_lock.CollectionLock(sub_dir, name=sub_col):
+                    warcs = os.listdir(f'{sub_dir}/archive') if os.path.exists(f'{sub_dir}/archive') else []
+                    duplicates = set()
+                    for warc_name in warcs:
+                        src, dst = f'{sub_dir}/archive/{warc_name}', f'{col_dir}/archive/{warc_name}'
+                        if not os.path.exists(dst):
+                            continue
+                        if not filecmp.cmp(src, dst, shallow=False):
+                            raise FileExistsError(f"{warc_name} of {sub_col} differs from the one already in {col_name}")
+                        duplicates.add(warc_name)
+                    for warc_name in warcs:
+                        if warc_name in duplicates:
+                            # * Already in col_name, and so are its index lines
+                            os.remove(f'{sub_dir}/archive/{warc_name}')
+                        else:
+                            os.rename(f'{sub_dir}/archive/{warc_name}', f'{col_dir}/archive/{warc_name}')
+                    index_files = sorted(glob.glob(f'{sub_dir}/indexes/*.cdxj'))
+                    merged = warc_index.merge_index_files(f'{col_dir}/indexes/{warc_index.COLLECTION_INDEX}', index_files,
+                                                          skip_filenames=duplicates)
+                    for index_file in index_files:
+                        os.remove(index_file)
+                if not incremental:
+                    shutil.rmtree(sub_dir, ignore_errors=True)
+                print(f"Merged {len(warcs)} warcs and {merged} index lines from {sub_col} into {col_name}", flush=True)
         
 
 class BaseManager:
@@ -116,28 +401,66 @@ class BaseManager:
            return collection.replace('.', '_')
 
 
+# * Long-lived SSH connections per (server, user), shared by the SSHClientManagers (e.g. crawl workers) of this process
+SSH_POOL_SIZE = 4
+_ssh_pool = defaultdict(list)
+_ssh_pool_lock = threading.Lock()
+_ssh_pool_next = defaultdict(int)
+# * Write buffer of the tar stream of SSHClientManager.upload_batch
+TAR_BUFSIZE = 1 << 20
+
+def _ssh_connect(server, user, password=None, identity=None) -> paramiko.SSHClient:
+    ssh_client = paramiko.SSHClient()
+    ssh_client.load_system_host_keys()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    if password:
+        ssh_client.connect(server, username=user, password=password)
+    else:
+        ssh_client.connect(server, username=user, key_filename=identity)
+    ssh_client.get_transport().set_keepalive(30)
+    return ssh_client
+
+def pooled_ssh_client(server, user, password=None, identity=None) -> paramiko.SSHClient:
+    """
+    Connection to server from the pool. Up to SSH_POOL_SIZE connections are opened, then they are handed out
+    round-robin, as channels of concurrent workers are multiplexed over a transport. Dropped connections are replaced
+    """
+    key = (server, user)
+    with _ssh_pool_lock:
+        clients = _ssh_pool[key]
+        clients[:] = [c for c in clients if c.get_transport() is not None and c.get_transport().is_active()]
+        if len(clients) < SSH_POOL_SIZE:
+            clients.append(_ssh_connect(server, user, password=password, identity=identity))
+            return clients[-1]
+        _ssh_pool_next[key] = (_ssh_pool_next[key] + 1) % len(clients)
+        return clients[_ssh_pool_next[key]]
+
+def close_ssh_pool():
+    with _ssh_pool_lock:
+        for clients in _ssh_pool.values():
+            for ssh_client in clients:
+                ssh_client.close()
+        _ssh_pool.clear()
+
+
 class SSHClientManager(BaseManager):
     def __init__(self, server=None, user=None, password=None, wb_manager=None):
         assert not server or (server and user and password), "If server provided, user and password should also be provided"
+        identity = None
         if server is None:
             server = ssh_config.lookup(ssh_alias)['hostname']
             user = ssh_config.lookup(ssh_alias)['user']
             identity = ssh_config.lookup(ssh_alias)['identityfile']
         
-        self.ssh_client = paramiko.SSHClient()
-        self.ssh_client.load_system_host_keys()
-        
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        if password:
-            self.ssh_client.connect(server, username=user, password=password)
-        else:
-            self.ssh_client.connect(server, username=user, key_filename=identity)
-        self.ssh_client.get_transport().set_keepalive(30)
+        self.ssh_client = pooled_ssh_client(server, user, password=password, identity=identity)
         self.scp_client = SCPClient(self.ssh_client.get_transport())
         self.wb_manager = wb_manager or WBManager()
+        self.locks = {}
+        self.lock_helper_copied = False
 
 
     def close(self):
+        """Close this manager's channels. The connection stays in the pool (see close_ssh_pool)"""
         if self.scp_client:
             self.scp_client.close()
 
@@ -153,31 +476,94 @@ class SSHClientManager(BaseManager):
         self.scp_client.put(local_path, remote_path, recursive=True)
     
     def _lock(self, col_name):
-        lock_file = f"{ARCHIVEDIR}/collections/{col_name}/lock"
-        # Try create lock if not exist
-        self.ssh_exec(f"touch {lock_file}", check=False)
-        count = 0
-        while True:
-            stdout, stderr = self.ssh_exec(f"ln {lock_file} {lock_file}.lock && echo 'locked' || echo 'waiting'", check=False)
-            if stdout.decode().strip() == 'locked':
-                break
-            else:
-                time.sleep(5)
-                count += 1
-                if count % 2 == 0:
-                    # If waiting for too long, unlock and try again
-                    self._unlock(col_name)
+        """
+        Take the collection's CollectionLock on the server through the lock helper,
+        which holds it until the channel is closed by _unlock (or the connection drops)
+        """
+        if not self.lock_helper_copied:
+            self.scp_copy(collection_lock.__file__, LOCK_HELPER)
+            self.lock_helper_copied = True
+        start = time.time()
+        channel = self.ssh_client.get_transport().open_session()
+        channel.exec_command(f"{PYWBENV} && python {LOCK_HELPER} {ARCHIVEDIR}/collections/{col_name}")
+        status = channel.makefile('r').readline().strip()
+        if status != 'locked':
+            channel.close()
+            raise Exception(f"Failed to lock collection {col_name}: {channel.makefile_stderr('r').read()}")
+        waited = time.time() - start
+        collection_lock.record_wait(waited)
+        print(f"Locked collection {col_name} after waiting {waited:.2f}s", flush=True)
+        self.locks[col_name] = channel
 
     def _unlock(self, col_name):
-        lock_file = f"{ARCHIVEDIR}/collections/{col_name}/lock.lock"
-        self.ssh_exec(f"rm -f {lock_file}", check=False)
+        channel = self.locks.pop(col_name, None)
+        if channel is not None:
+            # * EOF on the helper's stdin releases the lock
+            channel.shutdown_write()
+            channel.recv_exit_status()
+            channel.close()
         
+    def upload_batch(self, writes=(), warcs=(), screenshots=(), lock=True):
+        """
+        Upload many files as one tar stream over one channel. The server untars them under ARCHIVEDIR
+        while they are sent, and then adds the warcs to their collections in the same command,
+        so a batch takes one round trip instead of a mkdir, a copy per file and an add each.
+        Local files are removed once the whole batch is in.
+        Args:
+            writes: [(write_path, directory)], as in upload_write
+            warcs: [(warc_path, col_name, directory)], as in upload_warc. col_name None only copies the warc (mv_only)
+            screenshots: [(screenshot_path, directory)], as in upload_screenshot
+            lock: Add the warcs of each collection under its CollectionLock (through the lock helper)
+        """
+        members = [(path, f'writes/{directory}/{os.path.basename(path)}') for path, directory in writes]
+        members += [(path, f'screenshots/{directory}/{os.path.basename(path)}') for path, directory in screenshots]
+        col_warcs = defaultdict(list)
+        for warc_path, col_name, directory in warcs:
+            arcname = f'warcs/{directory}/{os.path.basename(warc_path)}'
+            members.append((warc_path, arcname))
+            if col_name is not None:
+                col_warcs[self.wb_manager.collection(col_name)].append(f'{ARCHIVEDIR}/{arcname}')
+        members = [(path, arcname) for path, arcname in members if os.path.exists(path)]
+        if lock and col_warcs and not self.lock_helper_copied:
+            members.append((collection_lock.__file__, os.path.relpath(LOCK_HELPER, ARCHIVEDIR)))
+
+        command = f"{PYWBENV} && cd {ARCHIVEDIR} && tar -xf -"
+        for col_name, warc_files in col_warcs.items():
+            col_dir = f'{ARCHIVEDIR}/collections/{col_name}'
+            command += f" && (test -d {col_dir} || wb-manager init {col_name}) && touch {col_dir}/lock"
+            command_add = f"wb-manager add {col_name} {' '.join(shlex.quote(w) for w in warc_files)}"
+            if lock:
+                command_add = f"python {LOCK_HELPER} {col_dir} {command_add}"
+            command += f" && {command_add}"
+
+        start = time.time()
+        channel = self.ssh_client.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            with channel.makefile('wb', TAR_BUFSIZE) as stream:
+                with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                    for path, arcname in members:
+                        tar.add(path, arcname=arcname)
+            channel.shutdown_write()
+            exit_status = channel.recv_exit_status()
+            if exit_status != 0:
+                raise Exception(f"Exit status != 0: {exit_status}. stderr: {channel.makefile_stderr('r').read()}")
+        finally:
+            channel.close()
+        if lock and col_warcs:
+            self.lock_helper_copied = True
+        for path, _ in members:
+            if path == collection_lock.__file__:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        print(f"Uploaded {len(members)} files and added {sum(len(w) for w in col_warcs.values())} warcs in {time.time()-start:.2f}s", flush=True)
+
     def upload_screenshot(self, screenshot_path, directory='default'):
         try:
-            # Create directory if not exist on the remote server
-            self.ssh_exec(f"mkdir -p {ARCHIVEDIR}/screenshots/{directory}")
-            self.scp_copy(screenshot_path, f'{ARCHIVEDIR}/screenshots/{directory}')
-            call(f"rm -rf {screenshot_path}", shell=True)
+            self.upload_batch(screenshots=[(screenshot_path, directory)])
         except Exception as e:
             print("Exception on uploading screenshots", str(e))
     
@@ -191,10 +577,7 @@ class SSHClientManager(BaseManager):
 
     def upload_write(self, write_path, directory='default'):
         try:
-            # Create directory if not exist on the remote server
-            self.ssh_exec(f"mkdir -p {ARCHIVEDIR}/writes/{directory}")
-            self.scp_copy(write_path, f'{ARCHIVEDIR}/writes/{directory}')
-            call(f"rm -rf {write_path}", shell=True)
+            self.upload_batch(writes=[(write_path, directory)])
         except Exception as e:
             print("Exception on uploading writes", str(e))
     
@@ -204,79 +587,53 @@ class SSHClientManager(BaseManager):
         except Exception as e:
             print("Exception on removing writes", str(e))
 
-    def upload_warc(self, warc_path, col_name, directory='default', lock=True):
-        col_name = self.wb_manager.collection(col_name)
+    def upload_warc(self, warc_path, col_name, directory='default', lock=True, mv_only=False):
         try:
-            self.ssh_exec(f"mkdir -p {ARCHIVEDIR}/warcs/{directory}")
-            self.scp_copy(warc_path, f'{ARCHIVEDIR}/warcs/{directory}')
-            warc_name = warc_path.split('/')[-1]
-            command_prefix = f"{PYWBENV} && cd {ARCHIVEDIR}"
-            command_init = f"test -d {ARCHIVEDIR}/collections/{col_name} || ({command_prefix} && wb-manager init {col_name}) && touch {ARCHIVEDIR}/collections/{col_name}/lock"
-            self.ssh_exec(command_init, check=False)
-
-            # First keep waiting until  gather lock
-            if lock:
-                self._lock(col_name)
-
-            command_add = f"{command_prefix} && wb-manager add {col_name} {ARCHIVEDIR}/warcs/{directory}/{warc_name}"
-            self.ssh_exec(command_add)
-            call(f"rm -rf {warc_path}", shell=True)
-
-            # Then unlock
-            if lock:
-                self._unlock(col_name)
+            self.upload_batch(warcs=[(warc_path, None if mv_only else col_name, directory)], lock=lock)
         except Exception as e:
             print("Exception on uploading warc", str(e))
 
 
 class LocalUploadManager(BaseManager):
     def __init__(self, wb_manager=None):
-        self.wb_manager = wb_manager
+        self.wb_manager = wb_manager or WBManager()
+        self.held = threading.local()
 
     def close(self):
         pass
 
+    @property
+    def locks(self) -> dict:
+        """Collection locks held by the calling thread, so threads sharing the manager never release each other's"""
+        if not hasattr(self.held, 'locks'):
+            self.held.locks = {}
+        return self.held.locks
+
     def _lock(self, col_name):
-        lock_file = f"{ARCHIVEDIR}/collections/{col_name}/lock"
-        # Try create lock if not exist
-        call(f"touch {lock_file}", shell=True)
-        count = 0
-        while True:
-            stdout = ''
-            try:
-                stdout = check_output(f"ln {lock_file} {lock_file}.lock && echo 'locked' || echo 'waiting'", shell=True, stderr=DEVNULL)
-            except: pass
-            if stdout and stdout.decode().strip() == 'locked':
-                break
-            else:
-                time.sleep(5)
-                count += 1
-                if count % 2 == 0:
-                    # If waiting for too long, unlock and try again
-                    self._unlock(col_name)
+        lock = collection_lock.CollectionLock(f"{ARCHIVEDIR}/collections/{col_name}", name=col_name)
+        lock.acquire()
+        self.locks[col_name] = lock
     
     def _unlock(self, col_name):
-        lock_file = f"{ARCHIVEDIR}/collections/{col_name}/lock.lock"
-        call(f"rm -f {lock_file}", shell=True)
+        lock = self.locks.pop(col_name, None)
+        if lock is not None:
+            lock.release()
 
     def upload_screenshot(self, screenshot_path, directory='default'):
         try:
-            os.makedirs(f'{ARCHIVEDIR}/screenshots/{directory}', exist_ok=True)
-            check_call(f"mv -f {screenshot_path} {ARCHIVEDIR}/screenshots/{directory}", shell=True)
+            warc_utils.move_path(screenshot_path, f'{ARCHIVEDIR}/screenshots/{directory}/{os.path.basename(screenshot_path)}')
         except Exception as e:
             print("Exception on uploading screenshots", str(e))
     
     def upload_write(self, write_path, directory='default'):
         try:
-            os.makedirs(f'{ARCHIVEDIR}/writes/{directory}', exist_ok=True)
-            call(f"cp -r {write_path} {ARCHIVEDIR}/writes/{directory}", shell=True)
-            call(f"rm -rf {write_path}", shell=True)
+            warc_utils.move_path(write_path, f'{ARCHIVEDIR}/writes/{directory}/{os.path.basename(write_path)}')
         except Exception as e:
             print("Exception on uploading writes", str(e))
 
     def remove_write(self, directory):
         try:
-            call(f"rm -rf {ARCHIVEDIR}/writes/{directory}", shell=True)
+            shutil.rmtree(f"{ARCHIVEDIR}/writes/{directory}", ignore_errors=True)
         except Exception as e:
             print("Exception on removing writes", str(e))
     
@@ -309,71 +666,145 @@ class LocalUploadManager(BaseManager):
     def upload_warc(self, warc_path, col_name, directory='default', lock=True, mv_only=False):
         col_name = self.wb_manager.collection(col_name)
         try:
-            os.makedirs(f'{ARCHIVEDIR}/warcs/{directory}', exist_ok=True)
-            call(f"mv -f {warc_path} {ARCHIVEDIR}/warcs/{directory}", shell=True)
+            warc_utils.move_path(warc_path, f"{ARCHIVEDIR}/warcs/{directory}/{os.path.basename(warc_path)}", sidecars=WARC_SIDECARS)
+            warc_index.load_index(f"{ARCHIVEDIR}/warcs/{directory}/{os.path.basename(warc_path)}")
+            url_filter.warc_filter(f"{ARCHIVEDIR}/warcs/{directory}/{os.path.basename(warc_path)}")
             if mv_only:
                 return
             warc_name = warc_path.split('/')[-1]
-            command_prefix = f"{PYWBENV} && cd {ARCHIVEDIR}"
-            command_init = f"test -d {ARCHIVEDIR}/collections/{col_name} || ({command_prefix} && wb-manager init {col_name}) && touch {ARCHIVEDIR}/collections/{col_name}/lock"
-            call(command_init, shell=True)
+            init_collection(col_name)
 
             if lock:
                 self._lock(col_name)
             
-            command_add = f"{command_prefix} && wb-manager add {col_name} {ARCHIVEDIR}/warcs/{directory}/{warc_name}"
-            check_call(command_add, shell=True)
-            call(f"rm -rf {warc_path}", shell=True)
-
-            if lock:
-                self._unlock(col_name)
+            add_to_collection(col_name, [f"{ARCHIVEDIR}/warcs/{directory}/{warc_name}"])
         except Exception as e:
             print("Exception on uploading warc", str(e))
+        finally:
+            self._unlock(col_name)
     
+    def upload_batch(self, writes=(), warcs=(), screenshots=(), lock=True):
+        """
+        Same as SSHClientManager.upload_batch, but raises on failure (e.g. for upload_queue to retry).
+        Files already moved by a failed attempt are picked up from their destination, so it can be retried.
+        The warcs of each collection are added with one merge
+        """
+        for screenshot_path, directory in screenshots:
+            if os.path.exists(screenshot_path):
+                warc_utils.move_path(screenshot_path, f'{ARCHIVEDIR}/screenshots/{directory}/{os.path.basename(screenshot_path)}')
+        for write_path, directory in writes:
+            if os.path.exists(write_path):
+                warc_utils.move_path(write_path, f'{ARCHIVEDIR}/writes/{directory}/{os.path.basename(write_path)}')
+        col_warcs = defaultdict(list)
+        for warc_path, col_name, directory in warcs:
+            archive_path = f"{ARCHIVEDIR}/warcs/{directory}/{os.path.basename(warc_path)}"
+            if os.path.exists(warc_path):
+                warc_utils.move_path(warc_path, archive_path, sidecars=WARC_SIDECARS)
+            warc_index.load_index(archive_path)
+            url_filter.warc_filter(archive_path)
+            if col_name is not None:
+                col_warcs[self.wb_manager.collection(col_name)].append(archive_path)
+        for col_name, archive_paths in col_warcs.items():
+            init_collection(col_name)
+            try:
+                if lock:
+                    self._lock(col_name)
+                add_to_collection(col_name, archive_paths)
+            finally:
+                self._unlock(col_name)
+
     def remove_archive(self, col_name):
-        call(f"rm -rf {ARCHIVEDIR}/collections/{col_name}", shell=True)
+        shutil.rmtree(f"{ARCHIVEDIR}/collections/{col_name}", ignore_errors=True)
+
+    def remove_tenants(self, col_name, tenants=None, lock=True):
+        """Remove tenants (all of them if None) of the shared collection col_name (see tenant_index.remove_tenants)"""
+        if not os.path.exists(f'{ARCHIVEDIR}/collections/{col_name}'):
+            return set()
+        try:
+            if lock:
+                self._lock(col_name)
+            return tenant_index.remove_tenants(f'{ARCHIVEDIR}/collections/{col_name}', tenants)
+        finally:
+            self._unlock(col_name)
+
+    def _add_virtual_warc(self, warc_path, col_name):
+        """
+        Add a virtual warc (see warc_index.write_exclusion_manifest) to the collection without copying bytes
+        The source warc is linked as {source}.virtual (not picked up by wb-manager reindex or add_to_collection),
+        and the filtered index is written as a separate cdxj next to the collection's index.cdxj
+        """
+        source = json.load(open(warc_index.manifest_path(warc_path)))['source']
+        link_name = f'{os.path.basename(source)}.virtual'
+        link_path = f'{ARCHIVEDIR}/collections/{col_name}/archive/{link_name}'
+        if not os.path.lexists(link_path):
+            os.symlink(source, link_path)
+        index_file = f'{ARCHIVEDIR}/collections/{col_name}/indexes/{os.path.basename(warc_path)}.cdxj'
+        warc_index.write_pywb_index(warc_path, index_file, filename=link_name)
+
+    def _add_revisit_targets(self, warc_paths, col_name):
+        """
+        For deduplicated warcs (see crawl/warcprocess/dedup.py), make the original responses that revisits refer to
+        loadable by pywb. Only the referred records are indexed, from the original warc linked as {original}.virtual
+        """
+        uploaded = set(os.path.basename(w) for w in warc_paths)
+        targets = {}
+        for warc_path in warc_paths:
+            for original, entries in warc_index.revisit_targets(warc_path).items():
+                if os.path.basename(original) in uploaded:
+                    continue
+                targets.setdefault(original, {}).update({e.offset: e for e in entries})
+        for original, entries in targets.items():
+            link_name = f'{os.path.basename(original)}.virtual'
+            link_path = f'{ARCHIVEDIR}/collections/{col_name}/archive/{link_name}'
+            if not os.path.lexists(link_path):
+                os.symlink(os.path.abspath(original), link_path)
+            index_file = f'{ARCHIVEDIR}/collections/{col_name}/indexes/{os.path.basename(original)}.revisits.cdxj'
+            with open(index_file, 'w') as f:
+                for line in warc_index.pywb_lines(entries.values(), link_name):
+                    f.write(line + '\n')
 
     def _upload_worker(self, warc_paths, col_name, lock, archive_name=""):
         print("Uploading warcs to archive", col_name, warc_paths, flush=True)
         try:
-            command_prefix = f"{PYWBENV} && cd {ARCHIVEDIR}"
-            command_init = f"test -d {ARCHIVEDIR}/collections/{col_name} || ({command_prefix} && wb-manager init {col_name}) && touch {ARCHIVEDIR}/collections/{col_name}/lock"
-            call(command_init, shell=True)
+            init_collection(col_name)
             if lock:
                 self._lock(col_name)
                 
+            warc_paths = [w if warc_index.is_virtual(w) else warc_utils.resolve_warc(w) for w in warc_paths]
             for warc_path in warc_paths:
-                call(f'cp -r {warc_path} {ARCHIVEDIR}/collections/{col_name}/archive/', shell=True)
-            
-            command_reindex = f"{command_prefix} && wb-manager reindex {col_name}"
-            check_call(command_reindex, shell=True)
-            if lock:
-                self._unlock(col_name)
+                if warc_index.is_virtual(warc_path):
+                    self._add_virtual_warc(warc_path, col_name)
+            self._add_revisit_targets(warc_paths, col_name)
+            # * One incremental merge for the whole batch instead of a full reindex of the collection
+            add_to_collection(col_name, [w for w in warc_paths if not warc_index.is_virtual(w)])
             return archive_name
         except Exception as e:
             print("Exception _upload_worker", str(e))
+        finally:
+            self._unlock(col_name)
     
     def upload_warcs_to_archive(self, warc_paths_map, col_name, lock=True, separate_collection=False):
         """
-        warc_paths_map ({str: [str]}): {archive_name: [warc paths]}. If separate_collection is True, each sublist will be treated as a separate collection.
+        warc_paths_map ({str: [str]}): {archive_name: [warc paths]}.
+        If separate_collection is True, each sublist will be treated as a separate tenant (see tenant_index)
+        of the shared collection col_name, replayed through PYWBServer.select_tenant.
         """
         finished = set()
         if not separate_collection:
             warc_paths = [w for warcs in warc_paths_map.values() for w in warcs] # Flatten the list
-            self._upload_worker(warc_paths, col_name)
-        else: # Create a separate collection for each warc
-            with futures.ProcessPoolExecutor(max_workers=16) as executor:
-                results = []
-                count = 0 
-                for archive_name, warcs in warc_paths_map.items():
-                    col_name_sub = BaseManager.escape(f'{col_name}_{archive_name}')
-                    count += 1
-                    results.append(executor.submit(self._upload_worker, warcs, col_name_sub, lock, archive_name))
-                while len(results) > 0:
-                    try:
-                        for result in futures.as_completed(results, timeout=10):
-                            finished.add(result.result())
-                            results.remove(result)
-                    except Exception as e:
-                        print("Exception upload_warcs_to_archive", str(e))
-        return finished
\ No newline at end of file
+            self._upload_worker(warc_paths, col_name, lock)
+        else: # Add each sublist as a tenant of one shared index
+            init_collection(col_name)
+            try:
+                if lock:
+                    self._lock(col_name)
+                tenant_warcs = {archive_name: [w if warc_index.is_virtual(w) else warc_utils.resolve_warc(w) for w in warcs]
+                                for archive_name, warcs in warc_paths_map.items()}
+                num_lines = tenant_index.add_tenants(f'{ARCHIVEDIR}/collections/{col_name}', tenant_warcs)
+                finished = set(tenant_warcs)
+                print(f"Added {len(tenant_warcs)} tenants ({num_lines} index lines) to {col_name}", flush=True)
+            except Exception as e:
+                print("Exception upload_warcs_to_archive", str(e))
+            finally:
+                self._unlock(col_name)
+        return finished
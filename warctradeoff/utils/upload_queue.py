@@ -0,0 +1,202 @@
+"""
+Background uploads, so that crawl workers hand their WARCs and writes off and go on with the next URL
+Workers put jobs (batches for upload_batch of an upload manager) into a bounded queue, which blocks them
+once it is full (backpressure), and a few uploader threads take the jobs out and upload them.
+
+Jobs are written to a journal (JSON lines) when they are queued and when they are done, so that jobs that
+haven't finished (failed after MAX_RETRIES, or the process died) are queued again by the next UploadQueue
+on the same journal. Uploads are idempotent, as their local files are only removed once they are in.
+"""
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+from warctradeoff.utils import catalog
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_WORKERS = 2
+MAX_RETRIES = 3
+# * Seconds before the first retry of a job, doubled on each retry
+RETRY_DELAY = 5
+
+
+class UploadQueue:
+    def __init__(self, client_factory, num_workers=DEFAULT_WORKERS, max_size=DEFAULT_QUEUE_SIZE, journal=None):
+        """
+        Args:
+            client_factory: Returns a new upload manager (e.g. upload.LocalUploadManager), one per uploader thread
+            max_size: Maximum number of queued jobs. put blocks while the queue is full
+            journal: Path of the journal. Unfinished jobs in it are queued again. None for no persistence
+        """
+        self.client_factory = client_factory
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=max_size)
+        self.journal = journal
+        self.journal_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.next_id = 0
+        self.threads = []
+        self.stats = {'queued': 0, 'done': 0, 'failed': 0, 'retries': 0, 'put_wait': 0.0, 'upload_time': 0.0}
+        self.recovered = self._recover()
+
+    def _recover(self) -> list:
+        """Unfinished jobs of the journal. The journal is rewritten with only them"""
+        if self.journal is None or not os.path.exists(self.journal):
+            return []
+        jobs = {}
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # * Torn last line of a process that died
+                if 'done' in record:
+                    jobs.pop(record['done'], None)
+                else:
+                    jobs[record['id']] = record
+        jobs = list(jobs.values())
+        for i, job in enumerate(jobs):
+            job['id'] = i
+        self.next_id = len(jobs)
+        tmp_path = f'{self.journal}.tmp'
+        with open(tmp_path, 'w') as f:
+            for job in jobs:
+                f.write(json.dumps(job) + '\n')
+        os.replace(tmp_path, self.journal)
+        if jobs:
+            logging.info(f'UploadQueue: Recovered {len(jobs)} unfinished jobs from {self.journal}')
+        return jobs
+
+    def _log(self, record):
+        if self.journal is None:
+            return
+        with self.journal_lock:
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name=f'uploader-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        for job in self.recovered:
+            self._enqueue(job)
+        self.recovered = []
+        return self
+
+    def _enqueue(self, job):
+        start = time.time()
+        self.queue.put(job)
+        waited = time.time() - start
+        with self.stats_lock:
+            self.stats['queued'] += 1
+            self.stats['put_wait'] += waited
+        if waited > 1:
+            logging.info(f'UploadQueue: Waited {waited:.1f}s for room in the queue')
+
+    def put(self, writes=(), warcs=(), screenshots=(), lock=True, catalog_updates=None):
+        """
+        Queue a batch (see SSHClientManager.upload_batch). Blocks while the queue is full
+        Args:
+            catalog_updates: {'archive': [col, archive_name], 'warcs': [col, [warcs]]} to update in the catalog once uploaded
+        """
+        with self.journal_lock:
+            job_id = self.next_id
+            self.next_id += 1
+        job = {'id': job_id, 'writes': [list(w) for w in writes], 'warcs': [list(w) for w in warcs],
+               'screenshots': [list(s) for s in screenshots], 'lock': lock, 'catalog': catalog_updates}
+        self._log(job)
+        self._enqueue(job)
+
+    def _upload(self, client, job):
+        client.upload_batch(writes=job['writes'], warcs=job['warcs'], screenshots=job['screenshots'], lock=job['lock'])
+        updates = job.get('catalog') or {}
+        if 'archive' in updates:
+            catalog.update_archive(*updates['archive'])
+        if 'warcs' in updates:
+            catalog.update_warcs(*updates['warcs'])
+
+    def _connect(self):
+        """New client of the uploader thread, retried like jobs. None if it can't connect"""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return self.client_factory()
+            except Exception as e:
+                logging.error(f'UploadQueue: Attempt {attempt} to connect failed: {e}')
+                if attempt < MAX_RETRIES:
+                    time.sleep(RETRY_DELAY * 2 ** attempt)
+        return None
+
+    def _worker(self):
+        client = None
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    self.queue.task_done()
+                    return
+                start = time.time()
+                if client is None:
+                    client = self._connect()
+                if client is None:
+                    # * Keep draining, so that flush returns. The job is left unfinished in the journal
+                    with self.stats_lock:
+                        self.stats['failed'] += 1
+                    self.queue.task_done()
+                    continue
+                for attempt in range(MAX_RETRIES + 1):
+                    try:
+                        self._upload(client, job)
+                        self._log({'done': job['id']})
+                        with self.stats_lock:
+                            self.stats['done'] += 1
+                        break
+                    except Exception as e:
+                        logging.error(f'UploadQueue: Attempt {attempt} of job {job["id"]} failed: {e}')
+                        if attempt == MAX_RETRIES:
+                            # * Left unfinished in the journal, for the next UploadQueue
+                            with self.stats_lock:
+                                self.stats['failed'] += 1
+                            break
+                        with self.stats_lock:
+                            self.stats['retries'] += 1
+                        time.sleep(RETRY_DELAY * 2 ** attempt)
+                with self.stats_lock:
+                    self.stats['upload_time'] += time.time() - start
+                self.queue.task_done()
+        finally:
+            if client is not None:
+                client.close()
+
+    def flush(self, timeout=None) -> int:
+        """
+        Wait until every queued job is done or has failed. Returns the number of failed jobs so far
+        Raises TimeoutError after timeout seconds, and RuntimeError if no uploader thread is left to do the jobs
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if not any(thread.is_alive() for thread in self.threads):
+                    raise RuntimeError(f'UploadQueue: No uploader thread left for {self.queue.unfinished_tasks} jobs')
+                wait = 1
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError(f'UploadQueue: {self.queue.unfinished_tasks} jobs left after {timeout}s')
+                    wait = min(wait, remaining)
+                self.queue.all_tasks_done.wait(wait)
+        return self.stats['failed']
+
+    def close(self, timeout=None) -> dict:
+        """Flush, and stop the uploader threads. Returns the stats"""
+        self.flush(timeout=timeout)
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        logging.info(f'UploadQueue: {self.stats}')
+        return self.stats
@@ -0,0 +1,131 @@
+"""
+Bloom filters of the target URIs in WARCs, to answer "may crawl X contain URL u?" without opening the WARC
+URLs are normalized with url_utils.url_norm (see norm_url) before they are added or queried.
+
+Each WARC has a sidecar ({warc}.bloom), and a group of WARCs (e.g. all archives of a site at one timestamp)
+can have a filter over the union of their URLs. Filters are rebuilt when the WARCs they cover change.
+A negative answer is exact, a positive one may be a false positive (FP_RATE), so positives still need the WARC.
+"""
+import os
+import json
+import math
+import hashlib
+
+from warctradeoff.utils import url_utils, warc_utils, warc_index
+
+BLOOM_SUFFIX = '.bloom'
+FP_RATE = 0.01
+# * Record types whose target URI is added to the filter
+FILTER_REC_TYPES = ['response', 'revisit', 'resource']
+
+def norm_url(url) -> str:
+    return url_utils.url_norm(url, ignore_scheme=True, trim_slash=True)
+
+
+class BloomFilter:
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate=FP_RATE):
+        capacity = max(capacity, 1)
+        num_bits = max(64, int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, url):
+        # * Double hashing: positions h1 + i * h2 of one 128-bit digest
+        digest = hashlib.blake2b(norm_url(url).encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, url):
+        for pos in self._positions(url):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, url) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(url))
+
+    def dump(self, path, sources):
+        """Write the filter, with fingerprints of the WARCs it covers ({name: [size, mtime]})"""
+        meta = {'num_bits': self.num_bits, 'num_hashes': self.num_hashes, 'count': self.count, 'sources': sources}
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode() + b'\n')
+            f.write(bytes(self.bits))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> "(BloomFilter, dict)":
+        with open(path, 'rb') as f:
+            meta = json.loads(f.readline())
+            bits = bytearray(f.read())
+        return cls(meta['num_bits'], meta['num_hashes'], bits, meta['count']), meta['sources']
+
+
+def bloom_path(warc) -> str:
+    return f'{warc}{BLOOM_SUFFIX}'
+
+def _sources(warcs) -> dict:
+    sources = {}
+    for warc in warcs:
+        stat = os.stat(warc)
+        sources[os.path.basename(warc)] = [stat.st_size, stat.st_mtime]
+    return sources
+
+def group_path(warc_dir, site, ts) -> str:
+    """Path of the filter over all archives of site crawled at ts"""
+    return f'{warc_dir}/bloom/{site}_{ts}{BLOOM_SUFFIX}'
+
+def _target_urls(warc) -> set:
+    index = warc_index.load_index(warc)
+    return set(e.url for e in index.entries if e.url is not None and e.rec_type in FILTER_REC_TYPES)
+
+def build_filter(warcs, path) -> BloomFilter:
+    """Build the filter over the target URIs of warcs (from their CDXJ sidecars) and write it to path"""
+    warcs = [warc_utils.resolve_warc(w) for w in warcs]
+    urls = set()
+    for warc in warcs:
+        urls |= _target_urls(warc)
+    bloom = BloomFilter.for_capacity(len(urls))
+    for url in urls:
+        bloom.add(url)
+    bloom.dump(path, _sources(warcs))
+    return bloom
+
+def load_filter(warcs, path, build=True) -> "BloomFilter | None":
+    """Filter at path over warcs, rebuilt (if build is set) if it is missing or any of warcs changed"""
+    warcs = [warc_utils.resolve_warc(w) for w in warcs]
+    warcs = [w for w in warcs if os.path.exists(w)]
+    if os.path.exists(path):
+        bloom, sources = BloomFilter.load(path)
+        if sources == json.loads(json.dumps(_sources(warcs))):
+            return bloom
+    if not build:
+        return None
+    return build_filter(warcs, path)
+
+def warc_filter(warc, build=True) -> "BloomFilter | None":
+    """Filter of a single WARC ({warc}.bloom)"""
+    warc = warc_utils.resolve_warc(warc)
+    if not os.path.exists(warc):
+        return None
+    return load_filter([warc], bloom_path(warc), build=build)
+
+def may_contain(warc, url) -> bool:
+    """False if warc surely has no record of url. Missing WARCs contain nothing"""
+    bloom = warc_filter(warc)
+    return bloom is not None and url in bloom
+
+def group_filter(warcs, path, build=True) -> "BloomFilter | None":
+    """Filter over the union of URLs of warcs, e.g. all archives of a site at one timestamp (see group_path)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return load_filter(warcs, path, build=build)
+
+def candidate_warcs(warcs, url) -> list:
+    """warcs that may contain url (the others are pruned without being opened)"""
+    return [warc for warc in warcs if may_contain(warc, url)]
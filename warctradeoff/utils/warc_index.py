@@ -0,0 +1,546 @@
+"""
+Byte-offset index sidecar ({warc}.cdxj) for WARC files
+Each line is CDXJ-style: "{surt} {ts} {json}", with json containing url, type, mime, status, digest, offset, length and filename.
+The sidecar is written when the WARC is produced (extract/upload), or lazily on the first lookup.
+
+A filtered WARC can also be virtual: only an exclusion manifest ({warc}.exclude.json) is written,
+and the view is the index of the source WARC with the excluded records dropped.
+"""
+import io
+import os
+import re
+import json
+import heapq
+from collections import namedtuple, defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+import surt
+from warcio.archiveiterator import ArchiveIterator
+
+from warctradeoff.utils import warc_utils, pool
+
+INDEX_SUFFIX = '.cdxj'
+MANIFEST_SUFFIX = '.exclude.json'
+# * Record types that pywb serves from its index
+PYWB_REC_TYPES = ['response', 'revisit', 'resource']
+# * Index of a pywb collection that wb-manager add/reindex write to
+COLLECTION_INDEX = 'index.cdxj'
+FILENAME_FIELD = re.compile(r'"filename":\s*"((?:[^"\\]|\\.)*)"')
+
+IndexEntry = namedtuple('IndexEntry', ['url', 'rec_type', 'ts', 'offset', 'length', 'mime', 'status', 'digest'])
+
+INDEX_CACHE = {}
+
+# * WARCs larger than SHARD_THRESHOLD are scanned in shards of about SHARD_SIZE by up to SHARD_WORKERS processes,
+# * within the process budget of the caller (see pool.worker_budget)
+SHARD_THRESHOLD = 256 << 20
+SHARD_SIZE = 64 << 20
+SHARD_WORKERS = 4
+
+def index_path(warc) -> str:
+    return f'{warc}{INDEX_SUFFIX}'
+
+def _warc_ts(warc_date) -> str:
+    return re.sub(r'\D', '', warc_date or '')[:14]
+
+def _surt(url) -> str:
+    try:
+        return surt.surt(url)
+    except Exception:
+        return url
+
+def entry_from_record(record, offset, length=None) -> IndexEntry:
+    """Index information of a record. Payload is not read"""
+    url = record.rec_headers.get_header('WARC-Target-URI')
+    mime, status = None, None
+    if record.rec_type == 'revisit':
+        mime = 'warc/revisit'
+    elif record.http_headers is not None:
+        mime = record.http_headers.get_header('Content-Type')
+    if mime is None:
+        mime = record.rec_headers.get_header('Content-Type', '')
+    mime = mime.split(';')[0].strip()
+    if record.http_headers is not None and record.rec_type in ['response', 'revisit']:
+        status = record.http_headers.get_statuscode()
+    return IndexEntry(url=url,
+                      rec_type=record.rec_type,
+                      ts=_warc_ts(record.rec_headers.get_header('WARC-Date')),
+                      offset=offset,
+                      length=length,
+                      mime=mime,
+                      status=status,
+                      digest=record.rec_headers.get_header('WARC-Payload-Digest'))
+
+def _no_classify(record):
+    return None
+
+def scan_shard(warc, start, end, classify=_no_classify) -> list:
+    """
+    [(IndexEntry, classify(record))] of records starting in [start, end) of warc. start needs to be a record boundary
+    classify runs while the record is current, so it can look at the headers (and payload) of the record
+    """
+    scanned = []
+    with open(warc, 'rb') as f:
+        f.seek(start)
+        for record, offset in warc_utils.iter_warc_records(f):
+            if offset >= end:
+                break
+            scanned.append((entry_from_record(record, offset), classify(record)))
+    spans = warc_utils.record_spans([e.offset for e, _ in scanned], end)
+    return [(e._replace(length=length), value) for (e, value), (_, length) in zip(scanned, spans)]
+
+def _header_scan_offsets(warc, min_gap) -> list:
+    """
+    Start offsets of records in an uncompressed WARC, at least min_gap apart
+    Only WARC headers are read, payloads are skipped by Content-Length
+    """
+    offsets = []
+    file_size = os.path.getsize(warc)
+    with open(warc, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            line = f.readline()
+            while line in [b'\r\n', b'\n']:
+                offset = f.tell()
+                line = f.readline()
+            if not line:
+                break
+            if not line.startswith(b'WARC/'):
+                raise ValueError(f'No WARC record at offset {offset} of {warc}')
+            length = 0
+            for line in iter(f.readline, b''):
+                if line in [b'\r\n', b'\n']:
+                    break
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value.strip())
+            if len(offsets) == 0 or offset - offsets[-1] >= min_gap:
+                offsets.append(offset)
+            offset = f.tell() + length
+    return offsets
+
+def shard_ranges(warc, shard_size=None) -> list:
+    """
+    Split warc into record-aligned (start, end) byte ranges of about shard_size
+    Boundaries come from the sidecar if it is fresh, otherwise from a header scan (uncompressed WARCs only)
+    """
+    shard_size = shard_size or SHARD_SIZE
+    file_size = os.path.getsize(warc)
+    if file_size <= shard_size:
+        return [(0, file_size)]
+    if index_fresh(warc):
+        with open(index_path(warc)) as f:
+            offsets = sorted(parse_line(line).offset for line in f if not line.startswith('!'))
+    else:
+        with open(warc, 'rb') as f:
+            if warc_utils.is_gzip_warc(f):
+                # * Finding member boundaries needs decompressing every member, which is the scan itself
+                return [(0, file_size)]
+        offsets = _header_scan_offsets(warc, shard_size)
+    starts = [0]
+    for offset in offsets:
+        if offset - starts[-1] >= shard_size:
+            starts.append(offset)
+    return list(zip(starts, starts[1:] + [file_size]))
+
+def scan_sharded(warc, classify=_no_classify, num_workers=None) -> list:
+    """
+    Same as scan_shard over the whole warc. WARCs larger than SHARD_THRESHOLD are split by shard_ranges
+    and the shards are scanned in parallel processes (classify needs to be picklable, and small), then concatenated in order
+    num_workers defaults to the process budget of the caller, so a run_tasks worker without spare CPUs scans in process
+    """
+    num_workers = num_workers or pool.worker_budget(SHARD_WORKERS)
+    file_size = os.path.getsize(warc)
+    shards = shard_ranges(warc) if file_size > SHARD_THRESHOLD and num_workers > 1 else [(0, file_size)]
+    if len(shards) == 1:
+        return scan_shard(warc, 0, file_size, classify)
+    scanned = []
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(shards))) as executor:
+        results = [executor.submit(scan_shard, warc, start, end, classify) for start, end in shards]
+        for r in results:
+            scanned += r.result()
+    return scanned
+
+def scan_entries(warc) -> list:
+    """Scan the whole WARC once for IndexEntry of every record (in file order)"""
+    return [e for e, _ in scan_sharded(warc)]
+
+def relocate_entries(entries) -> list:
+    """Offsets of entries after they are copied back to back into a new WARC"""
+    relocated, offset = [], 0
+    for entry in entries:
+        relocated.append(entry._replace(offset=offset))
+        offset += entry.length
+    return relocated
+
+def entry_line(entry: IndexEntry, filename) -> str:
+    obj = {
+        'url': entry.url,
+        'type': entry.rec_type,
+        'mime': entry.mime,
+        'status': entry.status,
+        'digest': entry.digest,
+        'length': str(entry.length),
+        'offset': str(entry.offset),
+        'filename': filename,
+    }
+    obj = {k: v for k, v in obj.items() if v is not None}
+    key = _surt(entry.url) if entry.url is not None else '-'
+    return f'{key} {entry.ts} {json.dumps(obj)}'
+
+def parse_line(line) -> IndexEntry:
+    _, ts, obj = line.rstrip('\n').split(' ', 2)
+    obj = json.loads(obj)
+    return IndexEntry(url=obj.get('url'),
+                      rec_type=obj.get('type', 'response'),
+                      ts=ts,
+                      offset=int(obj['offset']),
+                      length=int(obj['length']),
+                      mime=obj.get('mime'),
+                      status=obj.get('status'),
+                      digest=obj.get('digest'))
+
+def write_index(warc, entries):
+    """Write the sidecar for warc. Entries need to have offset and length filled"""
+    stat = os.stat(warc)
+    filename = os.path.basename(warc)
+    lines = sorted(entry_line(e, filename) for e in entries)
+    meta = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    tmp_path = f'{index_path(warc)}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(f'!meta {json.dumps(meta)}\n')
+        for line in lines:
+            f.write(line + '\n')
+    os.replace(tmp_path, index_path(warc))
+
+def build_index(warc) -> list:
+    entries = scan_entries(warc)
+    write_index(warc, entries)
+    return entries
+
+def remove_outputs(output_warc):
+    """Remove every form of output_warc (plain, gzip, virtual) and their sidecars"""
+    gzip_warc = f'{output_warc}{warc_utils.GZIP_SUFFIX}'
+    for path in [output_warc, index_path(output_warc), gzip_warc, index_path(gzip_warc), manifest_path(output_warc)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_filtered(input_warc, output_warc, entries, compress=False) -> str:
+    """
+    Write entries (records of input_warc) to output_warc as raw bytes, and write its sidecar
+    If compress is set, the output is written to {output_warc}.gz with one gzip member per record
+    Returns:
+        path of the written warc
+    """
+    remove_outputs(output_warc)
+    if compress:
+        output_warc = f'{output_warc}{warc_utils.GZIP_SUFFIX}'
+    with open(input_warc, 'rb') as iw, open(output_warc, 'wb') as fw:
+        copier = warc_utils.WarcCopier(iw, fw, compress=compress)
+        copier.copy([(e.offset, e.length) for e in entries])
+        spans = copier.close()
+    write_index(output_warc, [e._replace(offset=offset, length=length) for e, (offset, length) in zip(entries, spans)])
+    return output_warc
+
+def manifest_path(warc) -> str:
+    return f'{warc}{MANIFEST_SUFFIX}'
+
+def is_virtual(warc) -> bool:
+    return not os.path.exists(warc_utils.resolve_warc(warc)) and os.path.exists(manifest_path(warc))
+
+def warc_exists(warc) -> bool:
+    """Whether warc exists, either as a file (plain or gzip) or as a virtual WARC"""
+    return os.path.exists(warc_utils.resolve_warc(warc)) or os.path.exists(manifest_path(warc))
+
+def write_exclusion_manifest(input_warc, output_warc, exclude_entries):
+    """
+    Make output_warc a virtual WARC: input_warc without exclude_entries
+    No bytes are copied. Existing materialized output_warc (and its sidecar) is removed.
+    """
+    remove_outputs(output_warc)
+    if not index_fresh(input_warc):
+        build_index(input_warc)
+    stat = os.stat(input_warc)
+    manifest = {
+        'source': os.path.abspath(input_warc),
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'exclude': [{'url': e.url, 'offset': e.offset} for e in exclude_entries],
+    }
+    json.dump(manifest, open(manifest_path(output_warc), 'w+'), indent=2)
+
+def virtual_entries(warc) -> "(str, list)":
+    """Source WARC and its entries (in file order) that are visible in the virtual warc"""
+    manifest = json.load(open(manifest_path(warc)))
+    source = manifest['source']
+    stat = os.stat(source)
+    # * Same check as index_fresh: a source rewritten in place at the same size has different offsets
+    if stat.st_size != manifest['source_size'] or stat.st_mtime != manifest.get('source_mtime'):
+        raise ValueError(f'Source {source} of virtual warc {warc} has changed')
+    exclude_offsets = set(e['offset'] for e in manifest['exclude'])
+    entries = sorted(load_index(source).entries, key=lambda e: e.offset)
+    return source, [e for e in entries if e.offset not in exclude_offsets]
+
+def pywb_lines(entries, filename) -> list:
+    """Sorted CDXJ lines of entries that pywb can load"""
+    lines = []
+    for entry in entries:
+        if entry.url is None or entry.rec_type not in PYWB_REC_TYPES:
+            continue
+        digest = entry.digest
+        if digest and digest.startswith('sha1:'):
+            digest = digest[len('sha1:'):]
+        line = entry_line(entry._replace(digest=digest, rec_type=None), filename)
+        lines.append(line)
+    return sorted(lines)
+
+def merge_pywb_index(index_file, warc_filenames):
+    """
+    Merge the pywb lines of several warcs into the sorted index_file in one pass, as wb-manager add/reindex would
+    Lines of index_file that point to one of the filenames are replaced, so re-adding a warc doesn't duplicate it.
+    Args:
+        warc_filenames: [(warc, filename)], filename being relative to the collection's archive directory
+    """
+    new_lines = []
+    for warc, filename in warc_filenames:
+        source = warc_utils.resolve_warc(warc)
+        new_lines += pywb_lines(load_index(source).entries, filename)
+    new_lines.sort()
+    replaced = set(filename for _, filename in warc_filenames)
+
+    def kept_lines(f):
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            match = FILENAME_FIELD.search(line)
+            if match and json.loads(f'"{match.group(1)}"') in replaced:
+                continue
+            yield line
+
+    tmp_file = f'{index_file}.tmp'
+    old = open(index_file) if os.path.exists(index_file) else io.StringIO()
+    with old, open(tmp_file, 'w') as f:
+        for line in heapq.merge(kept_lines(old), new_lines):
+            f.write(line + '\n')
+    os.replace(tmp_file, index_file)
+    return len(new_lines)
+
+def merge_index_files(index_file, sources, skip_filenames=()) -> int:
+    """
+    k-way merge of sorted CDXJ files (e.g. the indexes of several pywb collections) into the sorted index_file
+    Only index lines are read, never the WARCs they point to. Returns the number of lines merged from sources
+    Args:
+        skip_filenames: Lines of sources pointing to these filenames are left out (e.g. already in index_file)
+    """
+    merged = 0
+    skip_filenames = set(skip_filenames)
+    def source_lines(f):
+        nonlocal merged
+        for line in f:
+            line = line.rstrip('\n')
+            if line and skip_filenames:
+                match = FILENAME_FIELD.search(line)
+                if match and json.loads(f'"{match.group(1)}"') in skip_filenames:
+                    continue
+            if line:
+                merged += 1
+                yield line
+
+    tmp_file = f'{index_file}.tmp'
+    files = [open(index_file)] if os.path.exists(index_file) else []
+    existing = len(files)
+    files += [open(source) for source in sources]
+    try:
+        with open(tmp_file, 'w') as f:
+            streams = [(line.rstrip('\n') for line in files[0] if line.strip())] if existing else []
+            streams += [source_lines(sf) for sf in files[existing:]]
+            for line in heapq.merge(*streams):
+                f.write(line + '\n')
+    finally:
+        for sf in files:
+            sf.close()
+    os.replace(tmp_file, index_file)
+    return merged
+
+def write_pywb_index(warc, index_file, filename=None):
+    """
+    Write pywb CDXJ index of warc (real or virtual) to index_file
+    Args:
+        filename: filename (relative to the collection's archive directory) that pywb loads the records from.
+    """
+    if is_virtual(warc):
+        source, entries = virtual_entries(warc)
+    else:
+        source = warc_utils.resolve_warc(warc)
+        entries = sorted(load_index(source).entries, key=lambda e: e.offset)
+    filename = filename or os.path.basename(source)
+    with open(index_file, 'w') as f:
+        for line in pywb_lines(entries, filename):
+            f.write(line + '\n')
+
+def index_fresh(warc) -> bool:
+    path = index_path(warc)
+    if not os.path.exists(path) or not os.path.exists(warc):
+        return False
+    with open(path) as f:
+        line = f.readline()
+    if not line.startswith('!meta '):
+        return False
+    meta = json.loads(line[len('!meta '):])
+    stat = os.stat(warc)
+    return meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime
+
+
+class WarcIndex:
+    """Index of warc. For virtual WARCs, warc is the source WARC that entries point into"""
+    def __init__(self, warc, entries):
+        self.warc = warc
+        self.entries = entries
+        self.url_entries = defaultdict(list)
+        for entry in entries:
+            self.url_entries[entry.url].append(entry)
+
+    def lookup(self, url, rec_type='response') -> "IndexEntry | None":
+        """First (by offset) record of url with rec_type"""
+        entries = [e for e in self.url_entries.get(url, []) if rec_type is None or e.rec_type == rec_type]
+        if len(entries) == 0:
+            return None
+        return min(entries, key=lambda e: e.offset)
+
+    def lookup_all(self, url, rec_type='response') -> list:
+        return sorted([e for e in self.url_entries.get(url, []) if rec_type is None or e.rec_type == rec_type],
+                      key=lambda e: e.offset)
+
+    def urls(self, rec_type='response') -> list:
+        return [url for url, entries in self.url_entries.items() if url is not None and any(rec_type is None or e.rec_type == rec_type for e in entries)]
+
+
+def load_index(warc, build=True) -> "WarcIndex | None":
+    """Load the sidecar of warc. If the sidecar is missing or stale, build it (if build is set)"""
+    if is_virtual(warc):
+        source, entries = virtual_entries(warc)
+        return WarcIndex(source, entries)
+    warc = warc_utils.resolve_warc(warc)
+    if not os.path.exists(warc):
+        return None
+    stat = os.stat(warc)
+    cache_key = (warc, stat.st_size, stat.st_mtime)
+    if cache_key in INDEX_CACHE:
+        return INDEX_CACHE[cache_key]
+    if index_fresh(warc):
+        with open(index_path(warc)) as f:
+            entries = [parse_line(line) for line in f if not line.startswith('!')]
+    elif build:
+        entries = build_index(warc)
+    else:
+        return None
+    index = WarcIndex(warc, entries)
+    INDEX_CACHE[cache_key] = index
+    return index
+
+def read_entry(warc, entry: IndexEntry):
+    """Read the record pointed by entry with a single seek. The record's content is kept in memory"""
+    with open(warc, 'rb') as f:
+        f.seek(entry.offset)
+        data = f.read(entry.length)
+    return next(iter(ArchiveIterator(io.BytesIO(data))))
+
+def resolve_revisit(warc, record):
+    """
+    Original response record that a revisit record in warc refers to. Return None if not found
+    The original is looked up in WARC-Refers-To-Filename (in the same directory as warc), or in warc itself,
+    by WARC-Refers-To-Target-URI and payload digest.
+    """
+    index = load_index(warc)
+    source = index.warc if index is not None else warc
+    filename = record.rec_headers.get_header('WARC-Refers-To-Filename')
+    if filename:
+        source = os.path.join(os.path.dirname(source), filename)
+    url = record.rec_headers.get_header('WARC-Refers-To-Target-URI') or record.rec_headers.get_header('WARC-Target-URI')
+    digest = record.rec_headers.get_header('WARC-Payload-Digest')
+    entry = lookup_original(source, url, digest)
+    if entry is None:
+        return None
+    return read_entry(source, entry)
+
+def lookup_original(warc, url, digest) -> "IndexEntry | None":
+    index = load_index(warc)
+    if index is None:
+        return None
+    for entry in index.lookup_all(url, 'response'):
+        if digest is None or entry.digest == digest:
+            return entry
+    return None
+
+def revisit_targets(warc) -> "dict[str, list]":
+    """{original warc: [IndexEntry]} of the responses that revisit records in warc (real or virtual) refer to"""
+    index = load_index(warc)
+    targets = defaultdict(list)
+    if index is None:
+        return targets
+    for entry in index.entries:
+        if entry.rec_type != 'revisit':
+            continue
+        record = read_entry(index.warc, entry)
+        filename = record.rec_headers.get_header('WARC-Refers-To-Filename')
+        source = os.path.join(os.path.dirname(index.warc), filename) if filename else index.warc
+        url = record.rec_headers.get_header('WARC-Refers-To-Target-URI') or entry.url
+        original = lookup_original(source, url, entry.digest)
+        if original is not None and original not in targets[source]:
+            targets[source].append(original)
+    return targets
+
+def seek_record(warc, url, rec_type='response'):
+    """
+    Get the record of url in warc without scanning the WARC. Return None if not found
+    If a response is asked for and url only has a revisit record, the original response is returned.
+    """
+    index = load_index(warc)
+    if index is None:
+        return None
+    entry = index.lookup(url, rec_type)
+    if entry is None and rec_type == 'response':
+        entry = index.lookup(url, 'revisit')
+        if entry is None:
+            return None
+        return resolve_revisit(warc, read_entry(index.warc, entry))
+    if entry is None:
+        return None
+    return read_entry(index.warc, entry)
+
+
+class IndexedResponses(Mapping):
+    """
+    {url: set(response payloads)} view of a WARC, same as warc_utils.read_warc_responses
+    Payloads are only read when accessed. Revisit records are resolved to their original payloads.
+    """
+    def __init__(self, warc):
+        self.warc = warc
+        self.index = load_index(warc)
+        self._urls = set()
+        if self.index:
+            self._urls = set(self.index.urls('response')) | set(self.index.urls('revisit'))
+
+    def _payload(self, entry):
+        record = read_entry(self.index.warc, entry)
+        if entry.rec_type == 'revisit':
+            record = resolve_revisit(self.warc, record)
+        return record.content_stream().read() if record is not None else None
+
+    def __getitem__(self, url):
+        if url not in self._urls:
+            raise KeyError(url)
+        entries = self.index.lookup_all(url, 'response') + self.index.lookup_all(url, 'revisit')
+        return set(p for p in (self._payload(e) for e in entries) if p is not None)
+
+    def __contains__(self, url):
+        return url in self._urls
+
+    def __iter__(self):
+        return iter(self._urls)
+
+    def __len__(self):
+        return len(self._urls)
@@ -1,7 +1,22 @@
 import os
+import io
+import zlib
+import fcntl
+import shutil
+import hashlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from warcio.archiveiterator import ArchiveIterator
-from collections import defaultdict
+from warcio.warcwriter import WARCWriter
+
+COPY_BUFFER = 1 << 20
+GZIP_SUFFIX = '.gz'
+GZIP_LEVEL = 6
+# * ioctl that clones a file's extents (copy-on-write), on filesystems that support it (e.g. btrfs, xfs)
+FICLONE = 0x40049409
+# * Record types that carry a response. revisit records (see crawl/warcprocess/dedup.py) share the payload of an earlier response
+RESPONSE_TYPES = ['response', 'revisit']
 
 def strip_url(url):
     return url
@@ -9,7 +24,18 @@ def strip_url(url):
     us = us._replace(query='', fragment='')
     return urlunsplit(us)
 
+def resolve_warc(warc) -> str:
+    """Path of warc as it is on disk: warc itself, or its per-record gzip form {warc}.gz"""
+    if not os.path.exists(warc) and not warc.endswith(GZIP_SUFFIX) and os.path.exists(f'{warc}{GZIP_SUFFIX}'):
+        return f'{warc}{GZIP_SUFFIX}'
+    return warc
+
+def strip_gzip_suffix(warc) -> str:
+    return warc[:-len(GZIP_SUFFIX)] if warc.endswith(GZIP_SUFFIX) else warc
+
 def read_warc_responses(warc_file):
+    from warctradeoff.utils import warc_index
+    warc_file = resolve_warc(warc_file)
     url_response = defaultdict(set)
     if not os.path.exists(warc_file):
         return url_response
@@ -19,4 +45,301 @@ def read_warc_responses(warc_file):
                 url = record.rec_headers.get_header('WARC-Target-URI')
                 content = record.content_stream().read()
                 url_response[strip_url(url)].add(content)
-    return url_response
\ No newline at end of file
+            elif record.rec_type == 'revisit':
+                url = record.rec_headers.get_header('WARC-Target-URI')
+                original = warc_index.resolve_revisit(warc_file, record)
+                if original is not None:
+                    url_response[strip_url(url)].add(original.content_stream().read())
+    return url_response
+
+def payload_digest(record) -> str:
+    """sha1 of the (decoded) payload of record, hashed in chunks without holding the payload in memory"""
+    sha1 = hashlib.sha1()
+    stream = record.content_stream()
+    while True:
+        chunk = stream.read(COPY_BUFFER)
+        if not chunk:
+            break
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class PayloadHandle:
+    """Lazy handle to the payload of a response (or revisit) record at offset of warc_file"""
+    def __init__(self, warc_file, offset):
+        self.warc_file = warc_file
+        self.offset = offset
+
+    def read(self) -> bytes:
+        from warctradeoff.utils import warc_index
+        with open(self.warc_file, 'rb') as f:
+            f.seek(self.offset)
+            record = next(iter(ArchiveIterator(f)))
+            if record.rec_type == 'revisit':
+                record = warc_index.resolve_revisit(self.warc_file, record)
+                if record is None:
+                    return None
+            return record.content_stream().read()
+
+
+def iter_response_digests(warc_file):
+    """Iterate (url, payload digest, offset) of responses in warc_file. Revisits are resolved to their original payload"""
+    from warctradeoff.utils import warc_index
+    warc_file = resolve_warc(warc_file)
+    if not os.path.exists(warc_file):
+        return
+    with open(warc_file, 'rb') as f:
+        for record, offset in iter_warc_records(f):
+            if record.rec_type not in RESPONSE_TYPES:
+                continue
+            url = record.rec_headers.get_header('WARC-Target-URI')
+            if record.rec_type == 'revisit':
+                record = warc_index.resolve_revisit(warc_file, record)
+                if record is None:
+                    continue
+            yield strip_url(url), payload_digest(record), offset
+
+def read_warc_digests(warc_file, handles=False):
+    """
+    Streaming version of read_warc_responses that keeps payload digests instead of payloads
+    Memory depends on the number of responses, not on the size of the WARC.
+    Returns:
+        {url: set(digests)}, or {url: {digest: PayloadHandle}} if handles is set (handles read the payload on demand)
+    """
+    warc_file = resolve_warc(warc_file)
+    if handles:
+        url_digests = defaultdict(dict)
+        for url, digest, offset in iter_response_digests(warc_file):
+            url_digests[url].setdefault(digest, PayloadHandle(warc_file, offset))
+    else:
+        url_digests = defaultdict(set)
+        for url, digest, _ in iter_response_digests(warc_file):
+            url_digests[url].add(digest)
+    return url_digests
+
+def iter_warc_records(fileobj):
+    """
+    Iterate (record, offset) over a WARC, where offset is where the record starts in the file.
+    The record needs to be consumed before moving to the next one, same as ArchiveIterator.
+    """
+    iterator = ArchiveIterator(fileobj)
+    for record in iterator:
+        yield record, iterator.offset
+
+def record_spans(offsets, file_size) -> list:
+    """Turn record start offsets into (offset, length) spans, where each span runs to the start of the next record"""
+    ends = offsets[1:] + [file_size]
+    return [(start, end - start) for start, end in zip(offsets, ends)]
+
+def merge_spans(spans) -> list:
+    """Merge adjacent (offset, length) spans so that consecutive records are copied in one go"""
+    merged = []
+    for offset, length in spans:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
+
+def is_gzip_warc(fileobj) -> bool:
+    """Whether the records in the WARC are gzip members"""
+    pos = fileobj.tell()
+    magic = fileobj.read(2)
+    fileobj.seek(pos)
+    return magic == b'\x1f\x8b'
+
+def _copy_range_kernel(src_fd, dst_fd, offset, length) -> int:
+    """Copy in kernel with copy_file_range (or sendfile). Return the number of bytes copied"""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            if copied > 0:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            if copied > 0:
+                raise
+    return copied
+
+def copy_byte_ranges(src, dst, spans):
+    """
+    Copy (offset, length) byte ranges of the src file object to the dst file object as-is
+    Use copy_file_range/sendfile when available, so that the bytes don't go through Python
+    """
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    for offset, length in merge_spans(spans):
+        copied = _copy_range_kernel(src_fd, dst_fd, offset, length)
+        if copied > 0:
+            continue
+        # * Kernel copy not supported, fall back to read and write
+        dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+        src.seek(offset)
+        while length > 0:
+            chunk = src.read(min(length, COPY_BUFFER))
+            if not chunk:
+                break
+            dst.write(chunk)
+            length -= len(chunk)
+        dst.flush()
+    dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+
+def place_file(src, dst) -> str:
+    """
+    Make dst a file with the content of src, sharing src's bytes where possible:
+    a hardlink, else a reflink (copy-on-write clone), else a kernel copy (e.g. across devices).
+    WARCs are replaced rather than rewritten in place, so a hardlinked copy never changes under the other.
+    Returns how the file was placed ('link', 'reflink' or 'copy')
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return 'link'
+    tmp_path = f'{dst}.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+        method = 'link'
+    except OSError:
+        with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = 'reflink'
+            except OSError:
+                copy_byte_ranges(fsrc, fdst, [(0, os.fstat(fsrc.fileno()).st_size)])
+                method = 'copy'
+    os.replace(tmp_path, dst)
+    return method
+
+def move_path(src, dst, sidecars=()):
+    """
+    Move the file or directory src to dst, merging into dst if both are directories (like `cp -r` then `rm -rf`)
+    Entries are renamed when on the same filesystem, and copied then removed otherwise
+    sidecars: suffixes of files kept next to src (e.g. a warc's .cdxj index), moved along with it.
+        The move keeps src's size and mtime, so sidecars checked against them stay valid
+    """
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    for suffix in sidecars:
+        if os.path.exists(f'{src}{suffix}'):
+            move_path(f'{src}{suffix}', f'{dst}{suffix}')
+        elif os.path.exists(f'{dst}{suffix}'):
+            # * Left by the file src replaces
+            os.remove(f'{dst}{suffix}')
+    if os.path.isdir(src) and os.path.isdir(dst):
+        for name in os.listdir(src):
+            move_path(f'{src}/{name}', f'{dst}/{name}')
+        os.rmdir(src)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    shutil.move(src, dst)
+
+
+def gzip_member(data: bytes, level=GZIP_LEVEL) -> bytes:
+    """Compress data as one gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipMemberWriter:
+    """
+    Write records to fileobj as one gzip member per record (.warc.gz), in the order they are added
+    Compression runs in a thread pool (zlib releases the GIL), so the caller keeps reading while records are compressed.
+    """
+    def __init__(self, fileobj, num_threads=4, max_pending=64):
+        self.fileobj = fileobj
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.max_pending = max_pending
+        self.pending = deque()
+        # * (offset, length) of each added record in fileobj
+        self.spans = []
+
+    def add_record(self, data: bytes):
+        """Add an uncompressed record"""
+        self.pending.append(self.executor.submit(gzip_member, data))
+        if len(self.pending) >= self.max_pending:
+            self._drain(self.max_pending // 2)
+
+    def add_member(self, data: bytes):
+        """Add a record that is already a gzip member"""
+        self.pending.append(data)
+
+    def _drain(self, keep=0):
+        while len(self.pending) > keep:
+            item = self.pending.popleft()
+            data = item if isinstance(item, bytes) else item.result()
+            offset = self.fileobj.tell()
+            self.fileobj.write(data)
+            self.spans.append((offset, len(data)))
+
+    def close(self) -> list:
+        self._drain()
+        self.executor.shutdown()
+        self.fileobj.flush()
+        return self.spans
+
+
+class WarcCopier:
+    """
+    Write a WARC made of records copied from src as raw byte ranges, and newly serialized records
+    If compress is set and src is not gzip, each copied record is compressed as its own gzip member (see GzipMemberWriter).
+    Records of a gzip src are already gzip members, so they are copied as-is.
+    """
+    def __init__(self, src, dst, compress=False, num_threads=4):
+        self.src = src
+        self.dst = dst
+        src_gzip = is_gzip_warc(src)
+        self.gzip = compress or src_gzip
+        self.members = GzipMemberWriter(dst, num_threads) if compress and not src_gzip else None
+        self.copy_spans = []
+        # * (offset, length) of each record in dst
+        self.spans = []
+        self.offset = dst.tell()
+
+    def copy(self, spans):
+        """Copy records at (offset, length) spans of src"""
+        for offset, length in spans:
+            if self.members is not None:
+                self.src.seek(offset)
+                self.members.add_record(self.src.read(length))
+            else:
+                self.copy_spans.append((offset, length))
+                self.spans.append((self.offset, length))
+                self.offset += length
+
+    def _flush_copies(self):
+        copy_byte_ranges(self.src, self.dst, self.copy_spans)
+        self.copy_spans = []
+
+    def write(self, record):
+        """Serialize a warcio record"""
+        buffer = io.BytesIO()
+        WARCWriter(buffer, gzip=self.gzip).write_record(record)
+        data = buffer.getvalue()
+        if self.members is not None:
+            self.members.add_member(data)
+        else:
+            self._flush_copies()
+            self.dst.write(data)
+            self.spans.append((self.offset, len(data)))
+            self.offset += len(data)
+
+    def close(self) -> list:
+        """Finish writing. Return (offset, length) in dst of each copied/written record, in order"""
+        if self.members is not None:
+            return self.members.close()
+        self._flush_copies()
+        self.dst.flush()
+        return self.spans